@@ -1,12 +1,21 @@
 # pykarta/draw/style.py
-# Copyright 2013--2016, Trinity College
-# Last modified: 29 January 2016
+# Copyright 2013--2026, Trinity College
+# Last modified: 17 October 2026
 #
 # This module has functions to stroke lines and fill polygons using style
 # attributes borrowed from Cascadenik. See:
 # https://github.com/mapnik/Cascadenik/wiki/Dictionary
+#
+# A style dict can be used directly, but code which draws many features
+# in the same few styles (such as the vector tile renderers) should
+# compile each style once with compile_style() and keep the result,
+# perhaps in a StyleTable. A compiled style has the widths worked out
+# for a particular zoom level and the strokes reduced to the parameters
+# Cairo wants, so drawing with it involves no further lookups.
 
 import cairo
+import threading
+from collections import namedtuple
 
 line_cap = {
 	'butt':cairo.LINE_CAP_BUTT,				# default
@@ -19,44 +28,91 @@ line_join = {
 	'round':cairo.LINE_JOIN_ROUND,
 	}
 
-# Stroke the path in the specified style. This was inspired by Cascadenik.
-def stroke_with_style(ctx, style, preserve=False, width_scale=1.0):
+# One stroke (underline, line, or overline) as Cairo parameters
+CompiledStroke = namedtuple("CompiledStroke", ("width", "rgba", "dash", "join", "cap"))
+
+# A style ready for drawing. Each of underline, line, and overline is a
+# CompiledStroke or None. Strokes lists those which are present in the
+# order in which they are drawn. Fill is an RGBA tuple or None.
+CompiledStyle = namedtuple("CompiledStyle", ("underline", "line", "overline", "strokes", "fill"))
+
+# Use a rule (start_zoom, start_width, end_zoom, end_width) to determine
+# the width of a feature at the indicated zoom level.
+def zoom_width(rule, zoom):
+	start_zoom, start_width, end_zoom, end_width = rule
+	position = float(zoom - start_zoom) / float(end_zoom - start_zoom)
+	width = start_width + position * (end_width - start_width)
+	if width < 0.1:
+		print("Warning: rules %s yields width of %f at zoom %f" % (str(rule), width, zoom))
+	return width
+
+def _rgba(color):
+	if len(color) == 4:
+		return tuple(color)
+	return (color[0], color[1], color[2], 1.0)
+
+# Convert a style dict to a CompiledStyle. Widths may be given as rules
+# for zoom_width(), in which case zoom must be supplied.
+def compile_style(style, zoom=None):
+	if isinstance(style, CompiledStyle):
+		return style
+
 	# Nobody should be using the old keys
 	assert not "color" in style			# color -> line-color
 	assert not "dash-pattern" in style	# dash-pattern -> line-dash
 	assert not "line-dash" in style		# line-dash -> line-dasharray
 	assert not "width" in style			# width -> line-width
 
-	ctx.set_line_cap(cairo.LINE_CAP_ROUND)
-
-	# This stroke goes 'under' the main stroke. It can be used to put
-	# a border around the main stroke or the dash pattern can be used
-	# to give it wiskers.
-	if 'underline-width' in style:
-		ctx.set_line_width(style['underline-width'] * width_scale)
-		ctx.set_source_rgba(*style['underline-color'])
-		ctx.set_dash(style.get('underline-dasharray', ()))
-		ctx.set_line_join(line_join[style.get('underline-join', 'miter')])
-		ctx.set_line_cap(line_cap[style.get('underline-cap', 'butt')])
-		ctx.stroke_preserve()
+	strokes = []
+	for prefix in ("underline", "line", "overline"):
+		width = style.get(prefix + '-width')
+		if width is None:
+			strokes.append(None)
+			continue
+		if isinstance(width, (tuple, list)):
+			width = zoom_width(width, zoom)
+		if prefix == "line":
+			color = style.get('line-color', (0.0, 0.0, 0.0))
+		else:
+			color = style[prefix + '-color']
+		strokes.append(CompiledStroke(
+			float(width),
+			_rgba(color),
+			tuple(style.get(prefix + '-dasharray', ())),
+			line_join[style.get(prefix + '-join', 'miter')],
+			line_cap[style.get(prefix + '-cap', 'butt')],
+			))
 
-	# This is the main stroke.
-	if 'line-width' in style:
-		ctx.set_line_width(style['line-width'] * width_scale)
-		ctx.set_source_rgba(*style.get('line-color', (0.0, 0.0, 0.0)))
-		ctx.set_dash(style.get('line-dasharray', ()))
-		ctx.set_line_join(line_join[style.get('line-join', 'miter')])
-		ctx.set_line_cap(line_cap[style.get('line-cap', 'butt')])
-		ctx.stroke_preserve()
+	fill_color = style.get("fill-color")
+	return CompiledStyle(
+		strokes[0], strokes[1], strokes[2],
+		tuple([stroke for stroke in strokes if stroke is not None]),
+		_rgba(fill_color) if fill_color is not None else None,
+		)
+
+# Prepare to stroke the path with a CompiledStroke
+def set_stroke(ctx, stroke, width_scale=1.0):
+	width, rgba, dash, join, cap = stroke
+	ctx.set_line_width(width * width_scale)
+	ctx.set_source_rgba(*rgba)
+	ctx.set_dash(dash)
+	ctx.set_line_join(join)
+	ctx.set_line_cap(cap)
+
+# Stroke the path in the specified style, a dict or a CompiledStyle. This
+# was inspired by Cascadenik. Up to three strokes are drawn:
+# * The underline goes 'under' the main stroke. It can be used to put
+#   a border around the main stroke or the dash pattern can be used
+#   to give it wiskers.
+# * The line is the main stroke.
+# * The overline goes over the main stroke. We can use it to run a solid
+#   or dashed line down the center of the main stroke.
+def stroke_with_style(ctx, style, preserve=False, width_scale=1.0):
+	if not isinstance(style, CompiledStyle):
+		style = compile_style(style)
 
-	# This stroke goes over the main stroke. We can use it to run a solid
-	# or dashed line down the center of the main stroke.
-	if 'overline-width' in style:
-		ctx.set_line_width(style['overline-width'] * width_scale)
-		ctx.set_source_rgba(*style['overline-color'])
-		ctx.set_dash(style.get('overline-dasharray', ()))
-		ctx.set_line_join(line_join[style.get('overline-join', 'miter')])
-		ctx.set_line_cap(line_cap[style.get('overline-cap', 'butt')])
+	for stroke in style.strokes:
+		set_stroke(ctx, stroke, width_scale)
 		ctx.stroke_preserve()
 
 	# This whole function is pitched as a substitute for stroke(), so
@@ -68,7 +124,10 @@ def stroke_with_style(ctx, style, preserve=False, width_scale=1.0):
 # filled with transparent white. To disable filling, set fill-color
 # to None in the style.
 def fill_with_style(ctx, style, preserve=False):
-	fill_color = style.get("fill-color")
+	if isinstance(style, CompiledStyle):
+		fill_color = style.fill
+	else:
+		fill_color = style.get("fill-color")
 	if fill_color is not None:
 		if len(fill_color) == 4:
 			ctx.set_source_rgba(*fill_color)
@@ -79,4 +138,36 @@ def fill_with_style(ctx, style, preserve=False):
 		else:
 			ctx.fill()
 
+# Compiled styles numbered in the order in which they were added, so
+# that features can carry a small integer in place of their style. Each
+# is filed under a key (anything hashable) which determines it, such as
+# the name of an entry in a table of styles together with any
+# modifiers applied to it. The widths are worked out for zoom.
+class StyleTable(object):
+	def __init__(self, zoom=None):
+		self.zoom = zoom
+		self.styles = []				# id -> CompiledStyle
+		self.ids = {}					# key -> id or None
+		self.lock = threading.Lock()
+
+	# Return the id of the style filed under key. If there is none yet,
+	# style_function(key) is called to get the style dict. If it returns
+	# None, so do we.
+	def get_id(self, key, style_function):
+		try:
+			return self.ids[key]
+		except KeyError:
+			pass
+		style = style_function(key)
+		with self.lock:
+			if not key in self.ids:
+				if style is None:
+					self.ids[key] = None
+				else:
+					self.styles.append(compile_style(style, self.zoom))
+					self.ids[key] = len(self.styles) - 1
+			return self.ids[key]
+
+	def __getitem__(self, style_id):
+		return self.styles[style_id]
 
@@ -0,0 +1,315 @@
+# pykarta/formats/geojson_reader.py
+# Copyright 2026, Trinity College
+# Last modified: 17 October 2026
+
+# Incremental reader for GeoJSON FeatureCollections such as vector tiles
+#
+# Rather than parsing the whole document into Python objects, this reads
+# it (gunzipping it if necessary) a piece at a time and yields the features
+# one by one. The id, properties and geometry type of each feature are
+# parsed, but the geometry itself is only parsed if the caller asks for it,
+# so a renderer can skip the features it has no style for without
+# building their coordinate lists.
+#
+# A document may be a single FeatureCollection or a dict of them, as the
+# tile server returns for a layer set:
+#
+# reader = GeojsonReader(data=tile_bytes)
+# for name, collection in reader.collections():
+#	for feature in collection:
+#		if feature.geometry_type == "LineString" and feature.properties.get("highway"):
+#			coordinates = feature.geometry()["coordinates"]
+#	if collection.foreign_members.get("tile_pixels"): ...
+#
+# Each collection must be finished with before the next is started,
+# though features need not be. The foreign members of a collection
+# (such as "tile_pixels") may follow its features, so they are complete
+# only once all of them have been read.
+
+import json
+import re
+import zlib
+import codecs
+
+class GeojsonReaderError(Exception):
+	pass
+
+class GeojsonFeature(object):
+	__slots__ = ("id", "properties", "geometry_type", "_text", "_start", "_stop", "_geometry")
+	def __init__(self):
+		self.id = None
+		self.properties = {}
+		self.geometry_type = None
+		self._text = None
+		self._geometry = None
+
+	# Wrap a feature which has already been parsed
+	@classmethod
+	def from_dict(cls, feature):
+		self = cls()
+		self.id = feature.get("id")
+		self.properties = feature.get("properties") or {}
+		self._geometry = feature.get("geometry")
+		if self._geometry is not None:
+			self.geometry_type = self._geometry.get("type")
+		return self
+
+	# Parse and return the geometry (or None).
+	def geometry(self):
+		if self._geometry is None and self._text is not None:
+			self._geometry = json.loads(self._text[self._start:self._stop])
+			self._text = None
+		return self._geometry
+
+class GeojsonCollection(object):
+	def __init__(self, reader, first_key):
+		self.foreign_members = {}
+		self.features = reader._features(self, first_key)
+	def __iter__(self):
+		return self.features
+
+class GeojsonReader(object):
+	chunk_size = 65536
+
+	def __init__(self, data=None, filename=None):
+		if filename is not None:
+			self.fh = open(filename, "rb")
+		else:
+			self.fh = None
+			self.data = data
+			self.data_pos = 0
+		self.gunzip = None
+		self.decoder = codecs.getincrementaldecoder("utf-8")()
+		self.text = ""
+		self.pos = 0
+		self.eof = False
+		self.started = False
+
+	#-------------------------------------------------------------------
+	# Public interface
+	#-------------------------------------------------------------------
+
+	# Yield (name, collection) for each FeatureCollection. If the document is
+	# a single FeatureCollection, name is None.
+	def collections(self):
+		self._expect("{")
+		key = self._next_key(True)
+		while key is not None:
+			if key in ("type", "features"):			# a FeatureCollection itself
+				collection = GeojsonCollection(self, key)
+				yield (None, collection)
+				self._finish(collection)
+				return
+			self._expect("{")
+			collection = GeojsonCollection(self, self._next_key(True))
+			yield (key, collection)
+			self._finish(collection)
+			key = self._next_key(False)
+
+	# Does the input look like JSON? A Mapbox Vector Tile, for instance, does not.
+	def is_json(self):
+		try:
+			return self._peek() == "{"
+		except (GeojsonReaderError, UnicodeDecodeError):
+			return False
+
+	def close(self):
+		if self.fh is not None:
+			self.fh.close()
+			self.fh = None
+
+	#-------------------------------------------------------------------
+	# Parsing of FeatureCollections and Features
+	#-------------------------------------------------------------------
+
+	# Yield the features of a collection. We are positioned just after the
+	# first key of the collection.
+	def _features(self, collection, key):
+		while key is not None:
+			if key == "features":
+				self._expect("[")
+				if self._peek() == "]":
+					self.pos += 1
+				else:
+					while True:
+						self._compact()
+						yield self._feature()
+						if self._comma_or(("]",)) == "]":
+							break
+			else:
+				value = self._value()
+				if key != "type":
+					collection.foreign_members[key] = value
+			key = self._next_key(False)
+
+	# Read the rest of a collection whose consumer stopped early
+	def _finish(self, collection):
+		for feature in collection.features:
+			pass
+
+	def _feature(self):
+		feature = GeojsonFeature()
+		self._expect("{")
+		key = self._next_key(True)
+		while key is not None:
+			if key == "properties":
+				feature.properties = self._value() or {}
+			elif key == "geometry":
+				self._geometry(feature)
+			elif key == "id":
+				feature.id = self._value()
+			else:
+				self._value()
+			key = self._next_key(False)
+		return feature
+
+	geometry_type_re = re.compile(r'\{\s*"type"\s*:\s*"(\w+)"')
+
+	# Find the extent of a geometry without parsing it. Apart from the
+	# type, simple geometries contain only numbers and brackets, so the
+	# first closing brace ends them. A GeometryCollection is parsed.
+	def _geometry(self, feature):
+		self._skip_whitespace()
+		while True:
+			if self.text.startswith("null", self.pos):
+				self.pos += 4
+				return
+			m = self.geometry_type_re.match(self.text, self.pos)
+			if m is None:
+				if len(self.text) - self.pos < 64 and self._fill():
+					continue
+				# Perhaps "type" does not come first
+				geometry = self._value()
+				feature.geometry_type = geometry.get("type")
+				feature._geometry = geometry
+				return
+			geometry_type = m.group(1)
+			if geometry_type == "GeometryCollection":
+				feature.geometry_type = geometry_type
+				feature._geometry = self._value()
+				return
+			stop = self.text.find("}", m.end())
+			if stop == -1:
+				if self._fill():
+					continue
+				raise GeojsonReaderError("unterminated geometry")
+			feature.geometry_type = geometry_type
+			feature._text = self.text
+			feature._start = self.pos
+			feature._stop = stop + 1
+			self.pos = stop + 1
+			return
+
+	#-------------------------------------------------------------------
+	# JSON tokens
+	#-------------------------------------------------------------------
+
+	whitespace_re = re.compile(r'\s*')
+	json_decoder = json.JSONDecoder()
+
+	# Read more text into the buffer. Returns False at the end of the input.
+	def _fill(self):
+		if self.eof:
+			return False
+		data = self._read()
+		if not self.started:
+			self.started = True
+			# A small chunk may split the two byte gzip signature.
+			while 0 < len(data) < 2:
+				more = self._read()
+				if len(more) == 0:
+					break
+				data += more
+			if data[:2] == b"\x1f\x8b":
+				self.gunzip = zlib.decompressobj(zlib.MAX_WBITS | 16)
+		if len(data) == 0:
+			self.eof = True
+			if self.gunzip is not None:
+				data = self.gunzip.flush()
+			self.text += self.decoder.decode(data, final=True)
+			return True
+		if self.gunzip is not None:
+			data = self.gunzip.decompress(data)
+		self.text += self.decoder.decode(data)
+		return True
+
+	def _read(self):
+		if self.fh is not None:
+			return self.fh.read(self.chunk_size)
+		data = self.data[self.data_pos:self.data_pos+self.chunk_size]
+		self.data_pos += len(data)
+		return data
+
+	# Drop the text which has been consumed. This is done only between
+	# features so that positions within the buffer remain valid.
+	def _compact(self):
+		if self.pos > self.chunk_size:
+			self.text = self.text[self.pos:]
+			self.pos = 0
+
+	def _skip_whitespace(self):
+		if self.pos < len(self.text) and not self.text[self.pos] in " \t\r\n":
+			return
+		while True:
+			self.pos = self.whitespace_re.match(self.text, self.pos).end()
+			if self.pos < len(self.text) or not self._fill():
+				return
+
+	def _peek(self):
+		self._skip_whitespace()
+		if self.pos >= len(self.text):
+			raise GeojsonReaderError("unexpected end of input")
+		return self.text[self.pos]
+
+	def _expect(self, char):
+		if self._peek() != char:
+			raise GeojsonReaderError("expected %s at %s" % (char, repr(self.text[self.pos:self.pos+20])))
+		self.pos += 1
+
+	# Consume a comma or one of the indicated closing characters and return it
+	def _comma_or(self, closers):
+		char = self._peek()
+		if char != "," and not char in closers:
+			raise GeojsonReaderError("expected , or %s at %s" % (" or ".join(closers), repr(self.text[self.pos:self.pos+20])))
+		self.pos += 1
+		return char
+
+	# Read a complete JSON value
+	def _value(self):
+		self._skip_whitespace()
+		while True:
+			try:
+				value, stop = self.json_decoder.raw_decode(self.text, self.pos)
+				# A number at the end of the buffer may continue in the next chunk.
+				if stop < len(self.text) or self.eof:
+					self.pos = stop
+					return value
+			except ValueError:
+				if self.eof:
+					raise
+			self._fill()
+
+	first_key_re = re.compile(r'\s*"([^"\\]*)"\s*:\s*')
+	next_key_re = re.compile(r'\s*,\s*"([^"\\]*)"\s*:\s*')
+
+	# Read the next key of an object and the colon after it. Returns None at
+	# the end of the object.
+	def _next_key(self, first):
+		# Fast path for a plain key which is not at the end of the buffer
+		m = (self.first_key_re if first else self.next_key_re).match(self.text, self.pos)
+		if m is not None and m.end() < len(self.text):
+			self.pos = m.end()
+			return m.group(1)
+		if first:
+			if self._peek() == "}":
+				self.pos += 1
+				return None
+		elif self._comma_or(("}",)) == "}":
+			return None
+		self._skip_whitespace()
+		key = self._value()
+		if not isinstance(key, str):
+			raise GeojsonReaderError("expected key")
+		self._expect(":")
+		return key
+
@@ -1,30 +1,35 @@
 # pykarta/formats/mbtiles.py
-# Copyright 2013--2023, Trinity College
-# Last modified: 26 March 2023
+# Copyright 2013--2026, Trinity College
+# Last modified: 18 October 2026
 
 import sqlite3
+import threading
+import queue
+import time
 
+# Writes tiles into an MBTiles file. If the file already exists, as when
+# the tiles are seeded again after an import, the tiles and metadata
+# written replace those already there and the others are kept.
 class MapMbtilesWriter(object):
 	def __init__(self, mbtiles, metadata):
 		self.conn = sqlite3.connect(mbtiles)
 		self.cursor = self.conn.cursor()
 
-		self.cursor.execute("CREATE TABLE metadata (name text, value text)")
-		self.cursor.execute("CREATE UNIQUE INDEX metadata_index on metadata (name)")
-		self.cursor.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
-		self.cursor.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row)")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_index on metadata (name)")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index on tiles (zoom_level, tile_column, tile_row)")
 
 		for name, value in list(metadata.items()):
-			self.cursor.execute("INSERT INTO metadata (name, value) values (?, ?)", (name, value))
+			self.cursor.execute("INSERT OR REPLACE INTO metadata (name, value) values (?, ?)", (name, value))
 
 		self.count = 0
 
 	def add_tile(self, zoom, x, y, tile_data):
 		flipped_y = (2**zoom-1) - y
 		self.cursor.execute(
-			"INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?)",
-			#(zoom, x, flipped_y, sqlite3.Binary(tile_data))
-			(zoom, x, flipped_y, buffer(tile_data))
+			"INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?)",
+			(zoom, x, flipped_y, sqlite3.Binary(tile_data))
 			)
 
 		self.count += 1
@@ -37,3 +42,132 @@ class MapMbtilesWriter(object):
 		self.conn.close()
 		self.conn = None
 
+#=============================================================================
+# An MBTiles file used as a cache of downloaded tiles
+#
+# The tiles table has the standard MBTiles columns, so the file can be
+# opened by other MBTiles readers, plus columns for the HTTP validators
+# (ETag and Last-Modified), the time the tile was fetched or revalidated,
+# and the time it was last used. The last is indexed for LRU eviction.
+#
+# Reads are done on a connexion belonging to the calling thread. Writes
+# are put in a queue and done by a background thread which commits them
+# in batches. Until a write is committed, get() finds it in the pending
+# dictionary, so a tile can be read back as soon as put() returns.
+#=============================================================================
+
+class MapMbtilesCache(object):
+	batch_size = 200				# maximum writes per transaction
+	access_resolution = 3600.0		# don't record access times more precisely than this
+
+	def __init__(self, filename, metadata={}):
+		self.filename = filename
+		self.local = threading.local()
+		self.pending = {}
+		self.pending_lock = threading.Lock()
+		self.writes = queue.Queue()
+
+		conn = self._connect()
+		conn.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+		conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_index on metadata (name)")
+		conn.execute("""CREATE TABLE IF NOT EXISTS tiles (
+			zoom_level integer, tile_column integer, tile_row integer, tile_data blob,
+			etag text, last_modified text, fetched real, last_access real
+			)""")
+		conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index on tiles (zoom_level, tile_column, tile_row)")
+		conn.execute("CREATE INDEX IF NOT EXISTS tile_last_access on tiles (last_access)")
+		for name, value in list(metadata.items()):
+			conn.execute("INSERT OR REPLACE INTO metadata (name, value) values (?, ?)", (name, value))
+		conn.commit()
+
+		self.writer = threading.Thread(target=self._writer, name="mbtiles-writer")
+		self.writer.daemon = True
+		self.writer.start()
+
+	def _connect(self):
+		conn = getattr(self.local, "conn", None)
+		if conn is None:
+			conn = sqlite3.connect(self.filename, timeout=30)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+			self.local.conn = conn
+		return conn
+
+	# Return (tile_data, etag, last_modified, fetched) or None.
+	def get(self, zoom, x, y):
+		key = (zoom, x, (2**zoom-1) - y)
+		with self.pending_lock:
+			row = self.pending.get(key)
+		if row is not None:
+			return row[:4]
+		row = self._connect().execute(
+			"SELECT tile_data, etag, last_modified, fetched, last_access FROM tiles WHERE zoom_level = ? and tile_column = ? and tile_row = ?",
+			key).fetchone()
+		if row is None:
+			return None
+		now = time.time()
+		if row[4] is None or now - row[4] > self.access_resolution:
+			self.writes.put(("UPDATE tiles SET last_access = ? WHERE zoom_level = ? and tile_column = ? and tile_row = ?", (now,) + key, None))
+		return (bytes(row[0]), row[1], row[2], row[3])
+
+	def put(self, zoom, x, y, tile_data, etag=None, last_modified=None):
+		key = (zoom, x, (2**zoom-1) - y)
+		now = time.time()
+		row = (tile_data, etag, last_modified, now)
+		with self.pending_lock:
+			self.pending[key] = row
+		self.writes.put((
+			"INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, etag, last_modified, fetched, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+			key + (sqlite3.Binary(tile_data), etag, last_modified, now, now),
+			(key, row)
+			))
+
+	# Record that the tile has been revalidated
+	def touch(self, zoom, x, y):
+		key = (zoom, x, (2**zoom-1) - y)
+		now = time.time()
+		self.writes.put(("UPDATE tiles SET fetched = ?, last_access = ? WHERE zoom_level = ? and tile_column = ? and tile_row = ?", (now, now) + key, None))
+
+	def remove(self, zoom, x, y):
+		key = (zoom, x, (2**zoom-1) - y)
+		with self.pending_lock:
+			self.pending.pop(key, None)
+		self.writes.put(("DELETE FROM tiles WHERE zoom_level = ? and tile_column = ? and tile_row = ?", key, None))
+
+	# Delete tiles not used since the indicated time and then, if there
+	# are still more than max_tiles, the least recently used.
+	def evict(self, unused_since=None, max_tiles=None):
+		if unused_since is not None:
+			self.writes.put(("DELETE FROM tiles WHERE last_access < ?", (unused_since,), None))
+		if max_tiles is not None:
+			self.writes.put(("DELETE FROM tiles WHERE rowid IN (SELECT rowid FROM tiles ORDER BY last_access LIMIT max(0, (SELECT count(*) FROM tiles) - ?))", (max_tiles,), None))
+
+	# Wait until all queued writes have been committed
+	def flush(self):
+		self.writes.join()
+
+	# Writer thread body. Waits for a write and then takes as many more
+	# as are waiting (up to batch_size) and does them in one transaction.
+	def _writer(self):
+		conn = self._connect()
+		while True:
+			batch = [self.writes.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self.writes.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				with conn:
+					for sql, params, pending in batch:
+						conn.execute(sql, params)
+			except sqlite3.Error as e:
+				print("MBTiles cache %s: %s" % (self.filename, str(e)))
+			with self.pending_lock:
+				for sql, params, pending in batch:
+					if pending is not None:
+						key, row = pending
+						if self.pending.get(key) is row:
+							del self.pending[key]
+			for i in range(len(batch)):
+				self.writes.task_done()
@@ -0,0 +1,375 @@
+# pykarta/formats/mvt.py
+# Copyright 2026, Trinity College
+# Last modified: 17 October 2026
+
+# Reader and writer for Mapbox Vector Tiles (version 2 of the specification)
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+#
+# A vector tile contains named layers of features. Coordinates are integers
+# in the tile's own grid (extent units across, normally 4096) and are
+# delta and zigzag encoded, which is why the tiles are so much smaller
+# than GeoJSON. The Protocol Buffers encoding is done here by hand, since
+# the subset used by vector tiles is small.
+#
+# mvt_encode_geojson() takes the layers as a dict of GeoJSON
+# FeatureCollections with coordinates in degrees and returns the tile.
+#
+# mvt_decode() returns a dict of GeoJSON FeatureCollections with coordinates
+# already in tile pixels (0 to 256). These carry the foreign member
+# "tile_pixels", which MapGeoJSONTile takes as a sign that the features
+# need not be projected.
+
+import struct
+import json
+from pykarta.geometry.projection import project_geojson_geometries_quantized
+
+class MvtError(Exception):
+	pass
+
+GEOM_UNKNOWN = 0
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+GEOM_POLYGON = 3
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_CLOSE_PATH = 7
+
+#=============================================================================
+# Protocol Buffers primitives
+#=============================================================================
+
+def _varint(value):
+	out = bytearray()
+	while value > 0x7F:
+		out.append((value & 0x7F) | 0x80)
+		value >>= 7
+	out.append(value)
+	return bytes(out)
+
+def _zigzag(value):
+	return (value << 1) ^ (value >> 63)
+
+def _unzigzag(value):
+	return (value >> 1) ^ -(value & 1)
+
+def _field_varint(field, value):
+	return _varint(field << 3) + _varint(value)
+
+def _field_bytes(field, payload):
+	return _varint((field << 3) | 2) + _varint(len(payload)) + payload
+
+def _packed(values):
+	return b"".join([_varint(value) for value in values])
+
+# Yield (field number, wire type, value) for each field in a message. The value
+# of a length-delimited field is a memoryview.
+def _fields(data):
+	pos = 0
+	end = len(data)
+	while pos < end:
+		key, pos = _read_varint(data, pos)
+		field = key >> 3
+		wire_type = key & 7
+		if wire_type == 0:
+			value, pos = _read_varint(data, pos)
+		elif wire_type == 2:
+			length, pos = _read_varint(data, pos)
+			value = data[pos:pos+length]
+			pos += length
+		elif wire_type == 1:
+			value = data[pos:pos+8]
+			pos += 8
+		elif wire_type == 5:
+			value = data[pos:pos+4]
+			pos += 4
+		else:
+			raise MvtError("unsupported wire type %d" % wire_type)
+		yield (field, wire_type, value)
+
+def _read_varint(data, pos):
+	result = 0
+	shift = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		result |= (byte & 0x7F) << shift
+		if byte < 0x80:
+			return (result, pos)
+		shift += 7
+
+def _read_packed(data):
+	values = []
+	pos = 0
+	end = len(data)
+	while pos < end:
+		value, pos = _read_varint(data, pos)
+		values.append(value)
+	return values
+
+#=============================================================================
+# Encoder
+#=============================================================================
+
+# Geometry of one feature as MVT commands. Coordinates are integers.
+def _encode_geometry(geometry_type, coordinates):
+	commands = []
+	cursor = [0, 0]
+	def move(points, command, count):
+		commands.append(command | (count << 3))
+		for x, y in points:
+			commands.append(_zigzag(x - cursor[0]))
+			commands.append(_zigzag(y - cursor[1]))
+			cursor[0] = x
+			cursor[1] = y
+
+	if geometry_type in ("Point", "MultiPoint"):
+		points = [coordinates] if geometry_type == "Point" else coordinates
+		move(points, CMD_MOVE_TO, len(points))
+		return (GEOM_POINT, commands)
+
+	if geometry_type in ("LineString", "MultiLineString"):
+		for line in ([coordinates] if geometry_type == "LineString" else coordinates):
+			move(line[:1], CMD_MOVE_TO, 1)
+			move(line[1:], CMD_LINE_TO, len(line) - 1)
+		return (GEOM_LINESTRING, commands)
+
+	if geometry_type in ("Polygon", "MultiPolygon"):
+		for polygon in ([coordinates] if geometry_type == "Polygon" else coordinates):
+			for i, ring in enumerate(polygon):
+				ring = ring[:-1]		# the closing point is implied
+				# Exterior rings must have a positive area (clockwise as
+				# seen on the screen), holes a negative area.
+				if (_ring_area(ring) > 0) != (i == 0):
+					ring = ring[::-1]
+				move(ring[:1], CMD_MOVE_TO, 1)
+				move(ring[1:], CMD_LINE_TO, len(ring) - 1)
+				commands.append(CMD_CLOSE_PATH | (1 << 3))
+		return (GEOM_POLYGON, commands)
+
+	raise MvtError("unsupported geometry type %s" % geometry_type)
+
+# Twice the signed area of a ring by the surveyor's formula
+def _ring_area(ring):
+	area = 0
+	for i in range(len(ring)):
+		x1, y1 = ring[i-1]
+		x2, y2 = ring[i]
+		area += x1 * y2 - x2 * y1
+	return area
+
+def _encode_value(value):
+	if isinstance(value, bool):
+		return _field_varint(7, int(value))
+	if isinstance(value, int):
+		if value < 0:
+			return _field_varint(6, _zigzag(value))
+		return _field_varint(5, value)
+	if isinstance(value, float):
+		return _varint((3 << 3) | 1) + struct.pack("<d", value)
+	if not isinstance(value, str):
+		value = json.dumps(value)
+	return _field_bytes(1, value.encode("utf-8"))
+
+# Encode one layer. The features are (id, geometry_type, coordinates, properties)
+# with integer coordinates in the tile's grid.
+def mvt_encode_layer(name, features, extent=4096):
+	keys = {}
+	values = {}
+	value_list = []
+	encoded_features = []
+	for id, geometry_type, coordinates, properties in features:
+		tags = []
+		for key, value in properties.items():
+			if value is None:
+				continue
+			key_index = keys.setdefault(key, len(keys))
+			value_key = (type(value), value if isinstance(value, (str, int, float, bool)) else json.dumps(value))
+			value_index = values.get(value_key)
+			if value_index is None:
+				value_index = values[value_key] = len(value_list)
+				value_list.append(value)
+			tags.extend((key_index, value_index))
+		mvt_type, commands = _encode_geometry(geometry_type, coordinates)
+		feature = b""
+		if isinstance(id, int) and id >= 0:
+			feature += _field_varint(1, id)
+		if tags:
+			feature += _field_bytes(2, _packed(tags))
+		feature += _field_varint(3, mvt_type)
+		feature += _field_bytes(4, _packed(commands))
+		encoded_features.append(_field_bytes(2, feature))
+
+	layer = [_field_varint(15, 2), _field_bytes(1, name.encode("utf-8"))]
+	layer.extend(encoded_features)
+	layer.extend([_field_bytes(3, key.encode("utf-8")) for key in keys])
+	layer.extend([_field_bytes(4, _encode_value(value)) for value in value_list])
+	layer.append(_field_varint(5, extent))
+	return _field_bytes(3, b"".join(layer))
+
+# Encode a tile from a dict of layer name -> GeoJSON FeatureCollection
+# with coordinates in degrees.
+def mvt_encode_geojson(layers, zoom, x, y, extent=4096):
+	encoded_layers = []
+	for name, geojson in layers.items():
+		features = geojson["features"]
+		geometries = []
+		for feature in features:
+			geometry = feature["geometry"]
+			if geometry["type"] == "GeometryCollection":
+				geometries.extend(geometry["geometries"])
+			else:
+				geometries.append(geometry)
+		quantized = iter(project_geojson_geometries_quantized(geometries, zoom, x, y, extent))
+		layer_features = []
+		for feature in features:
+			geometry = feature["geometry"]
+			count = len(geometry["geometries"]) if geometry["type"] == "GeometryCollection" else 1
+			for i in range(count):
+				geometry = next(quantized)
+				if geometry is not None:
+					layer_features.append((feature.get("id"), geometry["type"], geometry["coordinates"], feature["properties"]))
+		encoded_layers.append(mvt_encode_layer(name, layer_features, extent))
+	return b"".join(encoded_layers)
+
+#=============================================================================
+# Decoder
+#=============================================================================
+
+def mvt_decode(data, tilesize=256):
+	data = memoryview(data)
+	layers = {}
+	for field, wire_type, value in _fields(data):
+		if field == 3:
+			name, geojson = _decode_layer(value, tilesize)
+			layers[name] = geojson
+	return layers
+
+def _decode_layer(data, tilesize):
+	name = None
+	keys = []
+	values = []
+	raw_features = []
+	extent = 4096
+	for field, wire_type, value in _fields(data):
+		if field == 1:
+			name = bytes(value).decode("utf-8")
+		elif field == 2:
+			raw_features.append(value)
+		elif field == 3:
+			keys.append(bytes(value).decode("utf-8"))
+		elif field == 4:
+			values.append(_decode_value(value))
+		elif field == 5:
+			extent = value
+	scale = float(tilesize) / extent
+
+	features = []
+	for raw_feature in raw_features:
+		id = None
+		tags = []
+		geom_type = GEOM_UNKNOWN
+		commands = []
+		for field, wire_type, value in _fields(raw_feature):
+			if field == 1:
+				id = value
+			elif field == 2:
+				tags = _read_packed(value)
+			elif field == 3:
+				geom_type = value
+			elif field == 4:
+				commands = _read_packed(value)
+		geometry = _decode_geometry(geom_type, commands, scale)
+		if geometry is None:
+			continue
+		properties = {}
+		for i in range(0, len(tags) - 1, 2):
+			properties[keys[tags[i]]] = values[tags[i+1]]
+		feature = {
+			"type": "Feature",
+			"geometry": geometry,
+			"properties": properties,
+			}
+		if id is not None:
+			feature["id"] = id
+		features.append(feature)
+
+	return (name, {
+		"type": "FeatureCollection",
+		"features": features,
+		"tile_pixels": True,
+		})
+
+def _decode_value(data):
+	for field, wire_type, value in _fields(data):
+		if field == 1:
+			return bytes(value).decode("utf-8")
+		if field == 2:
+			return struct.unpack("<f", value)[0]
+		if field == 3:
+			return struct.unpack("<d", value)[0]
+		if field == 4:
+			return value - (1 << 64) if value >= (1 << 63) else value
+		if field == 5:
+			return value
+		if field == 6:
+			return _unzigzag(value)
+		if field == 7:
+			return bool(value)
+	return None
+
+# Turn the commands into lists of points. Each MoveTo starts a new list.
+def _decode_paths(commands, scale):
+	paths = []
+	path = None
+	x = y = 0
+	i = 0
+	end = len(commands)
+	while i < end:
+		command = commands[i] & 7
+		count = commands[i] >> 3
+		i += 1
+		if command == CMD_CLOSE_PATH:
+			if path is not None and len(path) > 0:
+				path.append(path[0])
+			continue
+		for j in range(count):
+			x += _unzigzag(commands[i])
+			y += _unzigzag(commands[i+1])
+			i += 2
+			if command == CMD_MOVE_TO:
+				path = []
+				paths.append(path)
+			path.append((x * scale, y * scale))
+	return paths
+
+def _decode_geometry(geom_type, commands, scale):
+	paths = _decode_paths(commands, scale)
+	if len(paths) == 0:
+		return None
+
+	if geom_type == GEOM_POINT:
+		points = [path[0] for path in paths]
+		if len(points) == 1:
+			return {"type": "Point", "coordinates": points[0]}
+		return {"type": "MultiPoint", "coordinates": points}
+
+	if geom_type == GEOM_LINESTRING:
+		if len(paths) == 1:
+			return {"type": "LineString", "coordinates": paths[0]}
+		return {"type": "MultiLineString", "coordinates": paths}
+
+	if geom_type == GEOM_POLYGON:
+		polygons = []
+		for ring in paths:
+			area = _ring_area(ring)
+			if area > 0 or len(polygons) == 0:
+				polygons.append([ring])
+			elif area < 0:
+				polygons[-1].append(ring)
+		if len(polygons) == 1:
+			return {"type": "Polygon", "coordinates": polygons[0]}
+		return {"type": "MultiPolygon", "coordinates": polygons}
+
+	return None
+
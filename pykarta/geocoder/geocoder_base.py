@@ -1,9 +1,10 @@
 # pykarta/geocoder/geocoder_base.py
 # Copyright 2013--2019, Trinity College Computing Center
-# Last modified: 4 May 2019
+# Last modified: 17 October 2026
 
 
 import threading
+import concurrent.futures
 try:
 	import http.client
 except ImportError:
@@ -16,21 +17,16 @@ import sys
 import pykarta
 from pykarta.misc import NoInet
 
-# Thread in which the HTTP GET runs
-class GetThread(threading.Thread):
-	def __init__(self, geocoder, path, kwargs):
-		threading.Thread.__init__(self)
-		self.geocoder = geocoder
-		self.path = path
-		self.kwargs = kwargs
-		self.result = None
-		self.exception = None
-		self.daemon = True
-	def run(self):
-		try:
-			self.result = self.geocoder.get_blocking(self.path, **(self.kwargs))
-		except Exception as e:
-			self.exception = e
+# Threads in which the HTTP requests run. They are shared by all of the
+# geocoders so that several can wait for their servers at once.
+executor = None
+executor_lock = threading.Lock()
+def get_executor():
+	global executor
+	with executor_lock:
+		if executor is None:
+			executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="geocoder")
+		return executor
 
 class GeocoderBase(object):
 
@@ -57,6 +53,8 @@ class GeocoderBase(object):
 		self.name = self.__class__.__name__
 		self.last_request_time = 0
 		self.last_progress_part = 0
+		self.rate_lock = threading.Lock()
+		self.cancel_event = None		# set by GeocoderMulti to stop a request
 
 	def debug(self, *args):
 		if self.debug_enabled:
@@ -82,23 +80,29 @@ class GeocoderBase(object):
 
 	# Send an HTTP query to the geocoder server.
 	# Calls get_blocking() which is defined below.
-	# Runs it in a thread so as to keep the GUI refreshed while waiting.
+	# If called from the main thread, runs it in another thread so as to
+	# keep the GUI refreshed while waiting. (GeocoderMulti may already
+	# be calling us from another thread, in which case it is not necessary.)
 	# Handles retries.
 	def get(self, path, **kwargs):
 		assert self.url_server is not None
+		in_main_thread = threading.current_thread() is threading.main_thread()
 		retry = 0
 		while True:
 			try:
-				thread = GetThread(self, path, kwargs)
-				thread.start()
+				if not in_main_thread:
+					return self.get_blocking(path, **kwargs)
+				future = get_executor().submit(self.get_blocking, path, **kwargs)
 				bump = 0.0
-				while thread.isAlive():
+				# Poll rather than catching the TimeoutError of result(), since
+				# Python 3.11 that is also the socket.timeout which
+				# get_blocking() may raise.
+				while not concurrent.futures.wait([future], timeout=0.2).done:
 					self.progress_bump(bump)
-					thread.join(0.2)
 					bump += 0.1
-				if thread.exception is not None:
-					raise thread.exception
-				return thread.result
+				return future.result()
+			except GeocoderCancelled:
+				raise
 			except GeocoderError as e:
 				self.debug("  %s" % str(e))
 				self.conn = None		# close connexion
@@ -106,12 +110,22 @@ class GeocoderBase(object):
 				if e.retryable and retry <= self.retry_limit:
 					countdown = self.retry_delay
 					while countdown > 0:
-						time.sleep(1)
-						self.progress(None, None, "%s failed, retry %d in %d seconds." % (self.name, retry, countdown))
+						self.wait(1)
+						if in_main_thread:
+							self.progress(None, None, "%s failed, retry %d in %d seconds." % (self.name, retry, countdown))
 						countdown -= 1
 				else:
 					raise e
 
+	# Sleep, but wake up and raise GeocoderCancelled if GeocoderMulti
+	# no longer wants the answer.
+	def wait(self, seconds):
+		cancel_event = self.cancel_event
+		if cancel_event is None:
+			time.sleep(seconds)
+		elif cancel_event.wait(seconds):
+			raise GeocoderCancelled("%s: cancelled" % self.name, retryable=False)
+
 	# This is the function which actually sends the HTTP query.
 	def get_blocking(self, path, query=None, method="GET", content_type=None):
 		try:
@@ -123,11 +137,14 @@ class GeocoderBase(object):
 					message_body = query
 			self.debug("  %s %s" % (method, path))
 
-			remaining_delay = self.last_request_time + self.delay - time.time()
-			self.debug("    remaining_delay: %f" % remaining_delay)
-			if remaining_delay > 0:
-				time.sleep(remaining_delay)
-			self.last_request_time = time.time()
+			with self.rate_lock:
+				remaining_delay = self.last_request_time + self.delay - time.time()
+				self.debug("    remaining_delay: %f" % remaining_delay)
+				if remaining_delay > 0:
+					self.wait(remaining_delay)
+				elif self.cancel_event is not None and self.cancel_event.is_set():
+					raise GeocoderCancelled("%s: cancelled" % self.name, retryable=False)
+				self.last_request_time = time.time()
 
 			for attempt in (1, 2):
 				if self.conn is None:
@@ -182,6 +199,9 @@ class GeocoderBase(object):
 			print("Lookup of %s failed." % self.url_server)
 			raise NoInet
 
+		except socket.timeout:
+			raise GeocoderError("Timed out waiting for %s" % self.url_server)
+
 		except socket.error as e:	# likely errno 104, connection reset by peer
 			if e.errno == errno.ECONNRESET:
 				raise GeocoderError("ECONNRESET")
@@ -222,6 +242,11 @@ class GeocoderBase(object):
 	def FindAddr(self, address, countrycode=None):
 		raise GeocoderUnimplemented
 
+	# Geocode a list of addresses, returning a list of results in the
+	# same order. Override if the geocoder can do better than one at a time.
+	def FindAddrBatch(self, addresses, countrycode=None):
+		return [self.FindAddr(address, countrycode=countrycode) for address in addresses]
+
 	def FindStreet(self, street, city, state, countrycode=None):
 		raise GeocoderUnimplemented
 
@@ -264,3 +289,7 @@ class GeocoderError(Exception):
 class GeocoderUnimplemented(GeocoderError):
 	pass
 
+# Raised in a geocoder which GeocoderMulti has stopped waiting for
+class GeocoderCancelled(GeocoderError):
+	pass
+
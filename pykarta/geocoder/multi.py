@@ -1,11 +1,16 @@
 #! /usr/bin/python
 # pykarta/geocoder/multi.py
 # Copyright 2013--2019, Trinity College Computing Center
-# Last modified: 4 May 2019
+# Last modified: 17 October 2026
 
 import os
-from pykarta.misc import file_age_in_days, get_cachedir
-from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError
+import time
+import atexit
+import sqlite3
+import threading
+import concurrent.futures
+from pykarta.misc import get_cachedir
+from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError, GeocoderCancelled
 
 # Import the geocoders
 from .spreadsheet import GeocoderSpreadsheet
@@ -16,15 +21,37 @@ from .bing import GeocoderBing
 from .massgis import GeocoderMassGIS
 from .uscensus import GeocoderUsCensus
 
+# Threads in which GeocoderMulti runs the geocoders when concurrent.
+# This is separate from the one in geocoder_base.py so that they
+# do not end up waiting for each other.
+executor = None
+executor_lock = threading.Lock()
+def get_executor():
+	global executor
+	with executor_lock:
+		if executor is None:
+			executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="geocoder-multi")
+		return executor
+
 #=============================================================================
 # This geocoder is a wrapper for a list of actual geocoders. It calls them
 # in sequence until one of them finds the requested information.
 # It also caches the result.
+#
+# If concurrent is True, it instead starts all of them at once and
+# considers their answers in the same order as it would have called them.
+# As soon as the answer is decided, those which are still waiting for
+# their turn or for their servers are cancelled. A geocoder's answer
+# therefore takes about as long as the slowest geocoder it needed.
 #=============================================================================
 class GeocoderMulti(GeocoderBase):
+	concurrent = False
 
-	def __init__(self, **kwargs):
+	def __init__(self, concurrent=None, **kwargs):
 		GeocoderBase.__init__(self, **kwargs)
+		if concurrent is not None:
+			self.concurrent = concurrent
+		self.busy = {}			# geocoder -> lock held while it is in use
 		self.cache = GeocoderCache(**kwargs)
 		self.geocoders = [
 			(GeocoderSpreadsheet(**kwargs), True),
@@ -54,25 +81,25 @@ class GeocoderMulti(GeocoderBase):
 		result = GeocoderResult(address, "None")
 		should_cache = False
 
-		# Run each geocoder in turn until we find a good-quality match.
+		if self.concurrent:
+			answers = self.find_addr_concurrent(address, countrycode)
+		else:
+			answers = self.find_addr_sequential(address, countrycode)
+
+		# Take the answer of each geocoder in turn until we find a good-quality match.
 		# If all we can get is an interpolated match, take the first one.
 		best = None
-		i = 0
-		for geocoder, stop_on_interpolated in self.geocoders:
-			self.debug("Trying: %s..." % geocoder.name)
-			self.progress(i, len(self.geocoders), _("Trying %s...") % geocoder.name)
-			try:
-				iresult = geocoder.FindAddr(address, countrycode=countrycode)
-			except GeocoderError as e:
-				raise GeocoderError("%s: %s" % (geocoder.name, str(e)))
-			self.debug("")
-			if iresult.coordinates is not None:
-				best = (geocoder, iresult)
-				if stop_on_interpolated or iresult.precision != "INTERPOLATED":
-					break		# good enough
-			else:
-				result.alternative_addresses.extend(["%s: %s" % (geocoder.name, address) for address in iresult.alternative_addresses])
-			i += 1
+		try:
+			for geocoder, stop_on_interpolated in self.geocoders:
+				iresult = next(answers)
+				if iresult.coordinates is not None:
+					best = (geocoder, iresult)
+					if stop_on_interpolated or iresult.precision != "INTERPOLATED":
+						break		# good enough
+				else:
+					result.alternative_addresses.extend(["%s: %s" % (geocoder.name, address) for address in iresult.alternative_addresses])
+		finally:
+			answers.close()
 
 		if best is not None:
 			geocoder, iresult = best
@@ -87,11 +114,83 @@ class GeocoderMulti(GeocoderBase):
 
 		# Store the result.
 		if should_cache:
-			self.cache.store(result)
+			self.cache.store(result, countrycode=countrycode)
 
 		self.debug("")	# blank line
 		return result
 
+	# Geocode a list of addresses. Those in the cache are found with
+	# one lookup. The rest are passed to FindAddr().
+	def FindAddrBatch(self, addresses, countrycode=None):
+		results = self.cache.FindAddrBatch(addresses, countrycode=countrycode)
+		misses = [i for i, result in enumerate(results) if result.coordinates is None]
+		self.debug("%d of %d addresses found in cache" % (len(addresses) - len(misses), len(addresses)))
+		for count, i in enumerate(misses):
+			self.progress(count, len(misses), _("Geocoding address %d of %d...") % (count + 1, len(misses)))
+			results[i] = self.FindAddr(addresses[i], countrycode=countrycode, bypass_cache=True)
+		self.cache.flush()
+		return results
+
+	# Yield the answer of each geocoder, calling it only when the
+	# previous answer turns out not to be good enough.
+	def find_addr_sequential(self, address, countrycode):
+		i = 0
+		for geocoder, stop_on_interpolated in self.geocoders:
+			self.debug("Trying: %s..." % geocoder.name)
+			self.progress(i, len(self.geocoders), _("Trying %s...") % geocoder.name)
+			try:
+				iresult = geocoder.FindAddr(address, countrycode=countrycode)
+			except GeocoderError as e:
+				raise GeocoderError("%s: %s" % (geocoder.name, str(e)))
+			self.debug("")
+			yield iresult
+			i += 1
+
+	# Yield the answer of each geocoder in the same order, but having
+	# started them all at once. When the caller stops asking (closing the
+	# generator), those not yet finished are cancelled. The geocoders
+	# themselves see to it that they do not send requests to their servers
+	# more often than their delays allow.
+	def find_addr_concurrent(self, address, countrycode):
+		cancel_event = threading.Event()
+		def find(geocoder):
+			# A geocoder cancelled during the previous address may still
+			# be waiting for its server.
+			with self.busy[geocoder]:
+				if cancel_event.is_set():
+					raise GeocoderCancelled("%s: cancelled" % geocoder.name, retryable=False)
+				geocoder.cancel_event = cancel_event
+				try:
+					return geocoder.FindAddr(address, countrycode=countrycode)
+				finally:
+					geocoder.cancel_event = None
+
+		for geocoder, stop_on_interpolated in self.geocoders:
+			if not geocoder in self.busy:
+				self.busy[geocoder] = threading.Lock()
+
+		self.debug("Trying: %s" % ", ".join([geocoder.name for geocoder, stop_on_interpolated in self.geocoders]))
+		futures = [get_executor().submit(find, geocoder) for geocoder, stop_on_interpolated in self.geocoders]
+		try:
+			i = 0
+			bump = 0.0
+			for (geocoder, stop_on_interpolated), future in zip(self.geocoders, futures):
+				self.progress(i, len(self.geocoders), _("Waiting for %s...") % geocoder.name)
+				# See GeocoderBase.get() for why we do not use result(timeout=...)
+				while not concurrent.futures.wait([future], timeout=0.2).done:
+					self.progress_bump(bump)
+					bump += 0.1
+				try:
+					iresult = future.result()
+				except GeocoderError as e:
+					raise GeocoderError("%s: %s" % (geocoder.name, str(e)))
+				yield iresult
+				i += 1
+		finally:
+			cancel_event.set()
+			for future in futures:
+				future.cancel()
+
 	# Like FindAddr() but rather than returning the best result,
 	# it returns all of the results.
 	def FindAddrAll(self, address, countrycode=None):
@@ -106,54 +205,103 @@ class GeocoderMulti(GeocoderBase):
 
 #=============================================================================
 # This geocoder is used to return results from the cache.
+#
+# The results are kept in an SQLite database keyed by the normalized
+# address and the country code. New results are written in batches, so
+# call flush() (or close()) when done. Results older than max_age_days
+# are deleted when the cache is opened.
 #=============================================================================
 class GeocoderCache(GeocoderBase):
+	max_age_days = 30
+	flush_count = 100		# write after this many new results
+	flush_seconds = 10.0	# or after this many seconds
 
 	def __init__(self, **kwargs):
 		GeocoderBase.__init__(self, **kwargs)
 
-		self.cachedir = os.path.join(get_cachedir(), "geocoder")
-		if not os.path.exists(self.cachedir):
-			os.makedirs(self.cachedir)	
+		cachedir = get_cachedir()
+		if not os.path.exists(cachedir):
+			os.makedirs(cachedir)
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(os.path.join(cachedir, "geocoder.sqlite"), check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS results (
+			address text, countrycode text, lat real, lon real, precision text, source text, timestamp real,
+			PRIMARY KEY (address, countrycode)
+			)""")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp)")
+		with self.conn:
+			self.conn.execute("DELETE FROM results WHERE timestamp < ?", (time.time() - self.max_age_days * 86400,))
+		self.pending = {}		# results not yet written, by key
+		self.pending_since = None
+		atexit.register(self.flush)
 
-	def cachefile_name(self, address):
+	# Key for an address and country code
+	def key(self, address, countrycode):
 		formated_address = "%s %s, %s, %s %s" \
 			% (address[self.f_house_number], address[self.f_street],
 			  address[self.f_city], address[self.f_state], address[self.f_postal_code]
 			)
-		return "%s/%s" % (self.cachedir, formated_address.replace("/", "_"))
-
-	def FindAddr(self, address, countrycode=None):	# FIXME: countrycode is ignored
-		result = GeocoderResult(address, "Cache")
-
-		cachefile_name = self.cachefile_name(address)
-		cachefile_age = file_age_in_days(cachefile_name)
-		if cachefile_age and cachefile_age < 30:
-			fh = open(cachefile_name, "r")
-			cached_answer = fh.read()
-			fh.close()
-			self.debug("  Using %.1f day old answer from cache." % cachefile_age)
-			try:
-				lines = cached_answer.splitlines()
-				if len(lines) != 1:
-					raise AssertionError
-				lat, lon, result.precision, result.source = lines[0].split(",")
-				result.coordinates = (float(lat), float(lon))
-			except:
-				self.debug("  Bad cache entry")
+		return (" ".join(formated_address.lower().split()), countrycode or "")
+
+	def FindAddr(self, address, countrycode=None):
+		return self.FindAddrBatch([address], countrycode=countrycode)[0]
+
+	# Look up a whole list of addresses. The addresses not found come
+	# back as results without coordinates.
+	def FindAddrBatch(self, addresses, countrycode=None):
+		keys = [self.key(address, countrycode) for address in addresses]
+		cutoff = time.time() - self.max_age_days * 86400
+		found = {}
+		with self.lock:
+			found.update(self.pending)
+			unique_keys = list(set(keys) - set(found.keys()))
+			for start in range(0, len(unique_keys), 500):
+				chunk = unique_keys[start:start+500]
+				cursor = self.conn.execute("SELECT address, countrycode, lat, lon, precision, source, timestamp FROM results WHERE countrycode=? AND timestamp >= ? AND address IN (%s)" % ",".join(["?"] * len(chunk)),
+					[countrycode or "", cutoff] + [key[0] for key in chunk])
+				for row in cursor:
+					found[(row[0], row[1])] = row[2:]
+
+		results = []
+		for address, key in zip(addresses, keys):
+			result = GeocoderResult(address, "Cache")
+			row = found.get(key)
+			if row is not None:
+				lat, lon, result.precision, result.source, timestamp = row
+				result.coordinates = (lat, lon)
+				self.debug("  Using %.1f day old answer from cache." % ((time.time() - timestamp) / 86400.0))
+			else:
+				self.debug("  No match")
+			results.append(result)
+		return results
 
+	def store(self, result, countrycode=None):
 		if result.coordinates is None:
-			self.debug("  No match")
-		return result
+			return
+		self.debug("Storing new result in cache.")
+		with self.lock:
+			self.pending[self.key(result.query_address, countrycode)] = (result.coordinates[0], result.coordinates[1], result.precision, result.source, time.time())
+			if self.pending_since is None:
+				self.pending_since = time.time()
+			due = len(self.pending) >= self.flush_count or time.time() - self.pending_since >= self.flush_seconds
+		if due:
+			self.flush()
 
-	def store(self, result):
-		cachefile = open(self.cachefile_name(result.query_address), "w")
-		if result:	
-			self.debug("Storing new result in cache.")
-			cachefile.write("%s,%s,%s,%s\n" % (repr(result.coordinates[0]), repr(result.coordinates[1]), result.precision, result.source))
-		else:
-			self.debug("Storing empty result in cache.")
-		cachefile.close()
+	# Write the new results to the database
+	def flush(self):
+		with self.lock:
+			if len(self.pending) > 0:
+				with self.conn:
+					self.conn.executemany("INSERT OR REPLACE INTO results (address, countrycode, lat, lon, precision, source, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+						[key + row for key, row in self.pending.items()])
+				self.pending = {}
+			self.pending_since = None
+
+	def close(self):
+		self.flush()
+		atexit.unregister(self.flush)
+		self.conn.close()
 
 #=============================================================================
 # Test
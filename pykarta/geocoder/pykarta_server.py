@@ -1,6 +1,6 @@
 # pykarta/geocoder/pykarta_server.py
 # Copyright 2013--2018, Trinity College Computing Center
-# Last modified: 15 May 2018
+# Last modified: 17 October 2026
 
 
 import json
@@ -10,7 +10,7 @@ except ImportError:
 	from urllib.parse import quote_plus
 
 import pykarta
-from .geocoder_base import GeocoderBase, GeocoderResult
+from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError
 from pykarta.misc.http import simple_url_split
 
 class GeocoderPykartaBase(GeocoderBase):
@@ -23,30 +23,51 @@ class GeocoderPykartaBase(GeocoderBase):
 		url = "%s/geocoders/%s" % (pykarta.server_url, self.geocoder_basename)
 		self.url_method, self.url_server, self.url_path = simple_url_split(url)
 
+	batch_size = 1000		# addresses per POST in FindAddrBatch()
+
 	# Given a street address, try to find the latitude and longitude.
 	def FindAddr(self, address, countrycode=None):
-		result = GeocoderResult(address, self.geocoder_source_name)
-
-		query = json.dumps([
+		query = json.dumps(self.address_list(address))
+		response_text = self.get("%s?%s" % (self.url_path, quote_plus(query)))
+		feature = json.loads(response_text.decode("UTF-8"))
+		self.debug_indented(json.dumps(feature, indent=4, separators=(',', ': ')))
+		return self.feature_to_result(address, feature)
+
+	# Find a list of addresses, sending them to the server in batches
+	# of batch_size. The server answers with one line per address.
+	def FindAddrBatch(self, addresses, countrycode=None):
+		results = []
+		for start in range(0, len(addresses), self.batch_size):
+			self.progress(start, len(addresses), "Geocoding addresses %d through %d..." % (start + 1, min(start + self.batch_size, len(addresses))))
+			batch = addresses[start:start+self.batch_size]
+			query = json.dumps([self.address_list(address) for address in batch]).encode("UTF-8")
+			response_text = self.get(self.url_path, query=query, method="POST", content_type="application/json")
+			lines = response_text.decode("UTF-8").splitlines()
+			if len(lines) != len(batch):
+				raise GeocoderError("Server returned %d answers for %d addresses" % (len(lines), len(batch)))
+			for address, line in zip(batch, lines):
+				results.append(self.feature_to_result(address, json.loads(line)))
+		return results
+
+	# The address in the order which the server expects
+	def address_list(self, address):
+		return [
 			address[self.f_house_number],
 			address[self.f_apartment],
 			address[self.f_street],
 			address[self.f_city],
 			address[self.f_state],
 			address[self.f_postal_code]
-			])
-
-		response_text = self.get("%s?%s" % (self.url_path, quote_plus(query)))
-		feature = json.loads(response_text.decode("UTF-8"))
-		self.debug_indented(json.dumps(feature, indent=4, separators=(',', ': ')))
+			]
 
+	def feature_to_result(self, address, feature):
+		result = GeocoderResult(address, self.geocoder_source_name)
 		if feature is not None and feature['type'] == 'Feature':
 			geometry = feature['geometry']
 			assert geometry['type'] == 'Point'
 			coordinates = geometry['coordinates']
 			result.coordinates = (coordinates[1], coordinates[0])
 			result.precision = feature['properties']['precision']
-
 		if result.coordinates is None:
 			self.debug("  No match")
 		return result
@@ -1,8 +1,9 @@
 #! /usr/bin/python
 # pykarta/geocoder/spreadsheet.py
 # Copyright 2013--2018, Trinity College Computing Center
-# Last modified: 15 May 2018
+# Last modified: 17 October 2026
 
+import os
 import csv
 import re
 from fnmatch import fnmatch
@@ -12,59 +13,85 @@ from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError
 # This geocoder searches a single (hopefully small) spreadsheet which
 # contains local overrides. It can be used to fix the geocoding of
 # individual addresses until they can be inserted into OSM.
+#
+# The spreadsheet is loaded into a dict keyed by (state, city, street,
+# house number) the first time it is needed and loaded again whenever
+# the file changes.
 class GeocoderSpreadsheet(GeocoderBase):
+	filename = "geocoder_exceptions.csv"
+
+	def __init__(self, **kwargs):
+		GeocoderBase.__init__(self, **kwargs)
+		self.index = {}
+		self.index_mtime = None
 
 	def FindAddr(self, address, countrycode=None):	# FIXME: countrycode is ignored
 		result = GeocoderResult(address, "Spreadsheet")
 
-		filename = "geocoder_exceptions.csv"
-		try:
-			self.debug("  Opening %s..." % filename)
-			reader = csv.reader(open(filename, 'r'))
-		except IOError:
-			self.debug("  Spreadsheet not found")
+		if not self.load():
 			return result
 
-		for row in reader:
-			# row: 0=state, 1=city, 2=street, 3=house number, 4=apartment number, 5=lat, 6=lon, 7=precision
-			if address[4] == row[0] \
-					and address[self.f_state] == row[0] \
-					and address[self.f_city] == row[1] \
-					and address[self.f_street] == row[2] \
-					and address[self.f_house_number] == row[3] \
-					and ( address[self.f_apartment] == row[4] or fnmatch(address[self.f_apartment], row[4])):
+		entry = self.index.get((address[self.f_state], address[self.f_city], address[self.f_street], address[self.f_house_number]))
+		if entry is not None:
+			exact, wildcards = entry
+			apartment = address[self.f_apartment]
+			answer = exact.get(apartment)
+			if answer is None:
+				for pattern, wildcard_answer in wildcards:
+					if fnmatch(apartment, pattern):
+						answer = wildcard_answer
+						break
+			if answer is not None:
 				self.debug("  Match")
-
-				try:
-					# Parse latitude
-					m = re.search("^N(\d+)d([0-9\.]+)'$", row[5])
-					if m:
-						row[5] = repr(float(m.group(1)) + float(m.group(2)) / 60.0)
-					elif re.search("^[0-9\.-]+$", row[5]):
-						row[5] = float(row[5])
-					else:
-						raise Exception
-
-					# Parse longitude
-					m = re.search("^W(\d+)d([0-9\.]+)'$", row[6])
-					if m:
-						row[6] = repr(0 - float(m.group(1)) - float(m.group(2)) / 60.0)
-					elif re.search("^[0-9\.-]+$", row[6]):
-						row[6] = float(row[6])
-					else:
-						raise Exception
-
-					result.coordinates = (row[5], row[6])
-					result.precision = row[7]
-					break
-				except:
-					pass
+				result.coordinates, result.precision = answer
 
 		if result.coordinates is None:
 			self.debug("  No match")
 		return result
 
+	# Load the spreadsheet if it has not been loaded or has changed since.
+	# Returns False if there is no spreadsheet.
+	def load(self):
+		try:
+			mtime = os.path.getmtime(self.filename)
+		except OSError:
+			self.debug("  Spreadsheet not found")
+			self.index = {}
+			self.index_mtime = None
+			return False
+		if mtime == self.index_mtime:
+			return True
+
+		self.debug("  Loading %s..." % self.filename)
+		index = {}
+		with open(self.filename, 'r') as fh:
+			for row in csv.reader(fh):
+				# row: 0=state, 1=city, 2=street, 3=house number, 4=apartment number, 5=lat, 6=lon, 7=precision
+				try:
+					answer = ((self.parse_coordinate(row[5], "N"), self.parse_coordinate(row[6], "W")), row[7])
+				except (ValueError, IndexError):
+					continue
+				exact, wildcards = index.setdefault((row[0], row[1], row[2], row[3]), ({}, []))
+				# Apartment numbers with wildcards are tried only if none matches exactly.
+				if re.search(r'[*?\[]', row[4]):
+					wildcards.append((row[4], answer))
+				else:
+					exact.setdefault(row[4], answer)
+		self.index = index
+		self.index_mtime = mtime
+		return True
+
+	# Parse a latitude or longitude which is either in decimal degrees
+	# or in degrees and minutes such as N42d5.25' or W72d30.5'.
+	def parse_coordinate(self, text, hemisphere):
+		m = re.search(r"^%s(\d+)d([0-9\.]+)'$" % hemisphere, text)
+		if m:
+			value = float(m.group(1)) + float(m.group(2)) / 60.0
+			return value if hemisphere == "N" else 0 - value
+		if re.search(r"^[0-9\.-]+$", text):
+			return float(text)
+		raise ValueError(text)
+
 	def should_cache(self):
 		return False
 
-
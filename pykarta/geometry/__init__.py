@@ -1,12 +1,15 @@
 # encoding=utf-8
 # pykarta/geometry/__init__.py
 # Copyright 2013--2020, Trinity College
-# Last modified: 12 June 2020
+# Last modified: 18 October 2026
 
 
 import math
-from pykarta.geometry.distance import plane_lineseg_distance
+import numpy
+from pykarta.geometry.distance import plane_lineseg_distances
 from pykarta.geometry.projection import project_points_sinusoidal
+from pykarta.geometry.prepared import PreparedPolygon
+from pykarta.geometry.polylabel import polylabel as _polylabel
 
 #=============================================================================
 # Create an appropriate geometry object from a GeoJSON geometry
@@ -135,25 +138,101 @@ class Point(object):
 	def as_geojson(self):
 		return { "type":"Point","coordinates":(self.lon, self.lat) }
 
-# Convert an array of points (presumably expressed as (lat, lon)) to Point objects.
+#=============================================================================
+# Arrays of Geographic Points
+# A list-like container which stores its points as rows of an (N,2) NumPy
+# array of float64 (lat, lon) pairs rather than as individual Point objects.
+# Indexing returns Point objects, so code which treats it as a list of
+# Points continues to work, while bounding box, area, and centroid
+# computations can operate on the whole array at once.
+#=============================================================================
+
+class PointArray(object):
+	__slots__ = ['array']
+	def __init__(self, points=None):
+		if points is None:
+			self.array = numpy.empty((0, 2), dtype=numpy.float64)
+		elif isinstance(points, PointArray):
+			self.array = points.array.copy()
+		elif isinstance(points, numpy.ndarray):
+			self.array = numpy.array(points, dtype=numpy.float64).reshape(-1, 2)
+		else:						# Points or (lat, lon) pairs
+			self.array = numpy.array([(p[0], p[1]) for p in points], dtype=numpy.float64).reshape(-1, 2)
+
+	# Create from a list of GeoJSON positions, [[lon, lat], ...]
+	@staticmethod
+	def from_geojson(coordinates):
+		if len(coordinates) == 0:
+			return PointArray()
+		positions = numpy.array(coordinates, dtype=numpy.float64).reshape(len(coordinates), -1)
+		return PointArray(numpy.ascontiguousarray(positions[:,1::-1]))
+
+	def __len__(self):
+		return len(self.array)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return PointArray(self.array[index])
+		lat, lon = self.array[index].tolist()
+		return Point(lat, lon)
+
+	def __setitem__(self, index, point):
+		self.array[index] = (point[0], point[1])
+
+	def __iter__(self):
+		for lat, lon in self.array.tolist():
+			yield Point(lat, lon)
+
+	def __array__(self, dtype=None, copy=None):
+		return self.array if dtype is None else self.array.astype(dtype)
+
+	def __str__(self):
+		return "[%s]" % ", ".join(map(str, self))
+
+	def insert(self, index, point):
+		self.array = numpy.insert(self.array, index, (point[0], point[1]), axis=0)
+
+	def append(self, point):
+		self.insert(len(self.array), point)
+
+	def extend(self, points):
+		self.array = numpy.concatenate((self.array, PointArray(points).array))
+
+	def pop(self, index=-1):
+		point = self[index]
+		self.array = numpy.delete(self.array, index, axis=0)
+		return point
+
+	def get_bbox(self):
+		if len(self.array) == 0:
+			return BoundingBox()
+		min_lat, min_lon = self.array.min(axis=0).tolist()
+		max_lat, max_lon = self.array.max(axis=0).tolist()
+		return BoundingBox((min_lon, min_lat, max_lon, max_lat))
+
+	def as_geojson_positions(self):
+		return self.array[:,::-1].tolist()
+
+#=============================================================================
+# Collections of Geographic Points
+#=============================================================================
+
+# Convert an array of points (presumably expressed as (lat, lon)) to a PointArray.
 class MultiPoint(object):
 	def __init__(self, points=None, *, geometry=None):
 		if geometry is not None:
 			assert type(geometry) is dict
 			assert geometry["type"] == "MultiPoint"
-			self.points = [Point(p[1],p[0]) for p in geometry['coordinates']]
-		elif points is not None:
-			self.points = list(map(Point, points))
+			self.points = PointArray.from_geojson(geometry['coordinates'])
 		else:
-			self.points = []
+			self.points = PointArray(points)
 		self.bbox = None
 	def get_bbox(self):
 		if self.bbox is None:
-			self.bbox = BoundingBox()
-			self.bbox.add_points(self.points)
+			self.bbox = self.points.get_bbox()
 		return self.bbox
 	def as_geojson(self):
-		return { "type":"MultiPoint", "coordinates": [p.as_geojson_position() for p in self.points] }
+		return { "type":"MultiPoint", "coordinates": self.points.as_geojson_positions() }
 
 #=============================================================================
 # Strings of Geographic Points
@@ -164,12 +243,12 @@ class LineString(MultiPoint):
 		if geometry is not None:
 			assert type(geometry) is dict
 			assert geometry["type"] == "LineString"
-			points = [Point(p[1],p[0]) for p in geometry['coordinates']]
-			super().__init__(points)
+			self.points = PointArray.from_geojson(geometry['coordinates'])
+			self.bbox = None
 		else:
-			super().__init__(points, geometry=geometry)
+			super().__init__(points)
 	def as_geojson(self):
-		return { "type":"LineString", "coordinates": [p.as_geojson_position() for p in self.points] }
+		return { "type":"LineString", "coordinates": self.points.as_geojson_positions() }
 
 class MultiLineString(object):
 	def __init__(self, linestrings=None, *, geometry=None):
@@ -205,7 +284,8 @@ class MultiLineString(object):
 # All of the calculations assume a rectangular grid. In other words,
 # they ignore projection.
 #
-# For now calculations ignore holes. All we do is store them.
+# For now calculations ignore holes. All we do is store them. The exception
+# is contains_points() which uses a PreparedPolygon (see prepared.py).
 #=============================================================================
 
 class Polygon(MultiPoint):
@@ -216,17 +296,17 @@ class Polygon(MultiPoint):
 			assert geometry['type'] == 'Polygon', geometry['type']
 			rings = []
 			for sub_poly in geometry['coordinates']:
-				points = [Point(p[1], p[0]) for p in sub_poly]
-				assert len(points) >= 4, "not enough points for a polygon"
-				assert points[0] == points.pop(-1), "polygon is not closed"
-				rings.append(points)
+				ring = PointArray.from_geojson(sub_poly)
+				assert len(ring) >= 4, "not enough points for a polygon"
+				assert ring[0] == ring[-1], "polygon is not closed"
+				rings.append(ring[:-1])
 			self.points = rings[0]
 			self.holes = rings[1:]
 		elif points is not None:
-			self.points = list(map(Point, points))
-			self.holes = holes
+			self.points = PointArray(points)
+			self.holes = [PointArray(hole) for hole in holes]
 		else:
-			self.points = []
+			self.points = PointArray()
 			self.holes = []
 
 	def area(self, project=False):
@@ -238,113 +318,86 @@ class Polygon(MultiPoint):
 	#  http://local.wasp.uwa.edu.au/~pbourke/geometry/polyarea/
 	# See also:
 	#  http://www.seas.upenn.edu/~sys502/extra_materials/Polygon%20Area%20and%20Centroid.pdf
+	# Each vertex is paired with the one before it (the last with the first)
+	# by rolling the coordinate arrays.
 	def signed_area(self, project=False):
 		if project:		# project to meters first?
-			points = project_points_sinusoidal(self.points)
+			points = project_points_sinusoidal(self.points.array)
 		else:
-			points = self.points
-		area=0
-		j=len(points)-1		# last point
-		for i in range(len(points)):
-			p1=points[i]
-			p2=points[j]
-			area += (p1[0]*p2[1])
-			area -= p1[1]*p2[0]
-			j=i
-		area /= 2;
-		return area
+			points = self.points.array
+		x = points[:,0]
+		y = points[:,1]
+		return float(numpy.sum(x * numpy.roll(y, 1) - y * numpy.roll(x, 1))) / 2
 
 	def centroid(self):
 		"Compute the centroid of the polygon"
-		points = self.points
-		x=0
-		y=0
-		j=len(points)-1;	# last point
-		for i in range(len(points)):
-			p1=points[i]
-			p2=points[j]
-			f=p1[0]*p2[1]-p2[0]*p1[1]
-			x+=(p1[0]+p2[0])*f
-			y+=(p1[1]+p2[1])*f
-			j=i
-		f=self.signed_area()*6
+		points = self.points.array
+		x1 = points[:,0]
+		y1 = points[:,1]
+		x2 = numpy.roll(x1, 1)
+		y2 = numpy.roll(y1, 1)
+		f = x1 * y2 - x2 * y1
+		x = float(numpy.sum((x1 + x2) * f))
+		y = float(numpy.sum((y1 + y2) * f))
+		f = self.signed_area() * 6
 		if(f == 0):
-			return points[0]
+			return self.points[0]
 		else:
 			return Point(x/f, y/f)
 
 	# See:
 	# http://www.faqs.org/faqs/graphics/algorithms-faq/ (section 2.03)
 	# http://www.ecse.rpi.edu/Homepages/wrf/Research/Short_Notes/pnpoly.html
+	# The crossing test is applied to all of the edges at once.
 	def contains_point(self, testpt):
 		"Return True if the polygon contains the indicated point"
 		if not self.get_bbox().contains_point(testpt):
 			return False
 
-		inPoly = False
-		i = 0
-		j = len(self.points) - 1
-		while i < len(self.points):
-			verti = self.points[i]
-			vertj = self.points[j]
-			if ( ((verti.lat > testpt.lat) != (vertj.lat > testpt.lat)) \
-					and \
-					(testpt.lon < (vertj.lon - verti.lon) * (testpt.lat - verti.lat) / (vertj.lat - verti.lat) + verti.lon) ):
-				inPoly = not inPoly
-			j = i
-			i += 1
-
-		return inPoly
+		verti = self.points.array
+		vertj = numpy.roll(verti, 1, axis=0)
+		lat_i = verti[:,0]
+		lon_i = verti[:,1]
+		lat_j = vertj[:,0]
+		lon_j = vertj[:,1]
+		straddles = (lat_i > testpt.lat) != (lat_j > testpt.lat)
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			crossing_lon = (lon_j - lon_i) * (testpt.lat - lat_i) / (lat_j - lat_i) + lon_i
+		crossings = numpy.count_nonzero(straddles & (testpt.lon < crossing_lon))
+		return (crossings % 2) == 1
+
+	def prepare(self, grid=None):
+		"Return a PreparedPolygon for testing many points against this polygon"
+		return PreparedPolygon(self, grid=grid)
+
+	def contains_points(self, points):
+		"Return a boolean mask showing which of the points are within the polygon"
+		return self.prepare().contains_points(points)
 
 	def choose_label_center(self):
-		"Try 81 possible label positions and choose the one farthest from the polygon's border"
+		"Return the point inside the polygon which is farthest from its border (see polylabel.py)"
 		assert len(self.points) >= 3
-		bbox = self.get_bbox()
-		lat_step = (bbox.max_lat - bbox.min_lat) / 10.0
-		lon_step = (bbox.max_lon - bbox.min_lon) / 10.0
-		largest_distance = 0
-		largest_distance_point = None
-		for y in range(1,10):
-			lat = bbox.min_lat + lat_step * y
-			for x in range(1,10):
-				lon = bbox.min_lon + lon_step * x
-				point = Point(lat, lon)
-				if self.contains_point(point):
-					distance = self.distance_to(point, largest_distance)
-					if distance is not None and distance > largest_distance:
-						largest_distance = distance
-						largest_distance_point = point
-		if largest_distance_point is not None:
-			return largest_distance_point
-		else:	# for some unknown pathological case
-			# FIXME: See ../tests/polygon_labeling_test.py for a case in which
-			# the centroid is far from the polygon. For now we are going with
-			# the bounding box center.
-			#return self.centroid()
-			return self.get_bbox().center()
+		return _choose_label_center(self.get_bbox(), [self.points] + self.holes)
 
 	def distance_to(self, point, low_abort=None):
 		"Find the distance from <point> to the nearest segment of the polygon"
-		shortest = None
-		i = 0
-		while i < len(self.points):
-			p1 = self.points[i]
-			p2 = self.points[(i+1) % len(self.points)]
-			distance = plane_lineseg_distance(point, p1, p2)
-			if shortest is None or distance < shortest:
-				shortest = distance
-			if low_abort is not None and distance < low_abort:
-				return None
-			i += 1
+		if len(self.points) == 0:
+			return None
+		p1 = self.points.array
+		p2 = numpy.roll(p1, -1, axis=0)
+		distances = plane_lineseg_distances(point, p1, p2)
+		shortest = float(distances.min())
+		if low_abort is not None and shortest < low_abort:
+			return None
 		return shortest
 
 	def as_geojson(self):
 		"Return a representation of the polygon in GeoJSON format"
 		coordinates = []
-		for poly in [self.points] + self.holes:
-			points = self.points[:]
-			points.append(points[0])		# close polygon
-			coordinates.append([p.as_geojson_position() for p in points])
+		for ring in [self.points] + self.holes:
+			positions = ring.as_geojson_positions()
+			positions.append(positions[0])		# close polygon
+			coordinates.append(positions)
 		return { "type":"Polygon", "coordinates": coordinates }
 
 class MultiPolygon(object):
@@ -366,6 +419,21 @@ class MultiPolygon(object):
 				self.bbox.add_bbox(polygon.get_bbox())
 		return self.bbox
 
+	def prepare(self, grid=None):
+		"Return a PreparedPolygon for testing many points against these polygons"
+		return PreparedPolygon(self, grid=grid)
+
+	def contains_points(self, points):
+		"Return a boolean mask showing which of the points are within the polygons"
+		return self.prepare().contains_points(points)
+
+	def choose_label_center(self):
+		"Return the point inside the polygons which is farthest from their borders"
+		rings = []
+		for polygon in self.polygons:
+			rings.extend([polygon.points] + polygon.holes)
+		return _choose_label_center(self.get_bbox(), rings)
+
 	def centroid(self):
 		"Compute the centroid of the set of polygons"
 		# FIXME: This is a placeholder
@@ -377,6 +445,20 @@ class MultiPolygon(object):
 			coordinates.append(polygon.as_geojson()['coordinates'])
 		return { "type":"Polygon", "coordinates":coordinates }
 
+# Find the pole of inaccessibility of rings of (lat, lon) points to within
+# a thousandth of the size of the bounding box. Longitudes are first
+# shrunk in proportion to the length of a degree at this latitude so that
+# distances east and west count as much as those north and south.
+def _choose_label_center(bbox, rings):
+	center = bbox.center()
+	lon_scale = max(math.cos(math.radians(center.lat)), 0.01)
+	rings = [ring.array[:,::-1] * (lon_scale, 1.0) for ring in rings]
+	precision = max(bbox.max_lat - bbox.min_lat, (bbox.max_lon - bbox.min_lon) * lon_scale) / 1000.0
+	if precision == 0.0:
+		return center
+	(x, y), distance = _polylabel(rings, precision)
+	return Point(y, x / lon_scale)
+
 #=============================================================================
 # Bounding Boxes
 #=============================================================================
@@ -439,8 +521,12 @@ class BoundingBox(object):
 		self.max_lon = max(self.max_lon, point.lon)
 
 	def add_points(self, points):
-		for point in points:
-			self.add_point(point)
+		if isinstance(points, PointArray):
+			if len(points) > 0:
+				self.add_bbox(points.get_bbox())
+		else:
+			for point in points:
+				self.add_point(point)
 
 	def add_bbox(self, bbox):
 		if not isinstance(bbox, BoundingBox): raise TypeError
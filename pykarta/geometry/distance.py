@@ -1,8 +1,9 @@
 # encoding=utf-8
 # pykarta/geometry/distance.py
-# Last modified: 14 May 2018
+# Last modified: 17 October 2026
 
 import math
+import numpy
 
 #=============================================================================
 # Distance on a plane
@@ -37,6 +38,24 @@ def plane_lineseg_distance(pt, p1, p2):
 		closest = (p1[0] + t * dx, p1[1] + t * dy);
 		return plane_points_distance(closest, pt)
 
+def plane_lineseg_distances(pt, p1, p2):
+	"""Distances of a point to each of a set of line segments on a plane.
+	p1 and p2 are (N,2) arrays of segment start and end points."""
+	dx = p2[:,0] - p1[:,0]
+	dy = p2[:,1] - p1[:,1]
+	px = pt[0] - p1[:,0]
+	py = pt[1] - p1[:,1]
+
+	# How far along each segment is the closest point? Clamping to the
+	# range 0.0--1.0 covers the before start and after end cases.
+	# Zero-length segments are treated as points.
+	length_squared = dx * dx + dy * dy
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		t = numpy.where(length_squared > 0.0, (px * dx + py * dy) / length_squared, 0.0)
+	t = numpy.clip(t, 0.0, 1.0)
+
+	return numpy.hypot(px - t * dx, py - t * dy)
+
 #=============================================================================
 # Distance and Bearing on the Globe
 #=============================================================================
@@ -0,0 +1,137 @@
+# pykarta/geometry/polylabel.py
+# Copyright 2026, Trinity College
+# Last modified: 17 October 2026
+
+import math
+import numpy
+
+#=============================================================================
+# Pole of inaccessibility
+#
+# The point inside a polygon which is farthest from its outline is a good
+# place for its label. polylabel() finds it to within a chosen precision
+# using the method of Mapbox's polylabel (https://github.com/mapbox/polylabel).
+# The bounding box is covered with square cells. The greatest distance from the outline which any point in a cell could
+# have is the distance of its center plus half its diagonal. Cells which
+# could beat the best point found so far by more than the precision are
+# split in four, and so on until none are left. Rather than taking the
+# cells one at a time from a priority queue, as polylabel does, we split
+# all of the promising cells of each size together, since the distances
+# from a batch of points can be found in a few array operations.
+#
+# The rings are lists of (x, y) pairs or (N,2) NumPy arrays, closed or not.
+# Any of them may be holes or separate parts, since a point is taken to be
+# inside if it is inside an odd number of them. As elsewhere in this
+# package, the calculations assume a rectangular grid.
+#=============================================================================
+
+# Returns ((x, y), distance). The distance is negative if (as can happen
+# only with a degenerate polygon) no point inside was found.
+def polylabel(rings, precision=1.0):
+	edges = PolylabelEdges(rings)
+	min_x, min_y, max_x, max_y = edges.bbox
+	width = max_x - min_x
+	height = max_y - min_y
+	cell_size = min(width, height)
+	if cell_size == 0:
+		return ((min_x, min_y), 0.0)
+
+	# The first guesses are the centroid of the outer ring and the center of the bounding box
+	xs = numpy.array((edges.centroid[0], min_x + width / 2.0))
+	ys = numpy.array((edges.centroid[1], min_y + height / 2.0))
+
+	# Cover the bounding box with square cells
+	half_cell = cell_size / 2.0
+	grid_xs = numpy.arange(min_x, max_x, cell_size) + half_cell
+	grid_ys = numpy.arange(min_y, max_y, cell_size) + half_cell
+	xs = numpy.concatenate((xs, numpy.tile(grid_xs, len(grid_ys))))
+	ys = numpy.concatenate((ys, numpy.repeat(grid_ys, len(grid_xs))))
+	halves = numpy.full(len(xs), half_cell)
+	halves[:2] = 0.0
+
+	best = None
+	best_distance = None
+	sqrt2 = math.sqrt(2.0)
+	while True:
+		distances = edges.signed_distances(xs, ys)
+		i = int(numpy.argmax(distances))
+		if best is None or distances[i] > best_distance:
+			best = (float(xs[i]), float(ys[i]))
+			best_distance = float(distances[i])
+
+		# Split those cells in which there could be a point better by more than the precision
+		keep = (distances + halves * sqrt2 - best_distance) > precision
+		if not numpy.any(keep):
+			break
+		xs = xs[keep]
+		ys = ys[keep]
+		halves = halves[keep] / 2.0
+		xs = numpy.concatenate((xs - halves, xs + halves, xs - halves, xs + halves))
+		ys = numpy.concatenate((ys - halves, ys - halves, ys + halves, ys + halves))
+		halves = numpy.concatenate((halves, halves, halves, halves))
+
+	return (best, best_distance)
+
+# The edges of all of the rings in flat arrays so that the distance from
+# a batch of points to all of them can be found in a few array operations
+class PolylabelEdges(object):
+	def __init__(self, rings):
+		starts = []
+		ends = []
+		for ring in rings:
+			ring = numpy.asarray(ring, dtype=numpy.float64).reshape(-1, 2)
+			if len(ring) < 2:
+				continue
+			if ring[0,0] == ring[-1,0] and ring[0,1] == ring[-1,1]:		# closed
+				starts.append(ring[:-1])
+				ends.append(ring[1:])
+			else:
+				starts.append(ring)
+				ends.append(numpy.concatenate((ring[1:], ring[:1])))
+		if len(starts) == 0:
+			raise ValueError("no rings")
+		start = numpy.concatenate(starts) if len(starts) > 1 else starts[0]
+		end = numpy.concatenate(ends) if len(ends) > 1 else ends[0]
+		self.x1 = start[:,0]
+		self.y1 = start[:,1]
+		self.dx = end[:,0] - self.x1
+		self.dy = end[:,1] - self.y1
+		length2 = self.dx * self.dx + self.dy * self.dy
+		self.length2 = numpy.where(length2 == 0.0, 1.0, length2)	# repeated points
+		self.y2 = end[:,1]
+		self.dy_nonzero = numpy.where(self.dy == 0.0, 1.0, self.dy)	# horizontal edges never straddle
+		self.bbox = tuple(start.min(axis=0).tolist() + start.max(axis=0).tolist())
+
+		# Centroid of the first ring
+		count = len(starts[0])
+		x1 = self.x1[:count]
+		y1 = self.y1[:count]
+		x2 = x1 + self.dx[:count]
+		y2 = y1 + self.dy[:count]
+		f = x1 * y2 - x2 * y1
+		area = float(f.sum()) * 3.0
+		if area == 0.0:
+			self.centroid = (float(x1[0]), float(y1[0]))
+		else:
+			self.centroid = (float(((x1 + x2) * f).sum()) / area, float(((y1 + y2) * f).sum()) / area)
+
+	# Distance from each point to the nearest edge, negative if outside
+	def signed_distances(self, xs, ys):
+		px = numpy.asarray(xs, dtype=numpy.float64)[:,numpy.newaxis]
+		py = numpy.asarray(ys, dtype=numpy.float64)[:,numpy.newaxis]
+		x1 = self.x1
+		y1 = self.y1
+		dx = self.dx
+		dy = self.dy
+
+		# Nearest point on each edge
+		t = numpy.minimum(numpy.maximum(((px - x1) * dx + (py - y1) * dy) / self.length2, 0.0), 1.0)
+		nx = x1 + t * dx - px
+		ny = y1 + t * dy - py
+		distances = numpy.sqrt((nx * nx + ny * ny).min(axis=1))
+
+		# Crossing test (as in Polygon.contains_point()) with the even-odd rule
+		straddles = (y1 > py) != (self.y2 > py)
+		crossing_x = dx * (py - y1) / self.dy_nonzero + x1
+		inside = (numpy.count_nonzero(straddles & (px < crossing_x), axis=1) % 2) == 1
+		return numpy.where(inside, distances, -distances)
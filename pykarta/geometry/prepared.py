@@ -0,0 +1,142 @@
+# pykarta/geometry/prepared.py
+# Copyright 2026, Trinity College
+# Last modified: 17 October 2026
+
+import numpy
+
+#=============================================================================
+# Prepared Polygons
+#
+# A PreparedPolygon is made from a Polygon or a MultiPolygon. It copies the
+# edges of all of the rings (including holes) into flat arrays once so that
+# large batches of points can be tested using whole-array operations. The
+# test is the pnpoly crossing test used by Polygon.contains_point(), but
+# applied with the even-odd rule to every ring, so a point in a hole is
+# outside the polygon.
+#
+# If the polygon has many edges, the edges are also sorted into horizontal
+# bands (the edge-bucket grid). A point then need only be tested against
+# the edges which pass through its band.
+#
+# As elsewhere in this package, the calculations assume a rectangular grid.
+#=============================================================================
+
+class PreparedPolygon(object):
+	grid_threshold = 64				# use bands if there are more edges than this
+	chunk_size = 1 << 20			# maximum points times edges per array operation
+
+	def __init__(self, geometry, grid=None):
+		if hasattr(geometry, "polygons"):		# MultiPolygon
+			polygons = geometry.polygons
+		else:
+			polygons = [geometry]
+		rings = []
+		for polygon in polygons:
+			rings.append(points_array(polygon.points))
+			for hole in polygon.holes:
+				rings.append(points_array(hole))
+
+		# Each edge runs from a vertex to the one before it.
+		p1 = numpy.concatenate(rings) if len(rings) > 0 else numpy.zeros((0, 2))
+		p2 = numpy.concatenate([numpy.roll(ring, 1, axis=0) for ring in rings]) if len(rings) > 0 else p1
+
+		# Horizontal edges can never be crossed, so drop them.
+		keep = p1[:,0] != p2[:,0]
+		self.lat1 = p1[keep,0]
+		self.lon1 = p1[keep,1]
+		self.lat2 = p2[keep,0]
+		self.lon2 = p2[keep,1]
+		self.slope = (self.lon2 - self.lon1) / (self.lat2 - self.lat1)
+
+		# An empty polygon contains nothing. contains_points() sees that
+		# there are no edges before it looks at the bounding box.
+		self.bands = None
+		if len(p1) == 0:
+			self.min_lat = self.min_lon = self.max_lat = self.max_lon = None
+			return
+
+		self.min_lat, self.min_lon = p1.min(axis=0).tolist()
+		self.max_lat, self.max_lon = p1.max(axis=0).tolist()
+
+		# Sort the edges into bands of latitude.
+		if grid is None:
+			grid = int(numpy.sqrt(len(self.lat1))) if len(self.lat1) > self.grid_threshold else 0
+		if grid > 0:
+			self.band_count = grid
+			self.band_height = (self.max_lat - self.min_lat) / grid
+			if self.band_height > 0.0:
+				edge_start = self.band_of(numpy.minimum(self.lat1, self.lat2))
+				edge_stop = self.band_of(numpy.maximum(self.lat1, self.lat2))
+				spans = edge_stop - edge_start + 1
+				edge_index = numpy.repeat(numpy.arange(len(spans)), spans)
+				offsets = numpy.arange(len(edge_index)) - numpy.repeat(numpy.cumsum(spans) - spans, spans)
+				edge_band = edge_start[edge_index] + offsets
+				order = numpy.argsort(edge_band, kind="stable")
+				self.band_edges = edge_index[order]
+				self.band_bounds = numpy.searchsorted(edge_band[order], numpy.arange(grid + 1))
+				self.bands = grid
+
+	def band_of(self, lat):
+		band = ((lat - self.min_lat) / self.band_height).astype(numpy.intp)
+		return numpy.clip(band, 0, self.band_count - 1)
+
+	def contains_point(self, point):
+		"Return True if the polygon contains the indicated point"
+		return bool(self.contains_points(numpy.array([(point[0], point[1])]))[0])
+
+	def contains_points(self, points):
+		"""Test a batch of points (Points, (lat, lon) pairs, a PointArray,
+		or an (N,2) array). Returns a NumPy boolean mask."""
+		points = points_array(points)
+		mask = numpy.zeros(len(points), dtype=bool)
+		if len(points) == 0 or len(self.lat1) == 0:
+			return mask
+
+		# Only points within the bounding box need further testing.
+		lat = points[:,0]
+		lon = points[:,1]
+		candidates = numpy.nonzero(
+			(lat >= self.min_lat) & (lat <= self.max_lat) & (lon >= self.min_lon) & (lon <= self.max_lon)
+			)[0]
+
+		if self.bands is None:
+			mask[candidates] = self._crossings_odd(lat[candidates], lon[candidates], slice(None))
+		else:
+			point_band = self.band_of(lat[candidates])
+			order = numpy.argsort(point_band, kind="stable")
+			candidates = candidates[order]
+			point_bounds = numpy.searchsorted(point_band[order], numpy.arange(self.bands + 1))
+			for band in numpy.nonzero(numpy.diff(point_bounds))[0].tolist():
+				in_band = candidates[point_bounds[band]:point_bounds[band+1]]
+				edges = self.band_edges[self.band_bounds[band]:self.band_bounds[band+1]]
+				mask[in_band] = self._crossings_odd(lat[in_band], lon[in_band], edges)
+
+		return mask
+
+	# Count the edges crossed by a ray extending east from each point.
+	# Points are taken in chunks so as to limit the size of the
+	# intermediate points-by-edges arrays.
+	def _crossings_odd(self, lat, lon, edges):
+		lat1 = self.lat1[edges]
+		lat2 = self.lat2[edges]
+		lon1 = self.lon1[edges]
+		slope = self.slope[edges]
+		result = numpy.zeros(len(lat), dtype=bool)
+		step = max(1, self.chunk_size // max(1, len(lat1)))
+		for start in range(0, len(lat), step):
+			y = lat[start:start+step,None]
+			x = lon[start:start+step,None]
+			straddles = (lat1 > y) != (lat2 > y)
+			crosses = straddles & (x < lon1 + (y - lat1) * slope)
+			result[start:start+step] = (numpy.count_nonzero(crosses, axis=1) % 2) == 1
+		return result
+
+# Convert any of the supported representations of a list of points
+# to an (N,2) array of (lat, lon).
+def points_array(points):
+	if isinstance(points, numpy.ndarray):
+		return numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+	if hasattr(points, "array"):		# PointArray
+		return points.array
+	return numpy.array([(p[0], p[1]) for p in points], dtype=numpy.float64).reshape(-1, 2)
+
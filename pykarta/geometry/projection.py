@@ -1,7 +1,10 @@
 # pykarta/geometry/projection.py
-# Last modified: 3 February 2015
+# Last modified: 17 October 2026
 
 from math import radians, degrees, exp, log, tan, cos, sinh, atan, pi
+from functools import lru_cache
+import itertools
+import numpy
 
 #=============================================================================
 # Web Mercator tiles
@@ -31,6 +34,181 @@ def project_to_tilespace_pixel(lat, lon, zoom, xtile, ytile):
 	xtile2, ytile2 = project_to_tilespace(lat, lon, zoom)
 	return ((xtile2 - xtile) * 256.0, (ytile2 - ytile) * 256.0)
 
+# Return the bounding box of a tile, optionally enlarged by pad tiles
+# on each side, in the Openlayers order (min_lon, min_lat, max_lon, max_lat).
+def tile_bbox(zoom, xtile, ytile, pad=0.0):
+	nw_lat, nw_lon = unproject_from_tilespace(xtile - pad, ytile - pad, zoom)
+	se_lat, se_lon = unproject_from_tilespace(xtile + 1.0 + pad, ytile + 1.0 + pad, zoom)
+	return (nw_lon, se_lat, se_lon, nw_lat)
+
+#=============================================================================
+# Batch versions of the above
+#
+# These take an (N,2) NumPy array of (lat, lon) (or anything which
+# numpy.asarray() will convert to one, such as a list of Points or a
+# PointArray) and return an (N,2) array. Each does the whole batch with
+# a few array operations, so they should be used wherever more than a
+# handful of points are to be projected.
+#=============================================================================
+
+# Tiles across the world at a zoom level and its reciprocal
+@lru_cache(maxsize=64)
+def _tile_count(zoom):
+	n = 2.0 ** zoom
+	return (n, 1.0 / n)
+
+def project_points_tilespace(points, zoom):
+	points = _latlon_array(points)
+	n = _tile_count(zoom)[0]
+	lat_rad = numpy.radians(points[:,0])
+	xtile = (points[:,1] + 180.0) / 360.0 * n
+	ytile = (1.0 - numpy.log(numpy.tan(lat_rad) + (1 / numpy.cos(lat_rad))) / pi) / 2.0 * n
+	return numpy.column_stack((xtile, ytile))
+
+# Takes an (N,2) array of (xtile, ytile), returns (lat, lon)
+def unproject_points_tilespace(points, zoom):
+	points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+	n, n_recip = _tile_count(zoom)
+	lon = points[:,0] * n_recip * 360.0 - 180.0
+	lat = numpy.degrees(numpy.arctan(numpy.sinh(pi * (1 - 2 * points[:,1] * n_recip))))
+	return numpy.column_stack((lat, lon))
+
+def project_points_tilespace_pixels(points, zoom, xtile, ytile):
+	result = project_points_tilespace(points, zoom)
+	result -= (xtile, ytile)
+	result *= 256.0
+	return result
+
+# Takes GeoJSON coordinates (lists of [lon, lat]) and returns a list
+# of (x, y) pixel positions within the coordinate space of a tile.
+def project_geojson_tilespace_pixels(coordinates, zoom, xtile, ytile):
+	return project_geojson_lines_tilespace_pixels([coordinates], zoom, xtile, ytile)[0]
+
+# The same for a list of lines, all of which are projected in one batch.
+# This is much faster than projecting them one by one when there are
+# many short lines, as there are in a vector tile.
+def project_geojson_lines_tilespace_pixels(lines, zoom, xtile, ytile):
+	lengths = [len(line) for line in lines]
+	if sum(lengths) == 0:
+		return [[] for line in lines]
+	lonlat = numpy.array(list(itertools.chain.from_iterable(lines)), dtype=numpy.float64)
+	pixels = project_points_tilespace_pixels(lonlat[:,1::-1], zoom, xtile, ytile)
+	x = pixels[:,0].tolist()
+	y = pixels[:,1].tolist()
+	result = []
+	start = 0
+	for length in lengths:
+		stop = start + length
+		result.append(list(zip(x[start:stop], y[start:stop])))
+		start = stop
+	return result
+
+# Project a list of GeoJSON geometries (with coordinates in degrees) into the
+# coordinate space of a tile divided into units x units cells. Coordinates
+# are rounded to whole cells and points which round to the same cell as
+# the one before them are dropped. Lines and polygon rings which no longer
+# have enough points are dropped too. Returns a list of geometries with
+# integer coordinates (or None for those which disappear entirely).
+def project_geojson_geometries_quantized(geometries, zoom, xtile, ytile, units=256):
+	lines = []			# every list of positions in every geometry
+	for geometry in geometries:
+		geometry_type = geometry["type"]
+		coordinates = geometry.get("coordinates")
+		if geometry_type == "Point":
+			lines.append([coordinates])
+		elif geometry_type in ("MultiPoint", "LineString"):
+			lines.append(coordinates)
+		elif geometry_type in ("MultiLineString", "Polygon"):
+			lines.extend(coordinates)
+		elif geometry_type == "MultiPolygon":
+			for polygon in coordinates:
+				lines.extend(polygon)
+		elif geometry_type != "GeometryCollection":
+			raise TypeError("Unsupported geometry type: %s" % geometry_type)
+
+	# Drop points which are in the same cell as the one before them
+	lengths = numpy.array([len(line) for line in lines], dtype=numpy.intp)
+	quantized = []
+	if lengths.sum() > 0:
+		lonlat = numpy.array(list(itertools.chain.from_iterable(lines)), dtype=numpy.float64)[:,:2]
+		cells = numpy.rint(project_points_tilespace_pixels(lonlat[:,::-1], zoom, xtile, ytile) * (units / 256.0)).astype(numpy.int64)
+		nonempty = lengths > 0
+		starts = (numpy.cumsum(lengths) - lengths)[nonempty]
+		keep = numpy.ones(len(cells), dtype=bool)
+		keep[1:] = numpy.any(cells[1:] != cells[:-1], axis=1)
+		keep[starts] = True
+		lengths[nonempty] = numpy.add.reduceat(keep, starts)
+		cells = cells[keep].tolist()
+		start = 0
+		for length in lengths.tolist():
+			quantized.append(cells[start:start+length])
+			start += length
+	else:
+		quantized = [[] for line in lines]
+
+	def line_ok(line):
+		return len(line) >= 2
+	def ring_ok(ring):
+		return len(ring) >= 4 and ring[0] == ring[-1]
+
+	result = []
+	lines = iter(quantized)
+	for geometry in geometries:
+		geometry_type = geometry["type"]
+		if geometry_type == "GeometryCollection":
+			members = [member for member in project_geojson_geometries_quantized(geometry["geometries"], zoom, xtile, ytile, units) if member is not None]
+			result.append({"type": geometry_type, "geometries": members} if len(members) > 0 else None)
+			continue
+		coordinates = geometry["coordinates"]
+		new_coordinates = None
+		if geometry_type == "Point":
+			new_coordinates = next(lines)[0]
+		elif geometry_type == "MultiPoint":
+			new_coordinates = next(lines)
+		elif geometry_type == "LineString":
+			line = next(lines)
+			if line_ok(line):
+				new_coordinates = line
+		elif geometry_type == "MultiLineString":
+			new_coordinates = [line for line in [next(lines) for i in range(len(coordinates))] if line_ok(line)]
+		elif geometry_type == "Polygon":
+			rings = [next(lines) for i in range(len(coordinates))]
+			if len(rings) > 0 and ring_ok(rings[0]):
+				new_coordinates = [rings[0]] + [ring for ring in rings[1:] if ring_ok(ring)]
+		elif geometry_type == "MultiPolygon":
+			new_coordinates = []
+			for polygon in coordinates:
+				rings = [next(lines) for i in range(len(polygon))]
+				if len(rings) > 0 and ring_ok(rings[0]):
+					new_coordinates.append([rings[0]] + [ring for ring in rings[1:] if ring_ok(ring)])
+		if new_coordinates is None or len(new_coordinates) == 0:
+			result.append(None)
+		else:
+			result.append({"type": geometry_type, "coordinates": new_coordinates})
+	return result
+
+def project_points_mercartor(points):
+	points = _latlon_array(points)
+	return numpy.column_stack((
+		numpy.radians(points[:,1]) * radius_of_earth,
+		numpy.log(numpy.tan(pi/4.0 + numpy.radians(points[:,0]) / 2.0)) * radius_of_earth
+		))
+
+# Takes an (N,2) array of (x, y) in meters, returns (lat, lon)
+def unproject_points_mercartor(points):
+	points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+	return numpy.column_stack((
+		numpy.degrees(2.0 * numpy.arctan(numpy.exp(points[:,1] / radius_of_earth)) - pi / 2.0),
+		numpy.degrees(points[:,0] / radius_of_earth)
+		))
+
+def _latlon_array(points):
+	if hasattr(points, "array"):		# PointArray
+		return points.array
+	if not isinstance(points, numpy.ndarray):
+		points = [(p[0], p[1]) for p in points]
+	return numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+
 #=============================================================================
 # Spherical Mercartor in meters rather than in tiles
 # http://wiki.openstreetmap.org/wiki/Mercator
@@ -56,10 +234,23 @@ def unproject_point_mercartor(x, y):
 # See: http://stackoverflow.com/questions/4681737/how-to-calculate-the-area-of-a-polygon-on-the-earths-surface-using-python
 #=============================================================================
 
+# Accepts a list of (lat, lon) pairs or an (N,2) NumPy array. In the
+# latter case the result is also an (N,2) array. unproject_points_sinusoidal()
+# accepts and returns (N,2) arrays.
 def project_points_sinusoidal(points):
 	lat_dist = pi * radius_of_earth / 180.0	# size of degree in meters
+	if isinstance(points, numpy.ndarray):
+		lat = points[:,0]
+		lon = points[:,1]
+		return numpy.column_stack((lon * lat_dist * numpy.cos(numpy.radians(lat)), lat * lat_dist))
 	return [(
 		lon * lat_dist * cos(radians(lat)),
 		lat * lat_dist
 		) for lat, lon in points]
 
+
+def unproject_points_sinusoidal(points):
+	lat_dist = pi * radius_of_earth / 180.0
+	points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+	lat = points[:,1] / lat_dist
+	return numpy.column_stack((lat, points[:,0] / (lat_dist * numpy.cos(numpy.radians(lat)))))
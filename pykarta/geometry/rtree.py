@@ -0,0 +1,149 @@
+# pykarta/geometry/rtree.py
+# Copyright 2026, Trinity College
+# Last modified: 17 October 2026
+
+import numpy
+import heapq
+
+#=============================================================================
+# Spatial Index
+#
+# An RTree is a static, Sort-Tile-Recursive (STR) packed R-tree. It is bulk
+# loaded from a list of objects and is not updated in place. If the objects
+# change, build a new one. Building takes O(N log N) time, a bounding box
+# query takes roughly O(log N + k).
+#
+# By default the bounding box of each object is obtained by calling its
+# get_bbox() method. Pass a function as bbox= to get it some other way. The
+# function may return a pykarta BoundingBox or a tuple in the Openlayers
+# order (min_lon, min_lat, max_lon, max_lat). Objects with an invalid
+# (empty) bounding box can not be indexed. They are returned by every
+# query so that nothing is lost.
+#
+# Query results are returned in the order of the original list, so the
+# index can stand in for a linear scan of a list which is in Z order.
+#
+# As elsewhere in this package, the calculations assume a rectangular grid.
+#=============================================================================
+
+class RTree(object):
+	node_capacity = 16
+
+	def __init__(self, objs, bbox=None):
+		self.objs = list(objs)
+		if bbox is None:
+			bbox = lambda obj: obj.get_bbox()
+
+		boxes = numpy.empty((len(self.objs), 4))	# min_lat, min_lon, max_lat, max_lon
+		valid = numpy.ones(len(self.objs), dtype=bool)
+		for i, obj in enumerate(self.objs):
+			obj_bbox = bbox(obj)
+			if hasattr(obj_bbox, "valid"):
+				if obj_bbox.valid:
+					boxes[i] = (obj_bbox.min_lat, obj_bbox.min_lon, obj_bbox.max_lat, obj_bbox.max_lon)
+				else:
+					valid[i] = False
+			else:
+				min_lon, min_lat, max_lon, max_lat = obj_bbox
+				boxes[i] = (min_lat, min_lon, max_lat, max_lon)
+
+		self.unindexed = numpy.nonzero(~valid)[0]
+
+		# Build the tree from the bottom up. Each level is a list of child
+		# indexes (STR order) and the boxes of the nodes which hold them.
+		# The children of node j are children[j*cap:(j+1)*cap].
+		self.levels = []
+		children = numpy.nonzero(valid)[0]
+		child_boxes = boxes[children]
+		while True:
+			order = self._str_order(child_boxes)
+			children = children[order]
+			child_boxes = child_boxes[order]
+			node_boxes = self._node_boxes(child_boxes)
+			self.levels.append((children, child_boxes))
+			if len(node_boxes) <= 1:
+				break
+			children = numpy.arange(len(node_boxes))
+			child_boxes = node_boxes
+		self.levels.reverse()
+
+	def __len__(self):
+		return len(self.objs)
+
+	# Sort boxes by the longitude of their centers into vertical slices
+	# and then each slice by latitude so that runs of node_capacity boxes
+	# are close together.
+	def _str_order(self, boxes):
+		count = len(boxes)
+		if count <= self.node_capacity:
+			return numpy.arange(count)
+		center_lat = boxes[:,0] + boxes[:,2]
+		center_lon = boxes[:,1] + boxes[:,3]
+		node_count = -(-count // self.node_capacity)
+		slice_size = int(numpy.ceil(numpy.sqrt(node_count))) * self.node_capacity
+		by_lon = numpy.argsort(center_lon, kind="stable")
+		slice_number = numpy.empty(count, dtype=numpy.intp)
+		slice_number[by_lon] = numpy.arange(count) // slice_size
+		return numpy.lexsort((center_lat, slice_number))
+
+	def _node_boxes(self, boxes):
+		if len(boxes) == 0:
+			return boxes
+		starts = numpy.arange(0, len(boxes), self.node_capacity)
+		return numpy.column_stack((
+			numpy.minimum.reduceat(boxes[:,0], starts),
+			numpy.minimum.reduceat(boxes[:,1], starts),
+			numpy.maximum.reduceat(boxes[:,2], starts),
+			numpy.maximum.reduceat(boxes[:,3], starts),
+			))
+
+	def query(self, bbox):
+		"Return the objects whose bounding boxes overlap the indicated BoundingBox"
+		min_lat, min_lon, max_lat, max_lon = bbox.min_lat, bbox.min_lon, bbox.max_lat, bbox.max_lon
+		nodes = numpy.zeros(1, dtype=numpy.intp)		# the root
+		for children, child_boxes in self.levels:
+			positions = (nodes[:,None] * self.node_capacity + numpy.arange(self.node_capacity)).ravel()
+			positions = positions[positions < len(children)]
+			boxes = child_boxes[positions]
+			hits = (boxes[:,0] <= max_lat) & (boxes[:,2] >= min_lat) & (boxes[:,1] <= max_lon) & (boxes[:,3] >= min_lon)
+			nodes = children[positions[hits]]
+		found = numpy.sort(numpy.concatenate((nodes, self.unindexed)))
+		return [self.objs[i] for i in found.tolist()]
+
+	def nearest(self, point, count=1, distance=None):
+		"""Return up to count objects nearest to the point, nearest first.
+		Distances are to bounding boxes unless a function distance(obj, point)
+		is supplied. It must never return less than the distance to the
+		object's bounding box."""
+		lat, lon = point[0], point[1]
+		leaf_level = len(self.levels) - 1
+		NODE, OBJ_BBOX, OBJ = 0, 1, 2
+		serial = 0
+		heap = []
+		if leaf_level >= 0 and len(self.levels[0][0]) > 0:
+			heap.append((0.0, serial, NODE, 0, 0))
+		found = []
+		while heap and len(found) < count:
+			dist, junk, kind, level, index = heapq.heappop(heap)
+			if kind == OBJ:
+				found.append(self.objs[index])
+			elif kind == OBJ_BBOX:
+				serial += 1
+				heapq.heappush(heap, (max(dist, distance(self.objs[index], point)), serial, OBJ, level, index))
+			else:
+				children, child_boxes = self.levels[level]
+				start = index * self.node_capacity
+				boxes = child_boxes[start:start+self.node_capacity]
+				dlat = numpy.maximum(numpy.maximum(boxes[:,0] - lat, lat - boxes[:,2]), 0.0)
+				dlon = numpy.maximum(numpy.maximum(boxes[:,1] - lon, lon - boxes[:,3]), 0.0)
+				if level < leaf_level:
+					child_kind = NODE
+					child_level = level + 1
+				else:
+					child_kind = OBJ if distance is None else OBJ_BBOX
+					child_level = level
+				for child, child_dist in zip(children[start:start+self.node_capacity].tolist(), numpy.hypot(dlat, dlon).tolist()):
+					serial += 1
+					heapq.heappush(heap, (child_dist, serial, child_kind, child_level, child))
+		return found
+
@@ -1,35 +1,121 @@
 # pykarta/geometry/simplify.py
-# Last modified: 15 May 2018
+# Last modified: 17 October 2026
 
-from .distance import plane_lineseg_distance
+import math
+import numpy
 
 #=============================================================================
 # Line simplification
+#
+# These implement the Douglas-Peucker algorithm. The points may be Points,
+# (x, y) tuples, a PointArray, or an (N,2) NumPy array. The distances from
+# the points of a span to the line segment which would replace them are
+# computed in a single array operation.
+#
+# line_simplify() simplifies a line to a given tolerance.
+#
+# line_simplify_levels() runs the algorithm once to find the largest
+# tolerance at which each point would still be kept. Simplifying to any
+# tolerance is then a matter of passing the levels to line_simplify_filter().
+# It returns the same points as line_simplify() would.
 #=============================================================================
+
 def line_simplify(points, tolerance):
+	if len(points) < 3:
+		return list(points)
+	array = _points_array(points)
 	stack = []
-	keep = set()
+	keep = numpy.zeros(len(array), dtype=bool)
 
-	stack.append((0, len(points)-1))
+	stack.append((0, len(array)-1))
 	while stack:
 		anchor, floater = stack.pop()
-		max_dist = 0.0
-		farthest = anchor + 1	# why necessary?
-		#print anchor, floater
-		for i in range(anchor + 1, floater):
-			dist_to_seg = plane_lineseg_distance(points[i], points[anchor], points[floater])
-			#print " i:", i, dist_to_seg
-			if dist_to_seg > max_dist:
-				max_dist = dist_to_seg
-				farthest = i
+		farthest, max_dist = _farthest(array, anchor, floater)
 		if max_dist <= tolerance:
-			keep.add(anchor)
-			keep.add(floater)
+			keep[anchor] = True
+			keep[floater] = True
 		else:
 			stack.append((anchor, farthest))
 			stack.append((farthest, floater))
 
-	keep = list(keep)
-	keep.sort()
-	return [points[i] for i in keep]
+	return [points[i] for i in numpy.nonzero(keep)[0].tolist()]
+
+def line_simplify_levels(points):
+	"Return an array of the tolerance below which each point is kept"
+	array = _points_array(points)
+	levels = numpy.zeros(len(array))
+	if len(array) == 0:
+		return levels
+	levels[0] = levels[-1] = numpy.inf
+
+	# A point is kept only if the spans in which it was found were
+	# split, so its level can not exceed that of the point which split
+	# the enclosing span.
+	stack = [(0, len(array)-1, numpy.inf)]
+	while stack:
+		anchor, floater, parent_level = stack.pop()
+		if floater - anchor < 2:
+			continue
+		farthest, max_dist = _farthest(array, anchor, floater)
+		level = min(max_dist, parent_level)
+		levels[farthest] = level
+		stack.append((anchor, farthest, level))
+		stack.append((farthest, floater, level))
+
+	return levels
+
+def line_simplify_filter(points, levels, tolerance):
+	"Simplify a line using levels from line_simplify_levels()"
+	return [points[i] for i in numpy.nonzero(levels > tolerance)[0].tolist()]
+
+# Find the point between anchor and floater which is farthest from
+# the line segment which joins them. Short spans are done in plain
+# Python since for them NumPy's per-call overhead would dominate.
+def _farthest(array, anchor, floater, small_span=24):
+	if floater - anchor < 2:
+		return (anchor + 1, 0.0)
+	if floater - anchor < small_span:
+		return _farthest_small(array[anchor:floater+1].tolist(), anchor)
+	p1 = array[anchor]
+	p2 = array[floater]
+	span = array[anchor+1:floater]
+	dx, dy = p2 - p1
+	px = span[:,0] - p1[0]
+	py = span[:,1] - p1[1]
+	length_squared = dx * dx + dy * dy
+	if length_squared > 0.0:
+		t = numpy.clip((px * dx + py * dy) / length_squared, 0.0, 1.0)
+		distances = numpy.hypot(px - t * dx, py - t * dy)
+	else:
+		distances = numpy.hypot(px, py)
+	i = int(numpy.argmax(distances))
+	return (anchor + 1 + i, float(distances[i]))
+
+def _farthest_small(span, anchor):
+	x1, y1 = span[0]
+	x2, y2 = span[-1]
+	dx = x2 - x1
+	dy = y2 - y1
+	length_squared = dx * dx + dy * dy
+	hypot = math.hypot
+	max_dist = 0.0
+	farthest = 1
+	for i in range(1, len(span)-1):
+		px = span[i][0] - x1
+		py = span[i][1] - y1
+		if length_squared > 0.0:
+			t = min(max((px * dx + py * dy) / length_squared, 0.0), 1.0)
+			dist = hypot(px - t * dx, py - t * dy)
+		else:
+			dist = hypot(px, py)
+		if dist > max_dist:
+			max_dist = dist
+			farthest = i
+	return (anchor + farthest, max_dist)
 
+def _points_array(points):
+	if isinstance(points, numpy.ndarray):
+		return numpy.asarray(points, dtype=numpy.float64)
+	if hasattr(points, "array"):		# PointArray
+		return points.array
+	return numpy.array([(p[0], p[1]) for p in points], dtype=numpy.float64).reshape(-1, 2)
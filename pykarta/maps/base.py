@@ -1,24 +1,26 @@
 # encoding=utf-8
 #=============================================================================
 # pykarta/maps/base.py
-# Copyright 2013--2021, Trinity College
-# Last modified: 26 December 2021
+# Copyright 2013--2026, Trinity College
+# Last modified: 17 October 2026
 #=============================================================================
 
 
 import os
 import sys
 import math
+import time
+import numpy
 import cairo
 import weakref
 
 from pykarta.geometry import Point, BoundingBox
-from pykarta.geometry.projection import project_to_tilespace, unproject_from_tilespace
+from pykarta.geometry.projection import project_to_tilespace, unproject_from_tilespace, project_points_tilespace, unproject_points_tilespace
 import pykarta.maps.symbols
-from pykarta.maps.layers import MapLayerBuilder, map_layer_sets, MapCacheCleaner
+from pykarta.maps.layers import MapLayerBuilder, map_layer_sets
+from pykarta.maps.layers.tile_cache import get_tile_cache
 import pykarta.misc
 
-cache_cleaner_thread = None
 
 #=============================================================================
 # Common code for both the map widget and the map printer
@@ -27,11 +29,17 @@ class MapBase(object):
 	lazy_tiles = False			# Load tiles asyncronously?
 	print_mode = False			# Need higher resolution?
 
-	def __init__(self, tile_source="osm-default", tile_cache_basedir=None, feedback=None, debug_level=0, offline=False):
+	# tile_cache may be "directory" (one file per tile), "mbtiles" (one
+	# SQLite file per tileset), or a tile cache object to share.
+	def __init__(self, tile_source="osm-default", tile_cache_basedir=None, feedback=None, debug_level=0, offline=False, tile_cache="directory"):
 		if tile_cache_basedir is not None:
 			self.tile_cache_basedir = tile_cache_basedir
 		else:
 			self.tile_cache_basedir = os.path.join(pykarta.misc.get_cachedir(), "map_tiles")
+		if isinstance(tile_cache, str):
+			self.tile_cache = get_tile_cache(self.tile_cache_basedir, tile_cache)
+		else:
+			self.tile_cache = tile_cache
 
 		# If the user has not supplied a custom MapFeedback object,
 		# create a generic one for him.
@@ -65,16 +73,14 @@ class MapBase(object):
 		self.layers_osd = []
 		self.updated_viewport = True
 		self.top_left_pixel = None
+		self.motion = MapViewportMotion()
 
 		if tile_source is not None:
 			self.feedback.debug(1, "Initial tile source: %s" % repr(tile_source))
 			self.set_tile_source(tile_source)
 
-		global cache_cleaner_thread
-		if cache_cleaner_thread is None:
-			self.feedback.debug(1, "Starting cache cleaner thread...")
-			cache_cleaner_thread = MapCacheCleaner(self.tile_cache_basedir)
-			cache_cleaner_thread.start()
+		self.feedback.debug(1, "Starting cache cleaner...")
+		self.tile_cache.start_cleaner()
 
 	# When the map goes out of scope, check the layers to see whether
 	# they will go out of scope too. Warn if they won't.
@@ -107,6 +113,9 @@ class MapBase(object):
 				y - (self.height / 2.0 / 256.0),
 				)
 			#print("Map top left:", self.top_left_pixel)
+
+			# Tile layers use the estimated pan and zoom speed to prefetch tiles.
+			self.motion.update(self.lat, self.lon, self.zoom)
 	
 			self.queue_draw()
 
@@ -130,9 +139,14 @@ class MapBase(object):
 		x, y = project_to_tilespace(point.lat, point.lon, self.zoom)
 		return (int((x - self.top_left_pixel[0]) * 256), int((y - self.top_left_pixel[1]) * 256))
 
-	# Apply project_point() to a list of points
+	# Apply project_point() to a list of points (or a PointArray).
+	# The projection is done in one batch.
 	def project_points(self, points):
-		return list(map(self.project_point, points))
+		pixels = project_points_tilespace(points, self.zoom)
+		pixels -= self.top_left_pixel
+		pixels *= 256
+		pixels = pixels.astype(int)		# truncates as int() does
+		return list(zip(pixels[:,0].tolist(), pixels[:,1].tolist()))
 
 	# Take a list of points which have already been passed through
 	# project_to_tilespace() return a new list with them converted
@@ -148,10 +162,9 @@ class MapBase(object):
 		tile_y = self.top_left_pixel[1] + y / 256.0
 		return Point(unproject_from_tilespace(tile_x, tile_y, self.zoom))
 	def unproject_points(self, points):
-		result = []
-		for point in points:
-			result.append(self.unproject_point(*point))
-		return result
+		tiles = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2) / 256.0
+		tiles += self.top_left_pixel
+		return [Point(lat, lon) for lat, lon in unproject_points_tilespace(tiles, self.zoom).tolist()]
 
 	#------------------------------------------------------------------------
 	# Public Methods: Viewport
@@ -548,6 +561,50 @@ class MapFeedback(object):
 		else:
 			print("Map Progress: %f of %f: %s" % (finished, total, message))
 
+#=============================================================================
+# Estimates how fast and in which direction the map is moving so that
+# the tile layers can download the tiles it will need next. Positions are
+# in tilespace at zoom level 0, so the whole world is 1.0 units wide.
+# The velocity is smoothed so that a single jerk of the mouse does not
+# send the prefetcher off in a new direction.
+#=============================================================================
+class MapViewportMotion(object):
+	smoothing = 0.5			# weight given to the latest measurement
+	min_interval = 0.02		# seconds, changes closer together are combined
+	max_interval = 1.0		# seconds, if no change for this long, we have stopped
+
+	def __init__(self):
+		self.last = None		# (time, x, y, zoom)
+		self.velocity = (0.0, 0.0, 0.0)
+
+	def update(self, lat, lon, zoom):
+		now = time.time()
+		x, y = project_to_tilespace(lat, lon, 0)
+		if self.last is not None:
+			last_time, last_x, last_y, last_zoom = self.last
+			interval = now - last_time
+			if interval < self.min_interval:
+				return
+			if interval > self.max_interval:
+				self.velocity = (0.0, 0.0, 0.0)
+			else:
+				dx = (x - last_x + 0.5) % 1.0 - 0.5		# the short way around the world
+				measured = (dx / interval, (y - last_y) / interval, (zoom - last_zoom) / interval)
+				self.velocity = tuple([self.smoothing * m + (1.0 - self.smoothing) * v for m, v in zip(measured, self.velocity)])
+		self.last = (now, x, y, zoom)
+
+	# Return the center (in zoom level 0 tilespace) and zoom level
+	# expected in the indicated number of seconds if the map keeps
+	# moving as it has been.
+	def predict(self, seconds):
+		if self.last is None:
+			return None
+		last_time, x, y, zoom = self.last
+		if time.time() - last_time > self.max_interval:
+			return (x, y, zoom)
+		vx, vy, vzoom = self.velocity
+		return ((x + vx * seconds) % 1.0, y + vy * seconds, zoom + vzoom * seconds)
+
 #=============================================================================
 # Map which can be drawn directly on a Cairo context. This is used when
 # generating PDF files or when printing.
@@ -1,17 +1,19 @@
 # encoding=utf-8
 # pykarta/maps/layers/base.py
 # Copyright 2013--2022, Trinity College
-# Last modified: 2 January 2022
+# Last modified: 18 October 2026
 
 
 import math
 import cairo
 import weakref
+import threading
 from collections import OrderedDict
 
 from ...misc.i18n import *
 from ..image_loaders import surface_from_pixbuf, pixbuf_from_file, pixbuf_from_file_data
 from ...geometry.projection import project_to_tilespace
+from .tile_labels import MapLabelPlacer
 
 class MapTileError(Exception):
 	pass
@@ -106,6 +108,99 @@ class MapLayer(object):
 	def on_motion(self, gdkevent):
 		return False
 
+#=============================================================================
+# Process-wide accounting of the RAM used by loaded tiles
+#
+# Each tile layer keeps the tiles it has loaded in its ram_cache. The
+# memory manager keeps track of the size of each of them (as reported by
+# the tile's get_memory_size() method) in least-recently-used order across
+# all of the layers. When the total exceeds the budget, the least recently
+# used tiles are removed from their layers' caches.
+#=============================================================================
+
+class MapTileMemoryManager(object):
+	budget = 256 * 1024 * 1024			# bytes
+	default_size = 256 * 256 * 4		# for tiles which can't say
+	placeholder_size = 64				# for None (tile not available)
+
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.lru = OrderedDict()		# (id(layer), zoom, x, y) -> [weakref to layer, size]
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def set_budget(self, budget):
+		with self.lock:
+			self.budget = budget
+			self._trim()
+
+	def tile_size(self, tile):
+		if tile is None:
+			return self.placeholder_size
+		get_memory_size = getattr(tile, "get_memory_size", None)
+		if get_memory_size is None:
+			return self.default_size
+		return get_memory_size()
+
+	# The layer has found a tile in its cache
+	def hit(self, layer, key):
+		with self.lock:
+			self.hits += 1
+			lru_key = (id(layer),) + key
+			if lru_key in self.lru:
+				self.lru.move_to_end(lru_key)
+
+	# The layer has loaded a tile and added it to its cache. If the tile
+	# does not fit in the budget, it is removed again at once.
+	def add(self, layer, key, tile):
+		size = self.tile_size(tile)
+		with self.lock:
+			self.misses += 1
+			lru_key = (id(layer),) + key
+			old = self.lru.pop(lru_key, None)
+			if old is not None:
+				self.used -= old[1]
+			self.lru[lru_key] = [weakref.ref(layer), size]
+			self.used += size
+			self._trim()
+
+	# The layer has removed a tile from its cache
+	def remove(self, layer, key):
+		with self.lock:
+			old = self.lru.pop((id(layer),) + key, None)
+			if old is not None:
+				self.used -= old[1]
+
+	def remove_layer(self, layer):
+		with self.lock:
+			layer_id = id(layer)
+			for lru_key in [lru_key for lru_key in self.lru if lru_key[0] == layer_id]:
+				self.used -= self.lru.pop(lru_key)[1]
+
+	def _trim(self):
+		while self.used > self.budget and len(self.lru) > 0:
+			lru_key, (layer_ref, size) = self.lru.popitem(last=False)
+			self.used -= size
+			self.evictions += 1
+			layer = layer_ref()
+			if layer is not None:
+				layer.ram_cache.pop(lru_key[1:], None)
+
+	def get_stats(self):
+		with self.lock:
+			return {
+				"budget": self.budget,
+				"used": self.used,
+				"tiles": len(self.lru),
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				}
+
+tile_memory_manager = MapTileMemoryManager()
+
 #=============================================================================
 # Base of all tile layers
 #=============================================================================
@@ -114,7 +209,7 @@ class MapTileLayer(MapLayer):
 	def __init__(self, tile_class):
 		MapLayer.__init__(self)
 		self.tile_class = tile_class
-		self.ram_cache_max = 1000		# number of tiles to keep in RAM
+		self.ram_cache_max = 1000		# number of tiles to keep in RAM (see also tile_memory_manager)
 
 		self.ram_cache = OrderedDict()
 		self.tiles = []
@@ -123,10 +218,16 @@ class MapTileLayer(MapLayer):
 		self.int_zoom = None			# nearest integer zoom level (for fetching tiles)
 		self.tile_size = None
 		self.tile_ranges = None			# used for precaching
-		self.dedup = set()				# for deduplicating labels, shared by all the tiles
+		self.center_tile = None
+		self.drawn_tiles = set()		# tile objects drawn last time
 
-	#def __del__(self):
-	#	print("Map: tile layer %s destroyed" % self.name)
+		# Tiles which offer labels have them placed together (see tile_labels.py)
+		self.label_placer = MapLabelPlacer() if hasattr(tile_class, "get_labels") else None
+
+	# Release this layer's share of the tile memory budget
+	def __del__(self):
+		#print("Map: tile layer %s destroyed" % self.name)
+		tile_memory_manager.remove_layer(self)
 
 	# Called whenever viewport changes
 	def do_viewport(self):
@@ -215,13 +316,12 @@ class MapTileLayer(MapLayer):
 				xpixoff += self.tile_size
 
 			self.tile_ranges = (x_range_start, x_range_end, y_range_start, y_range_end)
+			self.center_tile = (center_tile_x, center_tile_y)
 
 	# Called whenever redrawing required
 	def do_draw(self, ctx):
 		#print("Draw %s tiles..." % self.name)
 
-		self.dedup.clear()
-
 		# Load tiles
 		progress = 1
 		tile_objs = []
@@ -277,29 +377,81 @@ class MapTileLayer(MapLayer):
 				tile_objs.append(tile)
 				i += 1
 
+		# Tiles may keep recordings of their drawing to replay while they
+		# are on the screen. These are not counted by tile_memory_manager,
+		# so they are dropped when the tiles go out of view.
+		drawn_tiles = set()
+		for tile, bigger_tile, subtile_scale_factor, x_adj, y_adj in tile_objs[:len(self.tiles)]:
+			drawn_tiles.add(tile if tile is not None else bigger_tile)
+		for tile in self.drawn_tiles - drawn_tiles:
+			drop_recordings = getattr(tile, "drop_recordings", None)
+			if drop_recordings is not None:
+				drop_recordings()
+		self.drawn_tiles = drawn_tiles
+
+		# Place the labels of all of the tiles together and draw them on top.
+		# A lower zoom tile standing in for several which are not loaded yet
+		# is listed once, positioned by its top left corner.
+		if self.label_placer is not None:
+			tiles = []
+			bigger_tiles = set()
+			for (zoom, x, y, xpixoff, ypixoff), tile_obj in zip(self.tiles, tile_objs):
+				tile, bigger_tile, subtile_scale_factor, x_adj, y_adj = tile_obj
+				if bigger_tile is None:
+					tiles.append((zoom, x, y, xpixoff, ypixoff, tile))
+				else:
+					zoom_diff = subtile_scale_factor.bit_length() - 1
+					key = (zoom - zoom_diff, x >> zoom_diff, y >> zoom_diff)
+					if not key in bigger_tiles:
+						bigger_tiles.add(key)
+						tiles.append(key + (xpixoff + x_adj, ypixoff + y_adj, bigger_tile))
+			self.label_placer.draw(ctx, tiles, self.int_zoom, self.tile_scale_factor)
+
 	# This wraps load_tile() and caches the most recently used tiles in RAM.
 	def load_tile_cached(self, zoom, x, y, may_download):
 		#print("Tile:", zoom, x, y, may_download)
 		key = (zoom, x, y)
-		try:
-			result = self.ram_cache.pop(key)	# will reinsert below
+		if key in self.ram_cache:
 			#print(" cache hit")
-		except KeyError:
+			result = self.ram_cache.pop(key)
+			self.ram_cache[key] = result		# now most recently used
+			tile_memory_manager.hit(self, key)
+		else:
 			#print(" cache miss")
 			result = self.load_tile(zoom, x, y, may_download)
 			if result == None and not may_download:
 				return None
 			if len(self.ram_cache) > self.ram_cache_max:		# trim cache?
-				self.ram_cache.popitem(last=False)
-		self.ram_cache[key] = result
+				old_key, old_tile = self.ram_cache.popitem(last=False)
+				tile_memory_manager.remove(self, old_key)
+			# The memory manager may take it out again if it is over budget.
+			self.ram_cache[key] = result
+			tile_memory_manager.add(self, key, result)
 		return result
 
 	def ram_cache_invalidate(self, zoom, x, y):
 		try:
 			self.ram_cache.pop((zoom, x, y))
+			tile_memory_manager.remove(self, (zoom, x, y))
 		except KeyError:
 			print("cache_invalidate(): not in cache", zoom, x, y)
 
+	# Put a tile which was loaded in the background into the RAM cache,
+	# replacing whatever (possibly None) was there before.
+	def ram_cache_store(self, zoom, x, y, tile):
+		key = (zoom, x, y)
+		if key in self.ram_cache:
+			del self.ram_cache[key]
+		elif len(self.ram_cache) > self.ram_cache_max:
+			old_key, old_tile = self.ram_cache.popitem(last=False)
+			tile_memory_manager.remove(self, old_key)
+		self.ram_cache[key] = tile
+		tile_memory_manager.add(self, key, tile)
+
+	def ram_cache_clear(self):
+		self.ram_cache.clear()
+		tile_memory_manager.remove_layer(self)
+
 	# Return the indicated tile as a Cairo surface. If it is not yet
 	# available, return None.
 	def load_tile(self, zoom, x, y, may_download):
@@ -340,6 +492,9 @@ class MapRasterTile(object):
 		# Convert pixbuf to a Cairo image surface.
 		self.tile_surface = surface_from_pixbuf(pixbuf)
 
+	def get_memory_size(self):
+		return self.tile_surface.get_stride() * self.tile_surface.get_height()
+
 	# Draw a tile so that it covers an area of 256x256 pixels multiplied by scale.
 	# Scale will be 1.0 when the zoom level is an integer and the tiles are not overzoomed.
 	def draw(self, ctx, scale, draw_pass):
@@ -1,28 +1,30 @@
 # pykarta/maps/layers/shapefile.py
 # Display ESRI shapefiles
-# Copyright 2013, 2014, Trinity College
-# Last modified: 4 September 2014
+# Copyright 2013--2026, Trinity College
+# Last modified: 18 October 2026
 
 from pykarta.formats.shapefile import Reader
 from pykarta.maps.layers import MapLayer
 import pykarta.draw
-from pykarta.geometry import Point, BoundingBox
+from pykarta.geometry import Point
+from pykarta.geometry.rtree import RTree
 
 class MapLayerShapefile(MapLayer):
 	def __init__(self, shapefile):
 		MapLayer.__init__(self)
 		self.sf = Reader(shapefile)
+		self.index = None
 		self.visible_objs = []
 
 	def do_viewport(self):
 		map_bbox = self.containing_map.get_bbox()
+		if self.index is None:
+			polylines = [shape for shape in self.sf.shapes() if shape.shapeType == 3]
+			self.index = RTree(polylines, bbox=lambda shape: shape.bbox)
 		self.visible_objs = []
-		for shape in self.sf.shapes():
-			if shape.shapeType == 3:	# polyline
-				shape_bbox = BoundingBox(shape.bbox)
-				if shape_bbox.overlaps(map_bbox):
-					points = [Point(p[1], p[0]) for p in shape.points]
-					self.visible_objs.append(self.containing_map.project_points(points))	
+		for shape in self.index.query(map_bbox):
+			points = [Point(p[1], p[0]) for p in shape.points]
+			self.visible_objs.append(self.containing_map.project_points(points))	
 
 	def do_draw(self, ctx):
 		ctx.set_line_width(1)
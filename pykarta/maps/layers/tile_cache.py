@@ -0,0 +1,245 @@
+# encoding=utf-8
+# pykarta/maps/layers/tile_cache.py
+# Copyright 2013--2026, Trinity College
+# Last modified: 17 October 2026
+
+import os
+import errno
+import random
+import threading
+import time
+
+from pykarta.misc import SaveAtomically
+from pykarta.formats.mbtiles import MapMbtilesCache
+
+#=============================================================================
+# Tile caches
+#
+# The tile downloaders store the tiles they download in a tile cache. There
+# are two implementations with the same interface:
+#
+# MapTileCacheDir
+#	Each tile is a file in a directory tree: basedir/key/z/x/y. Freshness
+#	is determined from file modification times.
+#
+# MapTileCacheMbtiles
+#	All of the tiles of a tileset are in one MBTiles file: basedir/key.mbtiles.
+#	This uses far fewer inodes and cleaning is a pair of SQL queries.
+#
+# get() returns a MapCachedTile or None. The tile classes accept either the
+# filename or the data from it.
+#=============================================================================
+
+class MapCachedTile(object):
+	__slots__ = ("filename", "data", "fetched", "etag", "last_modified")
+	def __init__(self, filename=None, data=None, fetched=None, etag=None, last_modified=None):
+		self.filename = filename			# file containing the tile, or
+		self.data = data					# the tile itself
+		self.fetched = fetched				# time downloaded or revalidated
+		self.etag = etag					# HTTP validators, if known
+		self.last_modified = last_modified
+
+	def age_in_days(self):
+		return float(time.time() - self.fetched) / 86400.0
+
+class MapTileCacheDir(object):
+	def __init__(self, basedir):
+		self.basedir = basedir
+		self.cleaner = None
+
+	def tile_filename(self, key, zoom, x, y):
+		return "%s/%s/%d/%d/%d" % (self.basedir, key, zoom, x, y)
+
+	def get(self, key, zoom, x, y):
+		filename = self.tile_filename(key, zoom, x, y)
+		try:
+			statbuf = os.stat(filename)
+		except OSError:
+			return None
+		return MapCachedTile(filename=filename, fetched=statbuf.st_mtime)
+
+	def put(self, key, zoom, x, y, data, etag=None, last_modified=None):
+		filename = self.tile_filename(key, zoom, x, y)
+
+		# Make the cache directory which holds this tile, if it does not exist already.
+		dirname = os.path.dirname(filename)
+		if not os.path.exists(dirname):
+			# This may fail if another thread creates.
+			try:
+				os.makedirs(dirname)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+		# Save the file in such a manner that there is never a partial tile with the final name.
+		cachefile = SaveAtomically(filename)
+		cachefile.write(data)
+		try:
+			cachefile.close()
+		except OSError as e:
+			print("FIXME: OSError: %d" % e.errno)
+
+	def touch(self, key, zoom, x, y):
+		fh = open(self.tile_filename(key, zoom, x, y), "a")
+		fh.close()
+
+	def remove(self, key, zoom, x, y):
+		try:
+			os.unlink(self.tile_filename(key, zoom, x, y))
+		except OSError:
+			pass
+
+	# Start cleaning the cache in a background thread, if not already started
+	def start_cleaner(self):
+		if self.cleaner is None:
+			self.cleaner = MapCacheCleaner(self.basedir)
+			self.cleaner.start()
+
+class MapTileCacheMbtiles(object):
+	max_age = 180			# days after last use after which to delete tiles
+	max_tiles = None		# maximum tiles per tileset, or None for no limit
+
+	def __init__(self, basedir):
+		self.basedir = basedir
+		self.files = {}
+		self.lock = threading.Lock()
+		self.cleaner_started = False
+
+	def get_file(self, key):
+		with self.lock:
+			mbtiles = self.files.get(key)
+			if mbtiles is None:
+				if not os.path.exists(self.basedir):
+					os.makedirs(self.basedir)
+				mbtiles = self.files[key] = MapMbtilesCache(os.path.join(self.basedir, "%s.mbtiles" % key), {"name": key})
+			return mbtiles
+
+	def get(self, key, zoom, x, y):
+		row = self.get_file(key).get(zoom, x, y)
+		if row is None:
+			return None
+		data, etag, last_modified, fetched = row
+		return MapCachedTile(data=data, fetched=fetched, etag=etag, last_modified=last_modified)
+
+	def put(self, key, zoom, x, y, data, etag=None, last_modified=None):
+		self.get_file(key).put(zoom, x, y, data, etag, last_modified)
+
+	def touch(self, key, zoom, x, y):
+		self.get_file(key).touch(zoom, x, y)
+
+	def remove(self, key, zoom, x, y):
+		self.get_file(key).remove(zoom, x, y)
+
+	# Evict old tiles from all of the tilesets in the cache. The work
+	# is done by the MBTiles writer threads.
+	def start_cleaner(self):
+		if not self.cleaner_started and os.path.exists(self.basedir):
+			for filename in os.listdir(self.basedir):
+				if filename.endswith(".mbtiles"):
+					self.get_file(filename[:-8]).evict(unused_since=time.time() - self.max_age * 86400, max_tiles=self.max_tiles)
+		self.cleaner_started = True
+
+# Return the cache of the indicated type for the indicated directory,
+# creating it if necessary. Maps which use the same directory share it.
+tile_cache_types = {
+	"directory": MapTileCacheDir,
+	"mbtiles": MapTileCacheMbtiles,
+	}
+tile_caches = {}
+def get_tile_cache(basedir, cache_type="directory"):
+	key = (basedir, cache_type)
+	tile_cache = tile_caches.get(key)
+	if tile_cache is None:
+		tile_cache = tile_caches[key] = tile_cache_types[cache_type](basedir)
+	return tile_cache
+
+#=============================================================================
+# Clean a MapTileCacheDir
+#=============================================================================
+class MapCacheCleaner(threading.Thread):
+	def __init__(self, cache_root, scan_interval=30, max_age=180):
+		threading.Thread.__init__(self, name="cache-cleaner")
+		self.daemon = True
+		self.cache_root = cache_root
+		day = 24 * 60 * 60
+
+		# Scan a tileset's cache if it was last scanned before this date.
+		self.scan_if_before = time.time() - scan_interval * day
+
+		# Delete tiles last used before this date.
+		self.delete_if_before = time.time() - max_age * day
+
+		# Sleep in seconds after processing each directory within a tileset's
+		# cache. We do this so as not to hit the disk too hard.
+		self.directory_delay = 0.2
+
+		# Sleep in seconds after scanning each tileset.
+		self.tileset_delay = 90
+
+	def run(self):
+		time.sleep(5)		# wait until after startup
+		print("Cache cleaner: starting")
+
+		tilesets = []
+		tilesets_count = 0
+		for tileset in os.listdir(self.cache_root):
+			if not os.path.isdir(os.path.join(self.cache_root, tileset)):
+				continue
+			tilesets_count += 1
+			touchfile = os.path.join(self.cache_root, tileset, ".last-cleaned")
+			if os.path.exists(touchfile):
+				statbuf = os.stat(touchfile)
+				if statbuf.st_mtime < self.scan_if_before:
+					#print("Cache cleaner: %s due for cleaning" % tileset)
+					tilesets.append(tileset)
+				else:
+					#print("Cache cleaner: %s cleaned too recently" % tileset)
+					pass
+			else:
+				#print("Cache cleaner: %s never cleaned" % tileset)
+				tilesets.append(tileset)
+		print("Cache cleaner: %d of %d tilesets need cleaning" % (len(tilesets), tilesets_count))
+
+		random.shuffle(tilesets)
+
+		for tileset in tilesets:
+			cachedir = os.path.join(self.cache_root, tileset)
+			touchfile = os.path.join(cachedir, ".last-cleaned")
+
+			print("Cache cleaner: cleaning %s..." % tileset)
+			total = 0
+			deleted = 0
+			for dirpath, dirnames, filenames in os.walk(cachedir, topdown=False):
+				#print dirpath, dirnames, filenames
+				left = 0
+				for filename in filenames:
+					filepath = os.path.join(dirpath, filename)
+					statbuf = os.stat(filepath)
+					if statbuf.st_atime < self.delete_if_before:
+						deleted += 1
+						os.unlink(filepath)
+					else:
+						left += 1
+					total += 1
+				for dirname in dirnames:
+					path = os.path.join(dirpath, dirname)
+					#print("rmdir(\"%s\")" % path)
+					try:
+						os.rmdir(path)
+					except OSError:
+						#print("  Not empty")
+						pass
+				time.sleep(self.directory_delay)
+
+			print("Cache cleaner: %d of %d tiles removed from %s" % (deleted, total, tileset))
+			if deleted == total:
+				print("Cache cleaner: removing empty cache %s..." % tileset)
+				if os.path.exists(touchfile):
+					os.unlink(touchfile)
+				os.rmdir(cachedir)
+			else:
+				open(touchfile, "w")
+
+			time.sleep(self.tileset_delay)
+
+		print("Cache cleaner: finished")
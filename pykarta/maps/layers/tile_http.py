@@ -1,29 +1,36 @@
 # encoding=utf-8
 # pykarta/maps/layers/tile_http.py
-# Copyright 2013--2023, Trinity College
-# Last modified: 1 April 2023
+# Copyright 2013--2026, Trinity College
+# Last modified: 17 October 2026
 
 
-import os
-import errno
-import random
 import threading
 import time
 import socket
 import gzip
+import math
+import heapq
+import queue
+import weakref
 import http.client
-from io import StringIO
+from io import BytesIO
 from gi.repository import GObject
 
 from pykarta.misc.http import http_date
 from pykarta.maps.layers.base import MapTileLayer, MapTileError
-from pykarta.misc import file_age_in_days, BoundMethodProxy, NoInet, tile_count, SaveAtomically
+from pykarta.misc import file_age_in_days, BoundMethodProxy, NoInet, tile_count
+from pykarta.maps.layers.tile_cache import MapCacheCleaner
 
 #=============================================================================
 # TMS tile layer loaded over HTTP
 #=============================================================================
 
 class MapTileLayerHTTP(MapTileLayer):
+	prefetch = True				# download tiles which will probably be needed soon?
+	prefetch_ring = 1			# tiles beyond the edges of the viewport
+	prefetch_lookahead = 2.0	# seconds of pan and zoom motion to anticipate
+	prefetch_max = 48			# tiles per viewport change
+
 	def __init__(self, tileset, options={}):
 		MapTileLayer.__init__(self, tileset.tile_class)
 		self.tileset = tileset
@@ -47,6 +54,7 @@ class MapTileLayerHTTP(MapTileLayer):
 		self.missing_tiles = {}
 		self.redraw_needed = False
 		self.tile_ranges = None
+		self.decoding = set()			# (zoom, x, y) of tiles queued for decoding
 
 	# Hook set_map() so that when this layer is added to the map it
 	# can create a tile downloader and set it to either syncronous mode or 
@@ -76,33 +84,79 @@ class MapTileLayerHTTP(MapTileLayer):
 		if self.containing_map.offline:
 			self.downloader = MapTileCacheLoader(
 				self.tileset,
-				self.containing_map.tile_cache_basedir,
+				self.containing_map.tile_cache,
 				feedback=self.feedback,
 				)
 		else:
 			self.downloader = MapTileDownloader(
 				self.tileset,
-				self.containing_map.tile_cache_basedir,
+				self.containing_map.tile_cache,
 				feedback=self.feedback,
 				done_callback=BoundMethodProxy(self.tile_loaded_cb) if self.containing_map.lazy_tiles else None,
 				)
 
 		# The RAM cache may reflect absence of tiles. Dump it.
-		self.ram_cache.clear()
+		self.ram_cache_clear()
 
 	# Return the indicated tile as a Cairo surface or None
 	# if it is not (yet) available.
+	#
+	# When tiles are loaded lazily, a tile found in the disk cache is
+	# decoded by a MapTileDecoder thread rather than here, so that the
+	# map can be dragged without waiting for images to be decompressed
+	# or GeoJSON to be parsed. In the meantime we return None, so
+	# the tile is drawn using a substitute from a lower zoom level.
 	def load_tile(self, zoom, x, y, may_download):
-		filename, pending = self.downloader.load_tile(zoom, x, y, may_download)
+		cached, pending = self.downloader.load_tile(zoom, x, y, may_download)
 		if pending:
 			self.missing_tiles[zoom] = self.missing_tiles.get(zoom, 0) + 1
-		if filename is not None:
-			try:
-				return self.tile_class(self, filename, zoom, x, y)
-			except MapTileError as e:
-				self.feedback.debug(1, " %s" % str(e))
+		if cached is not None:
+			if self.containing_map.lazy_tiles:
+				self.decode_tile_async(zoom, x, y, cached, counted=may_download)
+				return None
+			return self.decode_tile(zoom, x, y, cached)
 		return None
 
+	# Create the tile object from the cached data. This may be called
+	# from a decoder thread.
+	def decode_tile(self, zoom, x, y, cached):
+		try:
+			return self.tile_class(self, cached.filename, zoom, x, y, data=cached.data)
+		except MapTileError as e:
+			self.feedback.debug(1, " %s" % str(e))
+			return None
+
+	# Queue a tile for decoding in the background. If counted is true,
+	# the decoded tile counts toward self.missing_tiles just like one
+	# which was downloaded.
+	def decode_tile_async(self, zoom, x, y, cached, counted):
+		key = (zoom, x, y)
+		if key in self.decoding:
+			return
+		self.decoding.add(key)
+		if counted:
+			self.missing_tiles[zoom] = self.missing_tiles.get(zoom, 0) + 1
+		MapTileDecoder.get_decoder().submit(BoundMethodProxy(self.tile_decode_job), zoom, x, y, cached, counted)
+	def tile_decode_job(self, zoom, x, y, cached, counted):
+		tile = self.decode_tile(zoom, x, y, cached)
+		GObject.idle_add(lambda: self.tile_decoded_idle(zoom, x, y, tile, counted), priority=GObject.PRIORITY_HIGH)
+	def tile_decoded_idle(self, zoom, x, y, tile, counted):
+		self.feedback.debug(2, "Tile decoded: %d %d,%d" % (zoom, x, y))
+		key = (zoom, x, y)
+		if key in self.decoding:
+			self.decoding.remove(key)
+			self.ram_cache_store(zoom, x, y, tile)
+		else:			# a fresh copy was downloaded while we decoded the stale one
+			tile = None
+		if counted:
+			self.tile_arrived(zoom, x, y, tile is not None)
+		elif tile is not None:
+			# Probably a substitute for a tile not yet loaded
+			self.redraw_needed = True
+			if self.timer is None:
+				self.timer = GObject.timeout_add(self.tile_wait, self.timer_expired)
+		return False
+
 	# The tile downloader calls this when the tile has been received
 	# and is waiting in the disk cache. Note that it is called from
 	# the downloader thread, so we have to schedual the work
@@ -110,26 +164,44 @@ class MapTileLayerHTTP(MapTileLayer):
 	# these messages will be delivered before redraw requests. If we do
 	# not give them a high priority, then new times will not be added
 	# as we are dragging the map.
-	def tile_loaded_cb(self, *args):
-		GObject.idle_add(lambda: self.tile_loaded_cb_idle(*args), priority=GObject.PRIORITY_HIGH)
-	def tile_loaded_cb_idle(self, zoom, x, y, modified):
+	#
+	# If the tile was modified, we hand it to a decoder thread, which
+	# passes the finished tile object to tile_loaded_cb_idle().
+	def tile_loaded_cb(self, zoom, x, y, modified):
+		if modified:
+			MapTileDecoder.get_decoder().submit(BoundMethodProxy(self.tile_loaded_decode_job), zoom, x, y)
+		else:
+			GObject.idle_add(lambda: self.tile_loaded_cb_idle(zoom, x, y, False), priority=GObject.PRIORITY_HIGH)
+	def tile_loaded_decode_job(self, zoom, x, y):
+		cached = self.containing_map.tile_cache.get(self.tileset.key, zoom, x, y)
+		tile = self.decode_tile(zoom, x, y, cached) if cached is not None else None
+		GObject.idle_add(lambda: self.tile_loaded_cb_idle(zoom, x, y, True, tile), priority=GObject.PRIORITY_HIGH)
+	def tile_loaded_cb_idle(self, zoom, x, y, modified, tile=None):
 		self.feedback.debug(2, "Tile received: %d %d,%d %s" % (zoom, x, y, str(modified)))
 
-		# If the tile was modified, dump it from the RAM cache whether
+		# If the tile was modified, replace it in the RAM cache whether
 		# it is still needed or not.
 		if modified:
-			self.ram_cache_invalidate(zoom, x, y)
+			self.decoding.discard((zoom, x, y))
+			self.ram_cache_store(zoom, x, y, tile)
+
+		self.tile_arrived(zoom, x, y, modified)
+		return False
+
+	# A tile which was counted in self.missing_tiles has been received
+	# or decoded. Decide whether to redraw now or wait for more.
+	def tile_arrived(self, zoom, x, y, changed):
 
 		# If this tile is still needed.
 		if self.tile_in_view(zoom, x, y):
 			self.feedback.debug(5, " Still needed")
 
-			if modified:
+			if changed:
 				self.redraw_needed = True
 
 			# If this is the last tile we were waiting for,
 			self.missing_tiles[zoom] -= 1
-			if self.missing_tiles[zoom] == 0:
+			if self.missing_tiles[zoom] <= 0:
 				self.feedback.debug(5, " All tiles in, immediate redraw")
 
 				# If last tile arrived before timer expired,
@@ -149,6 +221,74 @@ class MapTileLayerHTTP(MapTileLayer):
 				if self.timer == None:
 					self.timer = GObject.timeout_add(self.tile_wait, self.timer_expired)
 
+	# Hook do_viewport() so that the downloader can drop requests for
+	# tiles which have scrolled out of view and download those nearest
+	# the center first. Cancelled tiles are removed from the RAM cache
+	# so that they will be requested again if they come back into view.
+	#
+	# Then queue those tiles which we expect will be needed next for
+	# download at low priority.
+	def do_viewport(self):
+		MapTileLayer.do_viewport(self)
+		if self.tile_ranges is not None and hasattr(self.downloader, "set_view"):
+			center_x, center_y = self.center_tile
+			if self.prefetch and self.containing_map.lazy_tiles:
+				prefetch_ranges = self.get_prefetch_ranges()
+			else:
+				prefetch_ranges = []
+			for zoom, x, y in self.downloader.set_view(self.int_zoom, center_x, center_y, self.tile_ranges, prefetch_ranges):
+				self.ram_cache_invalidate(zoom, x, y)
+			if len(prefetch_ranges) > 0:
+				self.downloader.prefetch(self.prefetch_max, lambda key: key in self.ram_cache)
+
+	# Return a list of (zoom, x_range_start, x_range_end, y_range_start, y_range_end)
+	# of the areas we would like to have in the cache. This is a ring around the
+	# viewport, stretched in the direction in which the map is moving, and the
+	# viewport at the next zoom level in the direction in which it is being zoomed.
+	def get_prefetch_ranges(self):
+		zoom = self.int_zoom
+		x_range_start, x_range_end, y_range_start, y_range_end = self.tile_ranges
+		center_x, center_y = self.center_tile
+		ring = self.prefetch_ring
+		ranges = []
+
+		x_start = x_range_start - ring
+		x_end = x_range_end + ring
+		y_start = y_range_start - ring
+		y_end = y_range_end + ring
+		zoom_trend = 0.0
+		predicted = self.containing_map.motion.predict(self.prefetch_lookahead)
+		if predicted is not None:
+			predicted_x, predicted_y, predicted_zoom = predicted
+			n = 1 << zoom
+			# How far will the center move? (Not more than a viewport.)
+			dx = (predicted_x * n - center_x + n / 2.0) % n - n / 2.0
+			dy = predicted_y * n - center_y
+			dx = max(-(x_range_end - x_range_start), min(x_range_end - x_range_start, dx))
+			dy = max(-(y_range_end - y_range_start), min(y_range_end - y_range_start, dy))
+			x_start = min(x_start, int(math.floor(x_range_start + dx)))
+			x_end = max(x_end, int(math.ceil(x_range_end + dx)))
+			y_start = min(y_start, int(math.floor(y_range_start + dy)))
+			y_end = max(y_end, int(math.ceil(y_range_end + dy)))
+			zoom_trend = predicted_zoom - self.zoom
+		ranges.append((zoom, x_start, x_end, y_start, y_end))
+
+		# The viewport is the same size in tiles at the next zoom level,
+		# but centered on a point twice (or half) as far from the origin.
+		next_zoom = zoom - 1 if zoom_trend < 0.0 else zoom + 1
+		if self.opts.zoom_substitutions is not None:
+			next_zoom = self.opts.zoom_substitutions.get(next_zoom, next_zoom)
+		if next_zoom != zoom and next_zoom >= self.opts.zoom_min and next_zoom <= self.opts.zoom_max:
+			factor = 2.0 ** (next_zoom - zoom)
+			half_width = (x_range_end - x_range_start) / 2.0
+			half_height = (y_range_end - y_range_start) / 2.0
+			ranges.append((next_zoom,
+				int(center_x * factor - half_width), int(center_x * factor + half_width),
+				int(center_y * factor - half_height), int(center_y * factor + half_height)
+				))
+
+		return ranges
+
 	def tile_in_view(self, zoom, x, y):
 		if zoom != self.int_zoom:
 			return False
@@ -171,7 +311,7 @@ class MapTileLayerHTTP(MapTileLayer):
 		if self.tile_ranges is not None:
 			downloader = MapTileDownloader(
 				self.tileset,
-				self.containing_map.tile_cache_basedir,
+				self.containing_map.tile_cache,
 				feedback=progress,
 				delay=0.1
 				)
@@ -189,7 +329,7 @@ class MapTileLayerHTTP(MapTileLayer):
 							progress.progress(count, total,
 								_("Downloading {layer} tile {count} of {total}, zoom level is {zoom}").format(layer=self.name, count=count, total=total, zoom=z)
 								)
-							if downloader.load_tile(z, x, y, True) is None:		# failed
+							if downloader.load_tile(z, x, y, True)[0] is None:		# failed
 								for seconds in range(10, 0, -1):
 									progress.countdown(_("Retry in %d seconds...") % seconds)
 									time.sleep(1.0)
@@ -206,23 +346,71 @@ class MapTileLayerHTTP(MapTileLayer):
 				for y in range(y_range_start, y_range_end+1):
 					self.ram_cache_invalidate(zoom, x, y)
 					# FIXME: should instead queue for revalidation
-					local_filename = "%s/%s/%d/%d/%d" % (self.containing_map.tile_cache_basedir, self.tileset.key, zoom, x, y)
-					try:
-						os.unlink(local_filename)
-					except OSError:
-						pass
+					self.containing_map.tile_cache.remove(self.tileset.key, zoom, x, y)
 		self.cache_surface = None
 
+#=============================================================================
+# Tile decoder
+# Turns tiles from the disk cache into tile objects ready to be drawn.
+# This is done in background threads since decompressing an image or
+# parsing and projecting a GeoJSON tile can take long enough to make
+# the map stutter as it is dragged. The jobs are done last-in-first-out
+# so that the tiles for the latest view are decoded first.
+#=============================================================================
+
+class MapTileDecoder(object):
+	thread_count = 2				# threads shared by all tile layers
+	_decoder = None
+	_decoder_lock = threading.Lock()
+
+	@classmethod
+	def get_decoder(cls):
+		with cls._decoder_lock:
+			if cls._decoder is None:
+				cls._decoder = cls()
+			return cls._decoder
+
+	def __init__(self):
+		self.jobs = queue.LifoQueue()
+		for i in range(self.thread_count):
+			thread = threading.Thread(target=self.run, name="tile-decoder-%d" % i)
+			thread.daemon = True
+			thread.start()
+
+	# Call function(*args) in a decoder thread. The function will generally
+	# be a BoundMethodProxy, so it is not an error if its object is gone.
+	def submit(self, function, *args):
+		self.jobs.put((function, args))
+
+	# Thread body
+	def run(self):
+		while True:
+			function, args = self.jobs.get()
+			try:
+				function(*args)
+			except ReferenceError:
+				pass
+			except Exception:
+				import traceback
+				traceback.print_exc()
+
 #=============================================================================
 # Downloader for getting tiles over HTTP/HTTPS
 # We use the lower-level HTTP library http.client rather than urllib.request
 # because the latter does not support persistent connexions.
+#
+# Each tile layer has a MapTileDownloader. In asyncronous mode it passes
+# its requests to the MapTileDownloadEngine which is shared by all of the
+# layers. The engine has a bounded pool of worker threads, a priority queue
+# of requests (nearest the center of the viewport first), a limited
+# number of keep-alive connexions to each server, and exponential backoff
+# for servers which fail.
 #=============================================================================
 
 class MapTileDownloader(object):
-	def __init__(self, tileset, tile_cache_basedir, done_callback=None, feedback=None, delay=None):
+	def __init__(self, tileset, tile_cache, done_callback=None, feedback=None, delay=None):
 		self.tileset = tileset
-		self.tile_cache_basedir = tile_cache_basedir
+		self.tile_cache = tile_cache
 		self.feedback = feedback
 		self.done_callback = done_callback
 		self.delay = delay
@@ -230,50 +418,38 @@ class MapTileDownloader(object):
 		if feedback is None:
 			raise AssertionError
 
-		# Should we start threads?
-		self.threads = []
-		if self.done_callback:		# multi-threaded mode
-			self.syncer = threading.Condition()
-			self.queue = []
-			for i in range(3):		# number of threads
-				thread = MapTileDownloaderThread(self, name="%s-%d" % (self.tileset.key, i))
-				self.threads.append(thread)
-				thread.start()
-		else:						# syncronous mode
-			self.syncer = None
-			self.queue = None
-			self.threads.append(MapTileDownloaderThread(self, name="%s-dummy" % self.tileset.key))
-
-	# If the indicated tile is in the cache and is not too old, return its path
-	# so that the caller can download it. If it is not, and there is no callback
+		# Viewport as last reported by the tile layer, see set_view()
+		self.view = None
+		self.prefetch_ranges = []
+		self.prefetching = {}		# (zoom, x, y) -> MapTileRequest
+
+		self.engine = MapTileDownloadEngine.get_engine()
+
+	# If the indicated tile is in the cache and is not too old, return it
+	# so that the caller can load it. If it is not, and there is no callback
 	# function, download it immediately. If there is a callback function, put
 	# it in the queue for a background thread the download.
 	#
 	# Returns:
-	#  filename--None if not (yet) available
+	#  cached--MapCachedTile, None if not (yet) available
 	#  pending--True if a callback is to be expected	
 	def load_tile(self, zoom, x, y, may_download):
 		debug_args = (self.tileset.key, zoom, x, y)
 		self.feedback.debug(1, "Load tile %s %d/%d/%d" % debug_args)
-		local_filename = "%s/%s/%d/%d/%d" % (self.tile_cache_basedir, self.tileset.key, zoom, x, y)
+		cached = self.tile_cache.get(self.tileset.key, zoom, x, y)
 		result = None
 
-		try:
-			statbuf = os.stat(local_filename)
-		except OSError:
-			statbuf = None
-
-		if statbuf is None:
+		if cached is None:
 			self.feedback.debug(3, " Not in cache")
 		else:
-			cachefile_age = (float(time.time() - statbuf.st_mtime) / 86400.0)
+			cachefile_age = cached.age_in_days()
 			self.feedback.debug(4, " Cache file age: %s" % cachefile_age)
 			if cachefile_age > self.tileset.max_age_in_days:
 				self.feedback.debug(3, " Old in cache")
-				result = local_filename
+				result = cached
 			else:
 				self.feedback.debug(3, " Fresh in cache")
-				return (local_filename, False)
+				return (cached, False)
 
 		# The caller may want the tile only if it is available instantly.
 		# This is used when using scaled up tiles from a lower zoom level
@@ -282,318 +458,489 @@ class MapTileDownloader(object):
 			self.feedback.debug(2, " Caller does not want to download this tile")
 			return (result, False)
 
-		remote_filename = self.tileset.get_path(zoom, x, y)
 		if self.done_callback:
+			# If we are already prefetching this tile, hurry it along.
+			request = self.prefetching.pop((zoom, x, y), None)
+			if request is not None and self.engine.promote(request, self.done_callback):
+				self.feedback.debug(2, " Already queued for prefetch")
+				return (result, True)
+			request = MapTileRequest(self, zoom, x, y, self.tileset.get_path(zoom, x, y), cached)
 			self.feedback.debug(2, " Added to queue")
-			self.enqueue((zoom, x, y, local_filename, remote_filename, statbuf))
+			self.engine.enqueue(request)
 			return (result, True)
 		else:
 			self.feedback.debug(2, " Downloading syncronously...")
-			if self.threads[0].download_tile_worker(zoom, x, y, local_filename, remote_filename, statbuf):
+			request = MapTileRequest(self, zoom, x, y, self.tileset.get_path(zoom, x, y), cached)
+			if self.engine.download_now(request):
 				if self.delay:
 					time.sleep(self.delay)
-				return (local_filename, False)
+				return (self.tile_cache.get(self.tileset.key, zoom, x, y), False)
 			else:
 				return (None, False)
 
-	# Add an item to the work queue for the background threads
-	def enqueue(self, item, clear=False):
-		self.syncer.acquire()
-		if clear:
-			while len(self.queue):
-				self.queue.pop(0)
-		self.queue.insert(0, item)
-		if item is None:			# None is stop signal
-			self.syncer.notifyAll()
-		else:
-			self.syncer.notify()
-		self.syncer.release()
-
-	# This tile downloader is no longer needed. Shut down the background threads.
+	# The tile layer calls this whenever the viewport changes. Queued
+	# requests for tiles which are no longer in view are cancelled and
+	# the rest are reprioritized. Returns a list of the (zoom, x, y) of
+	# the tiles cancelled so that the layer can forget it asked for them.
+	#
+	# prefetch_ranges is a list of (zoom, x_range_start, x_range_end,
+	# y_range_start, y_range_end) of areas which will probably come into
+	# view soon. Call prefetch() to queue the tiles in them.
+	def set_view(self, zoom, center_x, center_y, tile_ranges, prefetch_ranges=[]):
+		self.view = (zoom, center_x, center_y, tile_ranges)
+		self.prefetch_ranges = prefetch_ranges
+		cancelled = self.engine.update_priorities(self)
+		for key, request in list(self.prefetching.items()):
+			if request.cancelled or request.finished:
+				del self.prefetching[key]
+		return cancelled
+
+	# Queue the tiles in the prefetch ranges, up to the indicated number,
+	# nearest the center of the viewport first. Those which are in view,
+	# already queued, or for which skip((zoom, x, y)) returns True are
+	# left out. The downloader threads get to them only when there
+	# is nothing more urgent to do.
+	def prefetch(self, max_tiles, skip):
+		if self.view is None:
+			return
+		view_zoom, center_x, center_y, tile_ranges = self.view
+		candidates = []
+		for zoom, x_range_start, x_range_end, y_range_start, y_range_end in self.prefetch_ranges:
+			n = 1 << zoom
+			for x in range(x_range_start, x_range_end + 1):
+				for y in range(max(0, y_range_start), min(n - 1, y_range_end) + 1):
+					key = (zoom, x % n, y)
+					if zoom == view_zoom and self._in_range(key[1], y, n, tile_ranges):
+						continue
+					if key in self.prefetching or skip(key):
+						continue
+					candidates.append((self._prefetch_distance(zoom, key[1], y), key))
+		candidates.sort()
+		for distance, key in candidates[:max_tiles]:
+			request = MapTileRequest(self, key[0], key[1], key[2], self.tileset.get_path(*key), None, prefetch=True)
+			self.prefetching[key] = request
+			self.engine.enqueue(request)
+		self.feedback.debug(3, "Prefetching %d of %d tiles" % (min(max_tiles, len(candidates)), len(candidates)))
+
+	# Priority of a request for one of our tiles given the current view.
+	# Lower numbers are downloaded first. Returns None if the tile is
+	# no longer wanted.
+	prefetch_priority = 1000.0			# added to the priority of prefetch requests
+	def priority(self, request):
+		if self.view is None:
+			return 0.0
+		zoom, center_x, center_y, tile_ranges = self.view
+		n = 1 << request.zoom
+		if request.prefetch:
+			for prefetch_range in self.prefetch_ranges:
+				if request.zoom == prefetch_range[0] and self._in_range(request.x, request.y, n, prefetch_range[1:]):
+					return self.prefetch_priority + self._prefetch_distance(request.zoom, request.x, request.y)
+			return None
+		if request.zoom != zoom:
+			return None
+		if not self._in_range(request.x, request.y, n, tile_ranges):
+			return None
+		dx = (request.x + 0.5 - center_x + n / 2.0) % n - n / 2.0	# shortest way around the world
+		dy = request.y + 0.5 - center_y
+		return math.hypot(dx, dy)
+
+	@staticmethod
+	def _in_range(x, y, n, tile_ranges):
+		x_range_start, x_range_end, y_range_start, y_range_end = tile_ranges
+		if (x - x_range_start) % n > (x_range_end - x_range_start):
+			return False
+		return y >= y_range_start and y <= y_range_end
+
+	# Distance of a tile from the center of the viewport in tiles of
+	# the viewport's zoom level
+	def _prefetch_distance(self, zoom, x, y):
+		view_zoom, center_x, center_y, tile_ranges = self.view
+		factor = 2.0 ** (view_zoom - zoom)
+		n = 1 << view_zoom
+		dx = ((x + 0.5) * factor - center_x + n / 2.0) % n - n / 2.0
+		dy = (y + 0.5) * factor - center_y
+		return math.hypot(dx, dy)
+
+	# This tile downloader is no longer needed. Drop its queued requests.
 	def __del__(self):
 		#print("Destroying tile downloader...")
-		if self.queue is not None:
-			# Tell the threads to stop
-			self.enqueue(None, clear=True)
-
-			# Wait for them to stop
-			#for thread in self.threads:
-			#	self.feedback.debug(1, " Waiting for thread %s to stop..." % thread.name)
-			#	thread.join()
-			#self.feedback.debug(1, "All downloader threads have stopped.")
+		self.engine.cancel_owner(self)
+
+# A request to download a tile. Its owner is held by weak reference so
+# that a tile layer which is discarded does not leave its requests
+# in the queue. Prefetch requests are for tiles which are not in view,
+# so no one is waiting for a callback.
+class MapTileRequest(object):
+	__slots__ = ("owner", "tileset", "tile_cache", "feedback", "done_callback", "zoom", "x", "y", "remote_filename", "cached", "hostname", "prefetch", "cancelled", "finished")
+	def __init__(self, owner, zoom, x, y, remote_filename, cached, prefetch=False):
+		self.owner = weakref.ref(owner)
+		self.tileset = owner.tileset
+		self.tile_cache = owner.tile_cache
+		self.feedback = owner.feedback
+		self.done_callback = None if prefetch else owner.done_callback
+		self.prefetch = prefetch
+		self.finished = False
+		self.zoom = zoom
+		self.x = x
+		self.y = y
+		self.remote_filename = remote_filename
+		self.cached = cached					# stale copy from the cache, if any
+		self.hostname = self.tileset.get_rotated_hostname()
+		self.cancelled = False
+	def __str__(self):
+		return "%s %d/%d/%d" % (self.tileset.key, self.zoom, self.x, self.y)
+
+# Keep-alive connexions to one server and its failure record
+class MapTileHost(object):
+	backoff_initial = 2.0			# seconds to wait after first failure
+	backoff_max = 300.0				# seconds
+	def __init__(self, scheme, hostname, max_connections):
+		self.scheme = scheme
+		self.hostname = hostname
+		self.max_connections = max_connections
+		self.idle = []
+		self.busy = 0
+		self.failures = 0
+		self.retry_after = 0.0
+
+	def available(self, now):
+		return self.busy < self.max_connections and now >= self.retry_after
+
+	def checkout(self):
+		self.busy += 1
+		if len(self.idle) > 0:
+			return self.idle.pop()
+		if self.scheme == "https":
+			return http.client.HTTPSConnection(self.hostname, timeout=30)
 		else:
-			if self.threads[0].conn is not None:
-				self.threads[0].conn.close()
+			return http.client.HTTPConnection(self.hostname, timeout=30)
+
+	# Return a connexion to the pool. Pass None if it was closed due to an error.
+	def checkin(self, conn):
+		self.busy -= 1
+		if conn is not None:
+			self.idle.append(conn)
+
+	def succeeded(self):
+		self.failures = 0
+		self.retry_after = 0.0
+
+	def failed(self):
+		self.failures += 1
+		self.retry_after = time.time() + min(self.backoff_max, self.backoff_initial * 2 ** (self.failures - 1))
+
+class MapTileDownloadEngine(object):
+	worker_count = 8				# threads shared by all tile layers
+	connections_per_host = 2		# keep-alive connexions to each (rotated) hostname
+	_engine = None
+	_engine_lock = threading.Lock()
+
+	@classmethod
+	def get_engine(cls):
+		with cls._engine_lock:
+			if cls._engine is None:
+				cls._engine = cls()
+			return cls._engine
+
+	def __init__(self):
+		self.syncer = threading.Condition()
+		self.queue = []					# heap of [priority, serial, request]
+		self.serial = 0
+		self.hosts = {}
+		self.threads = []
+
+	# Add a request to the queue, starting the worker threads if this is the first
+	def enqueue(self, request):
+		priority = request.owner().priority(request)
+		with self.syncer:
+			if len(self.threads) == 0:
+				for i in range(self.worker_count):
+					thread = MapTileDownloaderThread(self, name="tile-downloader-%d" % i)
+					self.threads.append(thread)
+					thread.start()
+			self._push(0.0 if priority is None else priority, request)
+			self.syncer.notify()
+
+	def _push(self, priority, request):
+		self.serial += 1
+		heapq.heappush(self.queue, [priority, self.serial, request])
+
+	# Recompute the priorities of an owner's queued requests, cancelling
+	# those it no longer wants.
+	def update_priorities(self, owner):
+		cancelled = []
+		with self.syncer:
+			queue = []
+			for entry in self.queue:
+				request = entry[2]
+				if request.owner() is None:
+					continue
+				if request.owner() is owner:
+					priority = owner.priority(request)
+					if priority is None:
+						request.cancelled = True
+						if not request.prefetch:
+							cancelled.append((request.zoom, request.x, request.y))
+						continue
+					entry[0] = priority
+				queue.append(entry)
+			heapq.heapify(queue)
+			self.queue = queue
+		for item in cancelled:
+			owner.feedback.debug(3, "Cancelled tile %s %d/%d/%d" % ((owner.tileset.key,) + item))
+		return cancelled
+
+	# A tile which is being prefetched has come into view. Turn the request
+	# into an ordinary one. Returns False if it is too late.
+	def promote(self, request, done_callback):
+		with self.syncer:
+			if request.cancelled or request.finished:
+				return False
+			request.prefetch = False
+			request.done_callback = done_callback
+			for entry in self.queue:
+				if entry[2] is request:
+					priority = request.owner().priority(request)
+					entry[0] = priority if priority is not None else 0.0
+					heapq.heapify(self.queue)
+					break
+			return True
+
+	def cancel_owner(self, owner):
+		with self.syncer:
+			for entry in self.queue:
+				request = entry[2]
+				if request.owner() is owner or request.owner() is None:
+					request.cancelled = True
+
+	def get_host(self, request):
+		key = (request.tileset.url_template.scheme, request.hostname)
+		host = self.hosts.get(key)
+		if host is None:
+			host = self.hosts[key] = MapTileHost(key[0], key[1], self.connections_per_host)
+		return host
+
+	# Called by the worker threads. Wait for the most urgent request whose
+	# server is willing to take it. Returns the request, the server, and a
+	# connexion to it.
+	def next_request(self):
+		with self.syncer:
+			while True:
+				now = time.time()
+				set_aside = []
+				found = None
+				wait = None
+				while len(self.queue) > 0:
+					entry = heapq.heappop(self.queue)
+					request = entry[2]
+					if request.cancelled or request.owner() is None:
+						continue
+					host = self.get_host(request)
+					if host.available(now):
+						found = (request, host, host.checkout())
+						break
+					set_aside.append(entry)
+					if host.retry_after > now:
+						wait = min(wait, host.retry_after - now) if wait is not None else (host.retry_after - now)
+				for entry in set_aside:
+					heapq.heappush(self.queue, entry)
+				if found is not None:
+					return found
+				self.syncer.wait(wait)
+
+	# Called by the worker threads when they are done with a request
+	def request_done(self, request, host, conn, success):
+		with self.syncer:
+			host.checkin(conn)
+			if success:
+				host.succeeded()
+				request.finished = True
+			else:
+				host.failed()
+				request.feedback.debug(3, "Host %s failed %d times, retry after %.1f seconds" % (host.hostname, host.failures, host.retry_after - time.time()))
+				owner = request.owner()
+				if owner is not None and not request.cancelled:
+					# If the tile has gone out of view, the owner will cancel
+					# the request when the viewport next changes.
+					priority = owner.priority(request)
+					self._push(priority if priority is not None else float("inf"), request)
+			self.syncer.notify_all()
+
+	# Download a tile in the calling thread. Used in syncronous mode.
+	def download_now(self, request):
+		with self.syncer:
+			host = self.get_host(request)
+			while host.busy >= host.max_connections:
+				self.syncer.wait()
+			conn = host.checkout()
+		try:
+			success, conn = download_tile_worker(request, conn, "main")
+		except NoInet:
+			self.request_done(request, host, None, False)
+			raise
+		self.request_done(request, host, conn, success)
+		return success
 
 class MapTileDownloaderThread(threading.Thread):
-	def __init__(self, parent, **kwargs):
+	def __init__(self, engine, **kwargs):
 		threading.Thread.__init__(self, **kwargs)
 		self.daemon = True
-		self.feedback = parent.feedback
-		self.conn = None
-		self.syncer = parent.syncer
-		self.queue = parent.queue
-		self.tileset = parent.tileset
-		self.done_callback = parent.done_callback
-		self.rotated_hostname = self.tileset.get_rotated_hostname()
+		self.engine = engine
 
 	# Thread body
 	def run(self):
 		while True:
-			self.syncer.acquire()
-			self.feedback.debug(3, "Thread %s is waiting..." % self.name)
-			while len(self.queue) < 1:
-				self.syncer.wait()
-			item = self.queue[0]
-			if item is not None:
-				self.queue.pop(0)
-			self.feedback.debug(3, "Thread %s received item: %s" % (self.name, str(item)))
-			self.syncer.release()
-			if item is None:				# signal to stop
-				break
-			while True:
-				if self.download_tile_worker(*item):
-					break
-				self.feedback.debug(3, "Thread %s sleeping..." % self.name)
-				time.sleep(10)
-		if self.conn is not None:
-			self.conn.close()
-		self.feedback.debug(2, " Thread %s exiting..." % self.name)
-
-	# Handle one tile request
-	def download_tile_worker(self, zoom, x, y, local_filename, remote_filename, statbuf):
-		self.feedback.debug(2, "Thread %s downloading tile %s %d/%d/%d" % (self.name, self.tileset.key, zoom, x, y))
-		debug_args = (
-			self.tileset.key,
-			"%s://%s%s" % (self.tileset.url_template.scheme, self.rotated_hostname, remote_filename)
-			)
-
-		# Download the tile. This uses a persistent connection.
-		try:
-			# Connect if we are not connected already.
-			if self.conn is None:
-				self.feedback.debug(3, " Thread %s opening HTTP connexion to %s..." % (self.name, self.rotated_hostname))
-				if self.tileset.url_template.scheme == "https":
-					self.conn = http.client.HTTPSConnection(self.rotated_hostname, timeout=30)
-				else:
-					self.conn = http.client.HTTPConnection(self.rotated_hostname, timeout=30)
-
-			# Build the HTTP request headers
-			hdrs = {}
-			hdrs.update(self.tileset.extra_headers)
-			if statbuf is not None:
-				hdrs['If-Modified-Since'] = http_date(statbuf.st_mtime)
-
-			redirect_count = 0
-			while True:
-				# send request
-				self.feedback.debug(3, " GET %s" % remote_filename)
-				self.conn.request("GET", remote_filename, None, hdrs)
-
-				# Read reasponse and if it is not "moved temporarily", break out.
-				response = self.conn.getresponse()
-				if response.status != 302:
-					break
-
-				# This 302 handling has not been tested.
-				response_body = response.read()
-				location = response.getheader("location")
-				print("Redirect to:", location)
-				assert location.startswith("/")		# FIXME
-				redirect_count += 1
-				if redirect_count > 5:
-					self.feedback.error(_("Tile %s %s: Redirect loop") % debug_args)
-					self.conn = None	# close connexion
-					return True			# give up on tile
-				remote_filename = location
-
-		except socket.gaierror as msg:
-			self.feedback.error(_("Tile %s %s: address lookup error: %s") % (debug_args + (msg,)))
-			raise NoInet
-		except socket.error as msg:
-			self.feedback.error(_("Tile %s %s: socket error: %s") % (debug_args + (msg,)))
-			self.conn = None		# close
-			return False
-		except http.client.BadStatusLine:
-			self.feedback.error(_("Tile %s %s: BadStatusLine") % debug_args)
-			self.conn = None		# close
-			return False
-		except http.client.ResponseNotReady:
-			self.feedback.error(_("Tile %s/%s: no response") % debug_args)
-			self.conn = None		# close
-			return False
-
-		content_length = response.getheader("content-length")
-		content_type = response.getheader("content-type")
-		self.feedback.debug(5, "  %s %s response: %d %s %s %s bytes" % (debug_args + (response.status, response.reason, content_type, str(content_length))))
-
-		if response.status == 304:
-			self.feedback.debug(1, "  %s %s: not modified" % debug_args)
-			response.read()					# discard
-			fh = open(local_filename, "a")	# touch
-			fh.close()
-			modified = False
-
-		else:
-			if response.status != 200:
-				self.feedback.debug(1, "  %s %s: unacceptable response status: %d %s" % (debug_args + (response.status, response.reason)))
-				response_body = response.read()
-				if response_body != "" and content_type is not None and content_type.startswith("text/"):
-					self.feedback.debug(1, "%s" % response_body.strip())
-				return True	 				# give up on tile
-
-			if not content_type.startswith("image/") and content_type != "application/json":
-				response_body = response.read()
-				if content_type.startswith("text/"):
-					if response.getheader("content-encoding") == "gzip":
-						response_body = gzip.GzipFile(fileobj=StringIO(response_body)).read()
-					sample = ": %s" % response_body.strip()[:50]
-				else:
-					sample = ""
-				self.feedback.debug(1, "  %s %s: non-image MIME type: %s: %s" % (debug_args + (content_type, sample)))
-				return True	 				# give up on tile
-	
-			if content_length is not None and int(content_length) == 0:
-				self.feedback.debug(1, "  %s %s: empty response" % debug_args)
-				response.read()
-				return True					# give up on tile
-	
-			# Make the cache directory which holds this tile, if it does not exist already.
-			local_dirname = os.path.dirname(local_filename)
-			if not os.path.exists(local_dirname):
-				# This may fail if another thread creates.
-				try:
-					os.makedirs(local_dirname)
-				except OSError as e:
-					if e.errno != errno.EEXIST:
-						raise
-	
-			# Save the file in such a manner that there is never a partial tile with the final name.
-			cachefile = SaveAtomically(local_filename)
-			try:
-				cachefile.write(response.read())
-			except socket.timeout:		# FIXME: socket is sometimes None. Why?
-				self.feedback.debug(1, "  %s %s: Socket timeout" % debug_args)
-				self.feedback.error(_("Timeout during download"))
-				self.conn = None		# close
-				return False
+			request, host, conn = self.engine.next_request()
+			request.feedback.debug(3, "Thread %s received item: %s" % (self.name, str(request)))
+			success, returned_conn = (False, None)
 			try:
-				cachefile.close()
-			except OSError as e:
-				print("FIXME: OSError: %d" % e.errno)
-
-			modified = True
-	
-		# Tell the tile layer that the tile is ready so that it can redraw.
-		if self.done_callback:
-			try:
-				self.done_callback(zoom, x, y, modified)
-			except ReferenceError:
-				self.feedback.debug(1, " Thread %s misses tile layer" % self.name)
-
-		return True
+				success, returned_conn = download_tile_worker(request, conn, self.name)
+			except NoInet:
+				pass
+			finally:
+				self.engine.request_done(request, host, returned_conn, success)
+
+# Handle one tile request using the supplied connexion. Returns True if the
+# request has been dealt with (even if we had to give up on the tile) or
+# False if it should be retried. Also returns the connexion, or None
+# if it had to be closed.
+def download_tile_worker(request, conn, thread_name):
+	feedback = request.feedback
+	tileset = request.tileset
+	zoom, x, y = request.zoom, request.x, request.y
+	remote_filename = request.remote_filename
+
+	# We did not look in the cache before queuing a prefetch request.
+	if request.prefetch:
+		cached = request.tile_cache.get(tileset.key, zoom, x, y)
+		if cached is not None and cached.age_in_days() <= tileset.max_age_in_days:
+			feedback.debug(3, "Thread %s: tile %s %d/%d/%d already cached" % (thread_name, tileset.key, zoom, x, y))
+			tile_done(request, False, thread_name)
+			return (True, conn)
+		request.cached = cached
+	cached = request.cached
+
+	feedback.debug(2, "Thread %s downloading tile %s %d/%d/%d" % (thread_name, tileset.key, zoom, x, y))
+	debug_args = (
+		tileset.key,
+		"%s://%s%s" % (tileset.url_template.scheme, request.hostname, remote_filename)
+		)
+
+	# Download the tile. This uses a persistent connection.
+	try:
+		# Build the HTTP request headers
+		hdrs = {}
+		hdrs.update(tileset.extra_headers)
+		if cached is not None:
+			hdrs['If-Modified-Since'] = cached.last_modified or http_date(cached.fetched)
+			if cached.etag is not None:
+				hdrs['If-None-Match'] = cached.etag
+
+		redirect_count = 0
+		while True:
+			# send request
+			feedback.debug(3, " GET %s" % remote_filename)
+			conn.request("GET", remote_filename, None, hdrs)
 
-#=============================================================================
-# Clean the tile cache created by MapTileDownloader
-#=============================================================================
-class MapCacheCleaner(threading.Thread):
-	def __init__(self, cache_root, scan_interval=30, max_age=180):
-		threading.Thread.__init__(self, name="cache-cleaner")
-		self.daemon = True
-		self.cache_root = cache_root
-		day = 24 * 60 * 60
+			# Read reasponse and if it is not "moved temporarily", break out.
+			response = conn.getresponse()
+			if response.status != 302:
+				break
 
-		# Scan a tileset's cache if it was last scanned before this date.
-		self.scan_if_before = time.time() - scan_interval * day
+			# This 302 handling has not been tested.
+			response_body = response.read()
+			location = response.getheader("location")
+			print("Redirect to:", location)
+			assert location.startswith("/")		# FIXME
+			redirect_count += 1
+			if redirect_count > 5:
+				feedback.error(_("Tile %s %s: Redirect loop") % debug_args)
+				conn.close()
+				return (True, None)		# give up on tile
+			remote_filename = location
+
+	except socket.gaierror as msg:
+		feedback.error(_("Tile %s %s: address lookup error: %s") % (debug_args + (msg,)))
+		conn.close()
+		raise NoInet
+	except socket.error as msg:
+		feedback.error(_("Tile %s %s: socket error: %s") % (debug_args + (msg,)))
+		conn.close()
+		return (False, None)
+	except http.client.BadStatusLine:
+		feedback.error(_("Tile %s %s: BadStatusLine") % debug_args)
+		conn.close()
+		return (False, None)
+	except http.client.ResponseNotReady:
+		feedback.error(_("Tile %s/%s: no response") % debug_args)
+		conn.close()
+		return (False, None)
+
+	content_length = response.getheader("content-length")
+	content_type = response.getheader("content-type")
+	feedback.debug(5, "  %s %s response: %d %s %s %s bytes" % (debug_args + (response.status, response.reason, content_type, str(content_length))))
+
+	if response.status == 304:
+		feedback.debug(1, "  %s %s: not modified" % debug_args)
+		response.read()					# discard
+		request.tile_cache.touch(tileset.key, zoom, x, y)
+		modified = False
+
+	else:
+		if response.status != 200:
+			feedback.debug(1, "  %s %s: unacceptable response status: %d %s" % (debug_args + (response.status, response.reason)))
+			response_body = response.read()
+			if response_body != "" and content_type is not None and content_type.startswith("text/"):
+				feedback.debug(1, "%s" % response_body.strip())
+			return (True, conn)	 		# give up on tile
+
+		if not content_type.startswith("image/") and content_type != "application/json":
+			response_body = response.read()
+			if content_type.startswith("text/"):
+				if response.getheader("content-encoding") == "gzip":
+					response_body = gzip.GzipFile(fileobj=BytesIO(response_body)).read()
+				sample = ": %s" % response_body.strip()[:50]
+			else:
+				sample = ""
+			feedback.debug(1, "  %s %s: non-image MIME type: %s: %s" % (debug_args + (content_type, sample)))
+			return (True, conn)	 		# give up on tile
 
-		# Delete tiles last used before this date.
-		self.delete_if_before = time.time() - max_age * day
+		if content_length is not None and int(content_length) == 0:
+			feedback.debug(1, "  %s %s: empty response" % debug_args)
+			response.read()
+			return (True, conn)			# give up on tile
 
-		# Sleep in seconds after processing each directory within a tileset's
-		# cache. We do this so as not to hit the disk too hard.
-		self.directory_delay = 0.2
+		try:
+			response_body = response.read()
+		except socket.timeout:		# FIXME: socket is sometimes None. Why?
+			feedback.debug(1, "  %s %s: Socket timeout" % debug_args)
+			feedback.error(_("Timeout during download"))
+			conn.close()
+			return (False, None)
 
-		# Sleep in seconds after scanning each tileset.
-		self.tileset_delay = 90
+		request.tile_cache.put(tileset.key, zoom, x, y, response_body, response.getheader("etag"), response.getheader("last-modified"))
 
-	def run(self):
-		time.sleep(5)		# wait until after startup
-		print("Cache cleaner: starting")
-
-		tilesets = []
-		tilesets_count = 0
-		for tileset in os.listdir(self.cache_root):
-			tilesets_count += 1
-			touchfile = os.path.join(self.cache_root, tileset, ".last-cleaned")
-			if os.path.exists(touchfile):
-				statbuf = os.stat(touchfile)
-				if statbuf.st_mtime < self.scan_if_before:
-					#print("Cache cleaner: %s due for cleaning" % tileset)
-					tilesets.append(tileset)
-				else:
-					#print("Cache cleaner: %s cleaned too recently" % tileset)
-					pass
-			else:
-				#print("Cache cleaner: %s never cleaned" % tileset)
-				tilesets.append(tileset)
-		print("Cache cleaner: %d of %d tilesets need cleaning" % (len(tilesets), tilesets_count))
-
-		random.shuffle(tilesets)
-
-		for tileset in tilesets:
-			cachedir = os.path.join(self.cache_root, tileset)
-			touchfile = os.path.join(cachedir, ".last-cleaned")
-
-			print("Cache cleaner: cleaning %s..." % tileset)
-			total = 0
-			deleted = 0
-			for dirpath, dirnames, filenames in os.walk(cachedir, topdown=False):
-				#print dirpath, dirnames, filenames
-				left = 0
-				for filename in filenames:
-					filepath = os.path.join(dirpath, filename)
-					statbuf = os.stat(filepath)
-					if statbuf.st_atime < self.delete_if_before:
-						deleted += 1
-						os.unlink(filepath)
-					else:
-						left += 1
-					total += 1
-				for dirname in dirnames:
-					path = os.path.join(dirpath, dirname)
-					#print("rmdir(\"%s\")" % path)
-					try:
-						os.rmdir(path)
-					except OSError:
-						#print("  Not empty")
-						pass
-				time.sleep(self.directory_delay)
-
-			print("Cache cleaner: %d of %d tiles removed from %s" % (deleted, total, tileset))
-			if deleted == total:
-				print("Cache cleaner: removing empty cache %s..." % tileset)
-				if os.path.exists(touchfile):
-					os.unlink(touchfile)
-				os.rmdir(cachedir)
-			else:
-				open(touchfile, "w")
+		modified = True
 
-			time.sleep(self.tileset_delay)
+	tile_done(request, modified, thread_name)
+	return (True, conn)
 
-		print("Cache cleaner: finished")
+# Tell the tile layer that the tile is ready so that it can redraw.
+def tile_done(request, modified, thread_name):
+	if request.done_callback:
+		try:
+			request.done_callback(request.zoom, request.x, request.y, modified)
+		except ReferenceError:
+			request.feedback.debug(1, " Thread %s misses tile layer" % thread_name)
 
 # Substitute for MapTileDownloader() for use when the map is in offline mode.
 class MapTileCacheLoader(object):
-	def __init__(self, tileset, tile_cache_basedir, feedback=None):
+	def __init__(self, tileset, tile_cache, feedback=None):
 		self.tileset = tileset
-		self.tile_cache_basedir = tile_cache_basedir
+		self.tile_cache = tile_cache
 		self.feedback = feedback
 
 	def load_tile(self, zoom, x, y, may_download):
 		self.feedback.debug(1, "Load tile %s %d/%d/%d" % (self.tileset.key, zoom, x, y))
-		local_filename = "%s/%s/%d/%d/%d" % (self.tile_cache_basedir, self.tileset.key, zoom, x, y)
-		if os.path.exists(local_filename):
-			return (local_filename, False)
-		else:
-			return (None, False)
+		return (self.tile_cache.get(self.tileset.key, zoom, x, y), False)
 
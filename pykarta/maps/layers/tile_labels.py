@@ -0,0 +1,213 @@
+# encoding=utf-8
+# pykarta/maps/layers/tile_labels.py
+# Copyright 2026, Trinity College
+# Last modified: 17 October 2026
+
+import math
+
+#=============================================================================
+# Label placement across the tiles of a layer
+#
+# Vector tiles choose candidate positions for their labels (road names,
+# highway shields, place names, etc.) when they are loaded. Each candidate
+# has a priority and a set of boxes which it will cover on the screen.
+# When the layer is drawn, it hands all of its tiles to a MapLabelPlacer
+# which accepts candidates in order of priority, rejecting those which
+# would overlap a label already accepted (from this tile or any other)
+# or which would repeat the same text too close to an earlier copy.
+#
+# The accepted boxes are kept in a grid of cells so that each candidate
+# is tested only against those nearby. The results are kept from one
+# frame to the next. When the map is panned, only the candidates of
+# newly arrived tiles need be tested. Labels already on the screen stay
+# where they are. Everything is placed afresh only if the scale changes.
+#=============================================================================
+
+# A label which a tile would like to draw
+class MapLabel(object):
+	__slots__ = ("text", "priority", "x", "y", "boxes", "min_scale", "draw_function", "draw_args")
+	def __init__(self, text, priority, x, y, boxes, draw_function, *draw_args, **kwargs):
+		self.text = text					# for preventing repeats, None to allow them
+		self.priority = priority			# higher numbers win
+		self.x = x							# anchor point in tile pixels
+		self.y = y
+		self.boxes = boxes					# (x1, y1, x2, y2) in screen pixels relative to anchor
+		self.min_scale = kwargs.get("min_scale", 0.0)
+		self.draw_function = draw_function	# called as draw_function(ctx, x, y, *draw_args)
+		self.draw_args = draw_args
+
+	# Boxes for a label of the indicated size centered on the anchor
+	@staticmethod
+	def box(width, height):
+		half_width = width / 2.0
+		half_height = height / 2.0
+		return [(-half_width, -half_height, half_width, half_height)]
+
+	# Boxes for a line of text of the indicated length and height centered
+	# on the anchor and rotated by angle (in radians). Rather than one
+	# large box around the whole thing, it is covered by a row of squares.
+	@staticmethod
+	def rotated_boxes(width, height, angle):
+		count = max(1, int(math.ceil(width / height)))
+		step = width / count
+		dx = math.cos(angle)
+		dy = math.sin(angle)
+		half_height = height / 2.0
+		boxes = []
+		for i in range(count):
+			offset = step * (i + 0.5) - width / 2.0
+			x = offset * dx
+			y = offset * dy
+			boxes.append((x - half_height, y - half_height, x + half_height, y + half_height))
+		return boxes
+
+class MapLabelPlacer(object):
+	cell_size = 64					# screen pixels
+	repeat_distance = 256			# minimum screen pixels between labels with the same text
+
+	def __init__(self):
+		self.scale = None
+		self.zoom = None
+		self.tiles = {}				# (zoom, x, y) -> (tile, accepted labels, rejected labels)
+		self.grid = {}				# (cell x, cell y) -> list of boxes in world pixels
+		self.texts = {}				# text -> list of anchor positions in world pixels
+
+	def clear(self):
+		self.tiles = {}
+		self.grid = {}
+		self.texts = {}
+
+	# Place the labels of tiles, a list of (zoom, x, y, xpixoff, ypixoff, tile)
+	# (where tile may be None), and draw those accepted. The layer is drawn
+	# at zoom and scale. A tile from a lower zoom level may stand in for
+	# tiles which have not been loaded yet. It is drawn enlarged, and so
+	# are the positions of its labels. It should be listed only once, with
+	# (xpixoff, ypixoff) at its top left corner. The ctx should not be
+	# translated to any tile.
+	def draw(self, ctx, tiles, zoom, scale):
+		self.update(tiles, zoom, scale)
+		for tile_zoom, x, y, xpixoff, ypixoff, tile in tiles:
+			item = self.tiles.get((tile_zoom, x, y))
+			if item is None:
+				continue
+			tile_scale = self._tile_scale(tile_zoom)
+			for label in item[1]:
+				label.draw_function(ctx, xpixoff + label.x * tile_scale, ypixoff + label.y * tile_scale, *label.draw_args)
+
+	def update(self, tiles, zoom, scale):
+		if scale != self.scale or zoom != self.zoom:
+			self.clear()
+			self.scale = scale
+			self.zoom = zoom
+
+		# Forget the tiles which have left the screen or been replaced
+		visible = {}
+		for tile_zoom, x, y, xpixoff, ypixoff, tile in tiles:
+			if tile is not None:
+				visible[(tile_zoom, x, y)] = tile
+		removed = []
+		for key in list(self.tiles.keys()):
+			if visible.get(key) is not self.tiles[key][0]:
+				self._remove(key)
+				removed.append(self._area(key))
+
+		# Collect the candidates which have not been tried. Labels which
+		# tiles next to one whose labels were removed rejected before may
+		# now fit. (No label reaches further than the next tile.)
+		candidates = []
+		for key, tile in visible.items():
+			item = self.tiles.get(key)
+			if item is None:
+				item = self.tiles[key] = (tile, [], [])
+				labels = tile.get_labels()
+			elif self._near(self._area(key), removed):
+				labels = list(item[2])
+				del item[2][:]
+			else:
+				continue
+			for label in labels:
+				candidates.append((label, key, item))
+		if len(candidates) == 0:
+			return
+
+		candidates.sort(key=lambda candidate: candidate[0].priority, reverse=True)
+		for label, key, item in candidates:
+			if self._try(label, key):
+				item[1].append(label)
+			else:
+				item[2].append(label)
+
+	# Scale at which a tile of the indicated zoom level is drawn
+	def _tile_scale(self, tile_zoom):
+		return self.scale * (1 << (self.zoom - tile_zoom))
+
+	# Area covered by a tile in units of tiles of the layer's zoom level
+	def _area(self, key):
+		factor = 1 << (self.zoom - key[0])
+		return (key[1] * factor, key[2] * factor, (key[1] + 1) * factor, (key[2] + 1) * factor)
+
+	# Does the area overlap or touch any of the others?
+	def _near(self, area, others):
+		for other in others:
+			if area[0] <= other[2] and other[0] <= area[2] and area[1] <= other[3] and other[1] <= area[3]:
+				return True
+		return False
+
+	# Position of a label anchor in pixels from the corner of the world
+	def _world_position(self, label, key):
+		tile_scale = self._tile_scale(key[0])
+		return ((key[1] * 256 + label.x) * tile_scale, (key[2] * 256 + label.y) * tile_scale)
+
+	def _cells(self, box):
+		cell_size = self.cell_size
+		for cx in range(int(math.floor(box[0] / cell_size)), int(math.floor(box[2] / cell_size)) + 1):
+			for cy in range(int(math.floor(box[1] / cell_size)), int(math.floor(box[3] / cell_size)) + 1):
+				yield (cx, cy)
+
+	def _world_boxes(self, label, x, y):
+		return [(x + box[0], y + box[1], x + box[2], y + box[3]) for box in label.boxes]
+
+	# Accept the label if there is room for it
+	def _try(self, label, key):
+		if self._tile_scale(key[0]) < label.min_scale:
+			return False
+		x, y = self._world_position(label, key)
+
+		if label.text is not None:
+			limit = self.repeat_distance * self.repeat_distance
+			for x2, y2 in self.texts.get(label.text, ()):
+				if (x2 - x) * (x2 - x) + (y2 - y) * (y2 - y) < limit:
+					return False
+
+		boxes = self._world_boxes(label, x, y)
+		grid = self.grid
+		for box in boxes:
+			for cell in self._cells(box):
+				for box2 in grid.get(cell, ()):
+					if box[0] < box2[2] and box2[0] < box[2] and box[1] < box2[3] and box2[1] < box[3]:
+						return False
+
+		for box in boxes:
+			for cell in self._cells(box):
+				grid.setdefault(cell, []).append(box)
+		if label.text is not None:
+			self.texts.setdefault(label.text, []).append((x, y))
+		return True
+
+	# Take the labels of a tile out of the grid
+	def _remove(self, key):
+		tile, accepted, rejected = self.tiles.pop(key)
+		grid = self.grid
+		for label in accepted:
+			x, y = self._world_position(label, key)
+			for box in self._world_boxes(label, x, y):
+				for cell in self._cells(box):
+					boxes = grid[cell]
+					boxes.remove(box)
+					if len(boxes) == 0:
+						del grid[cell]
+			if label.text is not None:
+				positions = self.texts[label.text]
+				positions.remove((x, y))
+				if len(positions) == 0:
+					del self.texts[label.text]
@@ -1,8 +1,8 @@
 # encoding=utf-8
 # pykarta/maps/layers/tile_rndr_geojson.py
 # Base class for GeoJSON vector tile renderers
-# Copyright 2013--2018, Trinity College
-# Last modified: 30 May 2018
+# Copyright 2013--2026, Trinity College
+# Last modified: 18 October 2026
 
 
 try:
@@ -14,45 +14,62 @@ import os
 import math
 import time
 import re
+import threading
+from collections import OrderedDict
+import cairo
 
-from pykarta.geometry.projection import project_to_tilespace_pixel
+from pykarta.geometry.projection import project_geojson_tilespace_pixels, project_geojson_lines_tilespace_pixels
 from pykarta.geometry import Polygon
-from pykarta.draw import place_line_label, place_line_shields, polygon as draw_polygon, line_string as draw_line_string, line_string as draw_line_string, stroke_with_style, fill_with_style
-
-def json_loader(filename):
+from pykarta.geometry.simplify import line_simplify_levels, line_simplify_filter
+from pykarta.geometry.polylabel import polylabel
+from pykarta.formats.mvt import mvt_decode
+from pykarta.formats.geojson_reader import GeojsonReader, GeojsonCollection, GeojsonFeature
+from pykarta.draw import place_line_label, place_line_shields, polygon as draw_polygon, line_string as draw_line_string, line_string as draw_line_string, stroke_with_style, fill_with_style, zoom_width, StyleTable
+
+# Load a tile, possibly gzipped, from a file or from bytes. GeoJSON is
+# parsed into Python objects. A Mapbox Vector Tile (which can be
+# recognized by its first byte) is decoded into a dict of GeoJSON
+# FeatureCollections with coordinates in tile pixels.
+def json_loader(filename, data=None):
+	if data is None:
+		with open(filename, "rb") as f:
+			data = f.read()
+	if data[:2] == b"\x1f\x8b":
+		data = gzip.decompress(data)
+	if len(data) == 0 or data[:1] == b"\x1a":
+		return mvt_decode(data)
+	return json.loads(data)
+
+# Load a tile like json_loader() does, but yield (name, FeatureCollection)
+# for each of its layers. If the tile is a single FeatureCollection, name
+# is None. GeoJSON is not parsed all at once but read incrementally by
+# GeojsonReader, so the collections are GeojsonCollections, the features
+# of which must be consumed in order.
+def tile_layers(filename, data=None):
+	reader = GeojsonReader(data=data, filename=filename)
 	try:
-		f = gzip.GzipFile(filename, "rb")
-		parsed_json = json.load(f)
-	except IOError:
-		f = open(filename, "r")
-		parsed_json = json.load(f)
-	return parsed_json
-
-def _project_to_tilespace_pixels(coordinates, zoom, xtile, ytile):
-	return [project_to_tilespace_pixel(p[1], p[0], zoom, xtile, ytile) for p in coordinates]
-
-# This is twice as fast as the above.
-def project_to_tilespace_pixels(coordinates, zoom, xtile, ytile):
-	n = 2.0 ** zoom
-	nx2 = 2.0 / n
-	nx360 = 360.0 / n
-	radians = math.radians
-	log = math.log
-	tan = math.tan
-	cos = math.cos
-	pi = math.pi
-	return [
-		(
-			((lon + 180.0) / nx360 - xtile) * 256.0,
-			(((1.0 - log(tan(radians(lat)) + (1 / cos(radians(lat)))) / pi) / nx2) - ytile) * 256.0
-			)
-		for lon, lat in coordinates]
+		if reader.is_json():
+			for item in reader.collections():
+				yield item
+			return
+	finally:
+		reader.close()
+	parsed_json = json_loader(filename, data)
+	if "type" in parsed_json:
+		yield (None, parsed_json)
+	else:
+		for item in parsed_json.items():
+			yield item
+
+# For the benefit of older renderers
+project_to_tilespace_pixels = project_geojson_tilespace_pixels
 
 # Base class for a tile which renders GeoJSON
 class MapGeoJSONTile(object):
 	draw_passes = 1					# draw1(), override for draw2(), etc.
 	clip = None						# None for no clipping, or number of pixels beyond tile border
 	sort_key = None
+	simplify = 0.5					# tolerance in pixels for simplifying lines and polygons as drawn, None to disable
 
 	label_lines = False
 	label_polygons = False
@@ -60,37 +77,54 @@ class MapGeoJSONTile(object):
 	timing_load = False				# Option: Time the loading routines and print the results
 	timing_draw = False				# Option: Time the drawing routines and print the results
 
+	record_passes = True			# replay the drawing of each pass, see draw()
+
 	def __init__(self, layer, filename, zoom, x, y, data=None):
 		self.zoom = zoom								# zoom, x, y of tile to load
 		self.x = x
 		self.y = y
 
 		self.tileset = layer.tileset
-		self.dedup = layer.dedup
 		self.containing_map = layer.containing_map
 
 		self.points = []
 		self.lines = []
 		self.polygons = []
 
+		self.style_table = self.get_style_table()
+
+		self.simplify_levels = {}		# (features is self.polygons, index) -> levels
+
+		self.recordings = {}			# draw_pass -> cairo.RecordingSurface
+		self.recordings_scale = None
+
 		self.line_labels = []
 		self.line_shields = []
 		self.polygon_labels = []
+		self.labels = []				# MapLabel objects for the layer's label placer
 
-		# Load the data, uncompress it, and parse the JSON into Python objects
+		# Load the data and uncompress it. Unless it is already parsed, this
+		# gives us a reader from which load_geojson() will take the features.
 		if self.timing_load:
-			self._elapsed_start("Parsing %s %s %d %d %d..." % (layer.tileset.key, type(self).__name__, zoom, x, y))
-		if data is not None:
-			parsed_json = data
+			self._elapsed_start("Loading %s %s %d %d %d..." % (layer.tileset.key, type(self).__name__, zoom, x, y))
+		if isinstance(data, (GeojsonCollection, dict)):	# already parsed
+			layers = None
+			geojson = data
 		else:
-			parsed_json = json_loader(filename)
+			# A vector tile has named layers. This renderer wants just one.
+			layers = tile_layers(filename, data)
+			geojson = {"type": "FeatureCollection", "features": []}
+			for name, geojson in layers:
+				break
+
+		# Interpret the features as GeoJSON
+		self.load_geojson(geojson)
+		if layers is not None:
+			layers.close()
 
 		if self.timing_load:
 			self._elapsed()
 
-		# Interpret the JSON (now in the form of Python dicts and lists) as GeoJSON
-		self.load_geojson(parsed_json)
-
 		if self.label_lines:
 
 			# Place text labels along lines
@@ -114,112 +148,189 @@ class MapGeoJSONTile(object):
 						tile_level_dedup.add(ref)
 
 		if self.label_polygons:
-			polygon_labels = self.polygon_labels
 			if zoom >= 13:
-				for id, polygon, properties, style in self.polygons:
-					label_text = self.choose_polygon_label_text(properties)
-					if label_text is not None:
-						# See ../../../tests/polygon_labeling_test.py for an example where this fails.
-						#polygon_obj = Polygon(polygon)
-						#area = polygon_obj.area()
-						#label_center = polygon_obj.choose_label_center()
-
-						# For now we will compute a bounding box and put the label at the center.
-						min_x = 255
-						max_x = 0
-						min_y = 255
-						max_y = 0
-						for x, y in polygon:
-							min_x = min(min_x, x)
-							max_x = max(max_x, x)
-							min_y = min(min_y, y)
-							max_y = max(max_y, y)
-						area = ((max_x - min_x) * (max_y - min_y))
-						label_center = ((max_x + min_x) / 2, (max_y + min_y) / 2)
-
-						polygon_labels.append((id, area, label_center, label_text))
+				self.place_polygon_labels()
+
+		self.choose_labels()
+
+	# Rough estimate of the RAM used by this tile's Python objects
+	bytes_per_point = 120			# tuple of two floats plus list slot
+	bytes_per_feature = 500			# feature tuple, properties, style
+	def get_memory_size(self):
+		size = 0
+		for features in (self.lines, self.polygons):
+			for feature in features:
+				size += self.bytes_per_feature + len(feature[1]) * self.bytes_per_point
+		size += len(self.points) * (self.bytes_per_feature + self.bytes_per_point)
+		size += (len(self.line_labels) + len(self.line_shields) + len(self.polygon_labels) + len(self.labels)) * self.bytes_per_feature
+		return size
+
+	# Override this to turn the label positions chosen above into MapLabel
+	# objects in self.labels. Rather than drawing them in one of its passes,
+	# the tile leaves it to the layer which places the labels of all of
+	# the tiles on the screen together so that they do not overlap.
+	def choose_labels(self):
+		pass
+
+	def get_labels(self):
+		return self.labels
 
 	def get_highway_refs(self, properties):
 		for ref in re.split(r'\s*;\s*', properties.get('ref','')):
 			if ref != "":
 				yield ref
 
+	# Label positions of polygons found before, keyed by tileset, tile,
+	# and feature id, so that they need not be found again if the tile
+	# is dropped from the RAM cache and loaded again.
+	label_center_cache = OrderedDict()
+	label_center_cache_max = 10000
+	label_center_cache_lock = threading.Lock()
+
+	# Put the label of each polygon at its pole of inaccessibility, the point
+	# inside it farthest from its border. The rings of a feature are taken
+	# together, so the label will not land in a hole and will go in the
+	# roomiest part of a MultiPolygon.
+	def place_polygon_labels(self):
+		features = OrderedDict()
+		i = 0
+		for id, polygon, properties, style in self.polygons:
+			key = id if id is not None else ("ring", i)
+			if key in features:
+				features[key][1].append(polygon)
+			else:
+				features[key] = (id, [polygon], properties)
+			i += 1
+
+		cache = self.label_center_cache
+		for key, (id, rings, properties) in features.items():
+			label_text = self.choose_polygon_label_text(properties)
+			if label_text is None:
+				continue
+			cache_key = (self.tileset.key, type(self).__name__, self.zoom, self.x, self.y, id) if id is not None else None
+			with self.label_center_cache_lock:
+				item = cache.get(cache_key)
+				if item is not None:
+					cache.move_to_end(cache_key)
+			if item is None:
+				area = 0
+				for ring in rings:
+					xs = [point[0] for point in ring]
+					ys = [point[1] for point in ring]
+					area = max(area, (max(xs) - min(xs)) * (max(ys) - min(ys)))
+				label_center, distance = polylabel(rings, precision=1.0)
+				item = (area, label_center)
+				if cache_key is not None:
+					with self.label_center_cache_lock:
+						cache[cache_key] = item
+						if len(cache) > self.label_center_cache_max:
+							cache.popitem(last=False)
+			self.polygon_labels.append((id, item[0], item[1], label_text))
+
 	def choose_line_label_text(self, properties):
 		return properties.get('name')
 
 	def choose_polygon_label_text(self, properties):
 		return properties.get('name')
 
+	# The geojson argument is a FeatureCollection, either as Python objects
+	# or as a GeojsonCollection which is still being read. The style of
+	# each feature is chosen before its geometry is looked at, so the
+	# geometries of features which are not drawn are never parsed.
+	#
+	# The coordinates are collected as the features are read and then
+	# projected to tile pixels in a single batch. If the FeatureCollection
+	# has the member "tile_pixels" (as those from vector tiles do), they
+	# are in tile pixels already.
 	def load_geojson(self, geojson):
 		points = self.points
 		lines = self.lines
 		polygons = self.polygons
+		points_start = len(points)
+		lines_start = len(lines)
+		polygons_start = len(polygons)
 
-		assert geojson['type'] == 'FeatureCollection'
-		features = geojson['features']
-		if self.sort_key is not None:
-			features = sorted(features, key=lambda feature: feature['properties'][self.sort_key])
+		if isinstance(geojson, GeojsonCollection):
+			features = geojson
+		else:
+			assert geojson['type'] == 'FeatureCollection'
+			features = [GeojsonFeature.from_dict(feature) for feature in geojson['features']]
+		choosers = {
+			'Point': self.choose_point_style,
+			'LineString': self.choose_line_style,
+			'MultiLineString': self.choose_line_style,
+			'Polygon': self.choose_polygon_style,
+			'MultiPolygon': self.choose_polygon_style,
+			}
 
 		for feature in features:
-			assert feature['type'] == 'Feature'
-			id = feature.get('id', None)
-			properties = feature['properties']
-			geometry = feature['geometry']
+			id = feature.id
+			properties = feature.properties
 
-			if geometry["type"] == 'GeometryCollection':
-				geometries = geometry["geometries"]
+			if feature.geometry_type == 'GeometryCollection':
+				geometries = [(geometry.get('type'), geometry) for geometry in feature.geometry()["geometries"]]
 			else:
-				geometries = [geometry]
+				geometries = [(feature.geometry_type, None)]
+
+			for geometry_type, geometry in geometries:
+				chooser = choosers.get(geometry_type)
+				if chooser is None:
+					print("Warning: unimplemented geometry type:", geometry_type, properties)
+					continue
+
+				style = chooser(properties)
+				if style is None:
+					continue
 
-			for geometry in geometries:
-				geometry_type = geometry['type']
-	
+				if geometry is None:
+					geometry = feature.geometry()
 				try:
 					coordinates = geometry['coordinates']
 				except KeyError:
-					print("Warning: broken geometry:", feature)
+					print("Warning: broken geometry:", properties)
 					continue
-	
+
 				if geometry_type == 'Point':
-					style = self.choose_point_style(properties)
-					if style is not None:
-						point = project_to_tilespace_pixel(coordinates[1], coordinates[0], self.zoom, self.x, self.y)
-						points.append((id, point, properties, style))
-					continue
-	
-				if geometry_type == 'LineString':
-					style = self.choose_line_style(properties)
-					if style is not None:
-						line = project_to_tilespace_pixels(coordinates, self.zoom, self.x, self.y)
-						lines.append((id, line, properties, style))
-					continue
-	
-				if geometry_type == 'MultiLineString':
-					style = self.choose_line_style(properties)
-					if style is not None:
-						for coordinates2 in coordinates:
-							line = project_to_tilespace_pixels(coordinates2, self.zoom, self.x, self.y)
-							lines.append((id, line, properties, style))
-					continue
-	
-				if geometry_type == 'Polygon':
-					style = self.choose_polygon_style(properties)
-					if style is not None:
-						for coordinates2 in coordinates:
-							polygon = project_to_tilespace_pixels(coordinates2, self.zoom, self.x, self.y)
-							polygons.append((id, polygon, properties, style))
-					continue
-	
-				if geometry_type == 'MultiPolygon':
-					style = self.choose_polygon_style(properties)
-					if style is not None:
-						for coordinates2 in coordinates:
-							for coordinates3 in coordinates2:
-								polygon = project_to_tilespace_pixels(coordinates3, self.zoom, self.x, self.y)
-								polygons.append((id, polygon, properties, style))
-					continue
-	
-				print("Warning: unimplemented geometry type:", feature)
+					points.append((id, coordinates, properties, style))
+				elif geometry_type == 'LineString':
+					lines.append((id, coordinates, properties, style))
+				elif geometry_type == 'MultiLineString':
+					for coordinates2 in coordinates:
+						lines.append((id, coordinates2, properties, style))
+				elif geometry_type == 'Polygon':
+					for coordinates2 in coordinates:
+						polygons.append((id, coordinates2, properties, style))
+				else:
+					for coordinates2 in coordinates:
+						for coordinates3 in coordinates2:
+							polygons.append((id, coordinates3, properties, style))
+
+		# Put the features in order by the sort key. This is done only now,
+		# since sorting the collection would mean reading all of it (and
+		# keeping the text of all the geometries) before choosing styles.
+		# Among lines which tie on the sort key, put those in the same style
+		# together so that stroke_lines() can stroke them all at once.
+		if self.sort_key is not None:
+			sort_key = self.sort_key
+			points[points_start:] = sorted(points[points_start:], key=lambda point: point[2][sort_key])
+			lines[lines_start:] = sorted(lines[lines_start:], key=lambda line: (line[2][sort_key], line[3]))
+			polygons[polygons_start:] = sorted(polygons[polygons_start:], key=lambda polygon: polygon[2][sort_key])
+
+		# Only now that the whole collection has been read can we be sure
+		# of its foreign members.
+		if isinstance(geojson, GeojsonCollection):
+			tile_pixels = geojson.foreign_members.get("tile_pixels", False)
+		else:
+			tile_pixels = geojson.get("tile_pixels", False)
+
+		if tile_pixels:
+			points[points_start:] = [(id, (coordinates[0], coordinates[1]), properties, style) for id, coordinates, properties, style in points[points_start:]]
+			return
+		projected = project_geojson_lines_tilespace_pixels([[item[1]] for item in points[points_start:]], self.zoom, self.x, self.y)
+		points[points_start:] = [(id, pixels[0], properties, style) for (id, coordinates, properties, style), pixels in zip(points[points_start:], projected)]
+		for collected, start in ((lines, lines_start), (polygons, polygons_start)):
+			projected = project_geojson_lines_tilespace_pixels([item[1] for item in collected[start:]], self.zoom, self.x, self.y)
+			collected[start:] = [(id, pixels, properties, style) for (id, coordinates, properties, style), pixels in zip(collected[start:], projected)]
 
 	# Performance timer
 	def _elapsed_start(self, message):
@@ -233,7 +344,9 @@ class MapGeoJSONTile(object):
 
 	# Override these to return something other than None for those objects
 	# which you wish to render. It will be stored with the object so that
-	# you can use it during the drawing stage.
+	# you can use it during the drawing stage. For lines and polygons it
+	# should be a style id from style_id(), since that is what draw1()
+	# and stroke_lines() expect.
 	def choose_point_style(self, properties):
 		print("Warning: renderer %s did not expect points in tile %d %d %d" % (type(self).__name__, self.zoom, self.x, self.y))
 		return None
@@ -249,28 +362,79 @@ class MapGeoJSONTile(object):
 	# The layer calls this when it is time to draw the tile. If self.draw_passes
 	# is more than one, then it will be called once for each pass. All tiles are
 	# drawn at each pass before any tile is draw at the next pass.
+	#
+	# The first time a pass is drawn at a particular scale, the drawing
+	# commands are captured in a Cairo recording surface. When the map is
+	# merely panned, the recording is replayed rather than building all of
+	# the paths again in Python. (Labels, which depend on which other tiles
+	# are on the screen, are not drawn in the passes but by the layer's
+	# label placer.)
 	def draw(self, ctx, scale, draw_pass):
 		if self.timing_draw:
 			self._elapsed_start("Drawing %s %s %d %d %d, pass %d..." % (self.tileset.key, type(self).__name__, self.zoom, self.x, self.y, draw_pass))
-		getattr(self,"draw%d" % (draw_pass+1))(ctx, scale)
+		draw_function = getattr(self,"draw%d" % (draw_pass+1))
+		if not self.record_passes:
+			draw_function(ctx, scale)
+		else:
+			if scale != self.recordings_scale:
+				self.recordings = {}
+				self.recordings_scale = scale
+			recording = self.recordings.get(draw_pass)
+			if recording is None:
+				recording = self.record(draw_function, scale, draw_pass)
+			ctx.set_source_surface(recording, 0, 0)
+			ctx.paint()
 		if self.timing_draw:
 			self._elapsed()
 
+	# Draw a pass into a recording surface and keep it
+	def record(self, draw_function, scale, draw_pass):
+		recording = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+		draw_function(cairo.Context(recording), scale)
+		self.recordings[draw_pass] = recording
+		return recording
+
+	# The layer calls this when the tile goes out of view
+	def drop_recordings(self):
+		self.recordings = {}
+		self.recordings_scale = None
+
 	# Very simply implementation of drawing. Override in derived classes
 	# if you want something fancier.
 	def draw1(self, ctx, scale):
 		self.start_clipping(ctx, scale)
-		for id, polygon, properties, style in self.polygons:
-			draw_polygon(ctx, self.scale_points(polygon, scale))
+		styles = self.style_table.styles
+		for index, (id, polygon, properties, style_id) in enumerate(self.polygons):
+			style = styles[style_id]
+			draw_polygon(ctx, self.scale_points(self.polygons, index, scale))
 			fill_with_style(ctx, style, preserve=True)
 			stroke_with_style(ctx, style, preserve=True)
 			ctx.new_path()
-		for id, line, properties, style in self.lines:
-			draw_line_string(ctx, self.scale_points(line, scale))
-			stroke_with_style(ctx, style)
+		self.stroke_lines(ctx, range(len(self.lines)), lambda index: self.scale_points(self.lines, index, scale), stroke_with_style)
 		for id, point, properties, style in self.points:
 			draw_node_dots(ctx, [point], style=style)
 
+	# Add lines to the path and call stroke_function(ctx, style) to stroke
+	# them. Lines which come one after another in the same style are
+	# stroked together, so a run of residential streets costs one stroke
+	# rather than one each. The order is kept, so a line still covers
+	# those which come before it in another style. The lines are given by
+	# their indexes in self.lines and their points are taken through
+	# points_function(index), which should simplify and scale them.
+	def stroke_lines(self, ctx, indexes, points_function, stroke_function):
+		lines = self.lines
+		styles = self.style_table.styles
+		run_style_id = None
+		for index in indexes:
+			style_id = lines[index][3]
+			if style_id != run_style_id:
+				if run_style_id is not None:
+					stroke_function(ctx, styles[run_style_id])
+				run_style_id = style_id
+			draw_line_string(ctx, points_function(index))
+		if run_style_id is not None:
+			stroke_function(ctx, styles[run_style_id])
+
 	# draw1(), draw2(), etc. should call this if they want their drawing
 	# commands to be clipped to the tile borders.
 	def start_clipping(self, ctx, scale):
@@ -286,9 +450,23 @@ class MapGeoJSONTile(object):
 	def scale_point(point, scale):
 		return (point[0] * scale, point[1] * scale)
 
-	@staticmethod
-	def scale_points(points, scale):
-		return list([(point[0]*scale,point[1]*scale) for point in points])
+	def scale_points(self, features, index, scale):
+		return list([(point[0]*scale,point[1]*scale) for point in self.simplified(features, index, scale)])
+
+	# Return the line or polygon ring (in tile pixels) at the indicated
+	# index in self.lines or self.polygons with those points removed which
+	# would make no visible difference when it is drawn at this scale.
+	# The work of simplification is done the first time a line is drawn.
+	# After that picking the points for any scale is cheap.
+	def simplified(self, features, index, scale):
+		points = features[index][1]
+		if self.simplify is None or len(points) < 8:
+			return points
+		key = (features is self.polygons, index)
+		levels = self.simplify_levels.get(key)
+		if levels is None:
+			levels = self.simplify_levels[key] = line_simplify_levels(points)
+		return line_simplify_filter(points, levels, self.simplify / scale)
 
 	# Use the supplied rule to determine the width of a feature
 	# at the current zoom level.
@@ -296,11 +474,29 @@ class MapGeoJSONTile(object):
 		zoom = self.zoom
 		if scale is not None:
 			zoom += math.log(scale, 2.0)
-		start_zoom, start_width, end_zoom, end_width = rule
-		position = float(zoom - start_zoom) / float(end_zoom - start_zoom)
-		width = start_width + position * (end_width - start_width)
-		if width < 0.1:
-			print("Warning: rules %s yields width of %f at zoom %f" % (str(rule), width, zoom))
-		return width
+		return zoom_width(rule, zoom)
+
+	# Compiled styles are shared by all of the tiles which a renderer
+	# draws at the same zoom level, so each style is looked up, copied,
+	# adjusted, and has its widths worked out only the first time it is
+	# used at that zoom rather than once for each feature.
+	style_tables = {}				# (renderer class, zoom) -> StyleTable
+	style_tables_lock = threading.Lock()
+
+	def get_style_table(self):
+		key = (type(self), self.zoom)
+		with self.style_tables_lock:
+			table = self.style_tables.get(key)
+			if table is None:
+				table = self.style_tables[key] = StyleTable(self.zoom)
+			return table
+
+	# Return the id of the compiled style filed under key, a value which
+	# determines the style, such as the name of an entry in the renderer's
+	# table of styles. The first time the key is seen at this zoom,
+	# style_function(key) is called to supply the style dict. Widths in
+	# it may be given as rules for zoom_feature().
+	def style_id(self, key, style_function):
+		return self.style_table.get_id(key, style_function)
 
 
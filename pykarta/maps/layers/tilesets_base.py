@@ -1,7 +1,7 @@
 # encoding=utf-8
 # pykarta/maps/layers/tilesets_base.py
 # Copyright 2013--2021, Trinity College
-# Last modified: 26 December 2021
+# Last modified: 17 October 2026
 
 import time
 
@@ -12,7 +12,7 @@ except ImportError:		# Python 2
 	from urllib.parse import urlparse
 
 import pykarta
-from pykarta.geometry.projection import unproject_from_tilespace
+from pykarta.geometry.projection import tile_bbox
 from pykarta.maps.layers.base import MapRasterTile
 
 # A list of tile sets from which they can be retrieved
@@ -186,9 +186,7 @@ class MapTilesetWMS(MapTilesetRaster):
 			'transparent':'true' if transparent else 'false',
 			}
 	def get_path(self, zoom, x, y):
-		nw_lat, nw_lon = unproject_from_tilespace(x, y, zoom)
-		se_lat, se_lon = unproject_from_tilespace(x+1, y+1, zoom)
-		query_params = {'bbox':",".join(map(str,(nw_lon, se_lat, se_lon, nw_lat)))}
+		query_params = {'bbox':",".join(map(str,tile_bbox(zoom, x, y)))}
 		query_params.update(self.wms_params)
 		path = "%s?%s" % (self.url_template.path, urlencode(query_params))
 		return path
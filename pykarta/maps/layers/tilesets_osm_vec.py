@@ -1,21 +1,21 @@
 # encoding=utf-8
 # pykarta/maps/layers/tilesets_osm_vec.py
 # Vector tile sets and renderers for them
-# Copyright 2013--2018, Trinity College
-# Last modified: 30 May 2018
+# Copyright 2013--2026, Trinity College
+# Last modified: 18 October 2026
 
 # http://colorbrewer2.org/ is helpful for picking color palates for maps.
 
 
 import os
 import glob
-import cairo
 import math
 import re
 import math
 
 from .tilesets_base import tilesets, MapTilesetVector
-from ..layers.tile_rndr_geojson import MapGeoJSONTile, json_loader
+from ..layers.tile_rndr_geojson import MapGeoJSONTile, tile_layers
+from ..layers.tile_labels import MapLabel
 from ..symbols import MapSymbolSet
 from ...draw import \
 	draw_line_label_stroked as draw_line_label, \
@@ -23,9 +23,9 @@ from ...draw import \
 	centered_label as draw_centered_label, \
 	poi_label as draw_poi_label, \
 	polygon as draw_polygon, \
-	line_string as draw_line_string, \
 	node_dots as draw_node_dots, \
-	stroke_with_style
+	stroke_with_style, \
+	set_stroke
 
 #-----------------------------------------------------------------------------
 
@@ -48,22 +48,23 @@ class MapOsmLanduseTile(MapGeoJSONTile):
 		"halo":False,
 		"color":(0.5, 0.5, 0.5),
 		}
-	draw_passes = 2	# set to 2 to enable labels, 1 to disable
-	label_polygons = True
+	label_polygons = True		# set to False to disable labels
+	default_style = { "fill-color": (0.90, 0.90, 0.90) }
 	def choose_polygon_style(self, properties):
-		landuse = properties.get("landuse", "?")
-		style = self.styles.get(landuse, { "fill-color": (0.90, 0.90, 0.90) })
-		return style
-	def draw2(self, ctx, scale):
-		dedup = self.dedup
+		return self.style_id(properties.get("landuse", "?"), self.landuse_style)
+	def landuse_style(self, landuse):
+		return self.styles.get(landuse, self.default_style)
+	def choose_labels(self):
+		fontsize = self.label_style["font-size"]
 		for id, area, center, text in self.polygon_labels:
-			if not text in dedup:
-				# If area in square pixels is greater than that of a 100x100 pixel square,
-				area = area * scale * scale
-				if area > 10000:
-					center = self.scale_point(center, scale)
-					draw_centered_label(ctx, center[0], center[1], text, style=self.label_style)
-					dedup.add(text)
+			if area > 0:
+				# Only if area in square pixels is greater than that of a 100x100
+				# pixel square. Larger areas take precedence.
+				self.labels.append(MapLabel(text, area / 65536.0, center[0], center[1],
+					MapLabel.box(len(text) * fontsize * 0.6, fontsize * 1.2),
+					draw_centered_label, text, self.label_style,
+					min_scale=math.sqrt(10000.0 / area)
+					))
 
 tilesets.append(MapTilesetVector("osm-vector-landuse",
 	tile_class=MapOsmLanduseTile,
@@ -109,10 +110,9 @@ class MapOsmWaterwaysTile(MapGeoJSONTile):
 				},
 		}
 	def choose_line_style(self, properties):
-		style = self.styles.get(properties['waterway'], self.styles['default'])
-		style = style.copy()
-		style['line-width'] = self.zoom_feature(style['line-width'])	
-		return style
+		return self.style_id(properties['waterway'], self.waterway_style)
+	def waterway_style(self, waterway):
+		return self.styles.get(waterway, self.styles['default'])
 
 tilesets.append(MapTilesetVector('osm-vector-waterways',
 	tile_class=MapOsmWaterwaysTile,
@@ -124,8 +124,11 @@ tilesets.append(MapTilesetVector('osm-vector-waterways',
 #-----------------------------------------------------------------------------
 
 class MapOsmWaterTile(MapGeoJSONTile):
+	styles = {
+		"water": { "fill-color": (0.53, 0.80, 0.98) },
+		}
 	def choose_polygon_style(self, properties):
-		return { "fill-color": (0.53, 0.80, 0.98) }
+		return self.style_id("water", self.styles.get)
 
 tilesets.append(MapTilesetVector('osm-vector-water',
 	tile_class=MapOsmWaterTile,
@@ -146,8 +149,11 @@ class MapOsmBuildingsTile(MapGeoJSONTile):
 		"halo":False,
 		"color":(0.5, 0.5, 0.5),
 		}
+	styles = {
+		"building": { "fill-color": (0.8, 0.7, 0.7) },
+		}
 	def choose_polygon_style(self, properties):
-		return  { "fill-color": (0.8, 0.7, 0.7) }
+		return self.style_id("building", self.styles.get)
 	def choose_polygon_label_text(self, properties):
 		return properties.get("addr:housenumber")
 	def draw2(self, ctx, scale):
@@ -181,16 +187,6 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 	clip = 15
 	sort_key = "z_order"
 	draw_passes = 2
-	line_cap = {
-		"butt":cairo.LINE_CAP_BUTT,				# default
-		"square":cairo.LINE_CAP_SQUARE,
-		"round":cairo.LINE_CAP_ROUND,
-		}
-	line_join = {
-		"miter":cairo.LINE_JOIN_MITER,			# default
-		"bevel":cairo.LINE_JOIN_BEVEL,
-		"round":cairo.LINE_JOIN_ROUND,
-		}
 
 	# Until zoom level 14 we conflate road classes
 	road_type_simplifier = {
@@ -349,14 +345,21 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 			"line-color": (0.5, 0.5, 0.7),
 			},
 		}
+	# The style depends on the way type and on whether the way is a link
+	# or a bridge, so those three are the key under which it is compiled.
 	def choose_line_style(self, properties):
-		#return {"line-width":1, "line-color":(0.0, 1.0, 0.0)}
-
 		way_type = properties.get("highway")
 		if way_type is None and "railway" in properties:
 			way_type = "railway"
 		if way_type is None and "aeroway" in properties:
 			way_type = "aeroway"
+		# At high zoom levels represent bridges by making their casings wider
+		is_bridge = self.zoom > 14 and properties.get("is_bridge") == "yes"
+		key = (way_type, properties.get("is_link") == "yes", is_bridge)
+		return self.style_id(key, self.road_style)
+
+	def road_style(self, key):
+		way_type, is_link, is_bridge = key
 		if self.zoom >= 14:
 			style = self.styles_z14_to_z18.get(way_type)
 		elif self.zoom >= 11:
@@ -364,7 +367,7 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 		else:
 			style = self.styles_z6_to_z10.get(self.road_type_simplifier.get(way_type,way_type))
 		if style is None:
-			print("Warning: no style for:", way_type, properties)
+			print("Warning: no style for:", way_type)
 			style = {"line-width":(0,10, 16,10), "line-color":(0.0, 1.0, 0.0)}		# error indicator
 
 		style = style.copy()
@@ -373,7 +376,7 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 		line_width = self.zoom_feature(style["line-width"])
 
 		# make link roads smaller
-		if properties.get("is_link") == "yes":
+		if is_link:
 			line_width *= 0.7
 
 		if "overline-width" in style:
@@ -381,8 +384,7 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 		elif "overline-color" in style:
 			style["overline-width"] = line_width * 0.9
 
-		# At high zoom levels represent bridges by making their casings wider
-		if self.zoom > 14 and properties.get("is_bridge") == "yes":
+		if is_bridge:
 			line_width *= 1.30
 
 		style.update({
@@ -391,31 +393,30 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 
 		return style
 
+	# Casings in the first pass, overlines in the second
 	def draw1(self, ctx, scale):
 		self.start_clipping(ctx, scale)
 		ctx.scale(scale, scale)
-		for id, line, name, style in self.lines:
-			if "line-width" in style:
-				draw_line_string(ctx, line)
-				ctx.set_line_width(style["line-width"])
-				ctx.set_source_rgba(*style["line-color"])
-				ctx.set_dash(style.get("line-dasharray", ()))
-				ctx.set_line_join(self.line_join[style.get("line-join", "miter")])
-				ctx.set_line_cap(self.line_cap[style.get("line-cap", "butt")])
-				ctx.stroke()
+		styles = self.style_table.styles
+		indexes = [index for index, line in enumerate(self.lines) if styles[line[3]].line is not None]
+		self.stroke_lines(ctx, indexes, lambda index: self.simplified(self.lines, index, scale), self.stroke_casing)
 
 	def draw2(self, ctx, scale):
 		self.start_clipping(ctx, scale)
 		ctx.scale(scale, scale)
-		for id, line, name, style in self.lines:
-			if "overline-width" in style:
-				draw_line_string(ctx, line)
-				ctx.set_line_width(style.get("overline-width"))
-				ctx.set_source_rgba(*style.get("overline-color"))
-				ctx.set_dash(style.get("overline-dasharray", ()))
-				ctx.set_line_join(self.line_join[style.get("overline-join", "miter")])
-				ctx.set_line_cap(self.line_cap[style.get("overline-cap", "butt")])
-				ctx.stroke()
+		styles = self.style_table.styles
+		indexes = [index for index, line in enumerate(self.lines) if styles[line[3]].overline is not None]
+		self.stroke_lines(ctx, indexes, lambda index: self.simplified(self.lines, index, scale), self.stroke_overline)
+
+	@staticmethod
+	def stroke_casing(ctx, style):
+		set_stroke(ctx, style.line)
+		ctx.stroke()
+
+	@staticmethod
+	def stroke_overline(ctx, style):
+		set_stroke(ctx, style.overline)
+		ctx.stroke()
 
 tilesets.append(MapTilesetVector("osm-vector-roads",
 	tile_class=MapOsmRoadsTile,
@@ -429,6 +430,8 @@ tilesets.append(MapTilesetVector("osm-vector-roads",
 class MapOsmRoadLabelsTile(MapGeoJSONTile):
 
 	label_lines = True
+	draw_passes = 0				# everything is drawn by the layer's label placer
+	shield_priority = 100		# above any name
 
 	fontsizes = {
 		"motorway":     (10,8, 16,14),
@@ -463,24 +466,28 @@ class MapOsmRoadLabelsTile(MapGeoJSONTile):
 			return rule
 		return None
 
-	def draw1(self, ctx, scale):
-		dedup = self.dedup
-
-		# For debugging
-		#for id, line, name, style in self.lines:
-		#	draw_node_dots(ctx, self.scale_points(line, scale), {'diameter':4})
-
-		# Draw road names
+	def choose_labels(self):
+		# Road names. Since the more important roads have the larger
+		# names, the font size serves as the priority.
 		for placement in self.line_labels:
-			if placement[0] not in dedup:
-				draw_line_label(ctx, placement, scale)
-				dedup.add(placement[0])
+			label_text, fontsize, width, middle, angle = placement
+			self.labels.append(MapLabel(label_text, fontsize, middle[0], middle[1],
+				MapLabel.rotated_boxes(width, fontsize * 1.2, angle),
+				self.draw_road_name, placement
+				))
 
-		# Draw highway route number shields
+		# Highway route number shields
 		shield_size = self.zoom_feature((10,15,18,40))
 		for center, ref in self.line_shields:
-			center = self.scale_point(center, scale)
-			draw_highway_shield(ctx, center[0], center[1], ref, size=shield_size)
+			self.labels.append(MapLabel(ref, self.shield_priority, center[0], center[1],
+				MapLabel.box(shield_size, shield_size),
+				draw_highway_shield, ref, shield_size
+				))
+
+	@staticmethod
+	def draw_road_name(ctx, x, y, placement):
+		label_text, fontsize, width, middle, angle = placement
+		draw_line_label(ctx, (label_text, fontsize, width, (x, y), angle), 1.0)
 
 tilesets.append(MapTilesetVector("osm-vector-road-labels",
 	tile_class=MapOsmRoadLabelsTile,
@@ -538,21 +545,16 @@ class MapOsmAdminBordersTile(MapGeoJSONTile):
 			},
 		}
 	def choose_line_style(self, properties):
-		style = self.styles.get(properties['admin_level'],None)
+		return self.style_id(properties['admin_level'], self.admin_level_style)
+	def admin_level_style(self, admin_level):
+		style = self.styles.get(admin_level,None)
 		if style is None:
-			print("Warning: no style for admin_level %d" % properties['admin_level'])
-		if style is not None:
-			style = style.copy()
-			for i in ("line-width", "overline-width"):
-				if i in style:
-					style[i] = self.zoom_feature(style[i])
+			print("Warning: no style for admin_level %d" % admin_level)
 		return style
 	def draw1(self, ctx, scale):
 		self.start_clipping(ctx, scale)
 		ctx.scale(scale, scale)
-		for id, line, properties, style in reversed(self.lines):
-			draw_line_string(ctx, line)
-			stroke_with_style(ctx, style)
+		self.stroke_lines(ctx, reversed(range(len(self.lines))), lambda index: self.simplified(self.lines, index, scale), stroke_with_style)
 
 tilesets.append(MapTilesetVector("osm-vector-admin-borders",
 	tile_class=MapOsmAdminBordersTile,
@@ -583,13 +585,24 @@ class MapOsmPoisTile(MapGeoJSONTile):
 			return (renderer, label_text)
 		print("Warning: no symbol for POI:", properties)
 		return None
+	def choose_labels(self):
+		fontsize = self.label_style["font-size"]
+		for id, point, properties, style in self.points:
+			renderer, label_text = style
+			if label_text is not None:
+				width = len(label_text) * fontsize * 0.6
+				height = fontsize * 1.2
+				self.labels.append(MapLabel(label_text, 0, point[0], point[1],
+					[(-width / 2.0, 10 - height / 2.0, width / 2.0, 10 + height / 2.0)],
+					self.draw_poi_name, label_text
+					))
+	def draw_poi_name(self, ctx, x, y, label_text):
+		draw_centered_label(ctx, x, y+10, label_text, style=self.label_style)
 	def draw1(self, ctx, scale):
 		for id, point, properties, style in self.points:
 			x, y = self.scale_point(point, scale)
 			renderer, label_text = style
 			renderer.blit(ctx, x, y)
-			if label_text is not None:
-				draw_centered_label(ctx, x, y+10, label_text, style=self.label_style)
 
 tilesets.append(MapTilesetVector("osm-vector-pois",
 	tile_class=MapOsmPoisTile,
@@ -612,6 +625,18 @@ class MapOsmPlacesTile(MapGeoJSONTile):
 		"suburb":   (6, 4,  16, 10),
 		"locality": (6, 4,  16, 10),
 		}
+	# Place names take precedence over road names and shields.
+	place_priorities = {
+		"state":    260,
+		"county":   250,
+		"city":     240,
+		"town":     230,
+		"village":  220,
+		"suburb":   215,
+		"hamlet":   210,
+		"locality": 205,
+		}
+	draw_passes = 0				# everything is drawn by the layer's label placer
 	def choose_point_style(self, properties):
 		#print("place:", properties)
 		if properties.get("name") is not None:
@@ -626,29 +651,40 @@ class MapOsmPlacesTile(MapGeoJSONTile):
 					"halo": True,
 					}
 		return None
-	def draw1(self, ctx, scale):
+	def choose_labels(self):
 		for id, point, properties, style in self.points:
-			x, y = self.scale_point(point, scale)
 			place = properties["place"]
 			label_text = properties['name']
 			if place == "county":
 				label_text = "%s County" % label_text
-
-			if self.zoom < 14 and place == "city" or place == "town":
-				# Draw dot
-				ctx.new_path()
-				ctx.arc(x, y, 3, 0, 2*math.pi)
-				ctx.set_line_width(1.5)
-				ctx.set_source_rgb(1,1,1)
-				ctx.stroke_preserve()
-				ctx.set_line_width(1.0)
-				ctx.set_source_rgb(0,0,0)
-				ctx.stroke_preserve()
-				ctx.set_source_rgba(0.5,0.5,1.0)
-				ctx.fill()
-				draw_poi_label(ctx, x + 5, y, label_text, fontsize=style['font-size'])
+			fontsize = style['font-size']
+			width = len(label_text) * fontsize * 0.6
+			dot = self.zoom < 14 and place == "city" or place == "town"
+			if dot:		# dot with the name to the right
+				boxes = [(-4, -fontsize, 5 + width, 4)]
 			else:
-				draw_centered_label(ctx, x, y, label_text, style=style)
+				boxes = MapLabel.box(width, fontsize * 1.2)
+			self.labels.append(MapLabel(label_text, self.place_priorities[place], point[0], point[1],
+				boxes,
+				self.draw_place, label_text, style, dot
+				))
+	@staticmethod
+	def draw_place(ctx, x, y, label_text, style, dot):
+		if dot:
+			# Draw dot
+			ctx.new_path()
+			ctx.arc(x, y, 3, 0, 2*math.pi)
+			ctx.set_line_width(1.5)
+			ctx.set_source_rgb(1,1,1)
+			ctx.stroke_preserve()
+			ctx.set_line_width(1.0)
+			ctx.set_source_rgb(0,0,0)
+			ctx.stroke_preserve()
+			ctx.set_source_rgba(0.5,0.5,1.0)
+			ctx.fill()
+			draw_poi_label(ctx, x + 5, y, label_text, fontsize=style['font-size'])
+		else:
+			draw_centered_label(ctx, x, y, label_text, style=style)
 
 tilesets.append(MapTilesetVector("osm-vector-places",
 	tile_class=MapOsmPlacesTile,
@@ -660,7 +696,7 @@ tilesets.append(MapTilesetVector("osm-vector-places",
 #-----------------------------------------------------------------------------
 
 class MapOsmTile(object):
-	draw_passes = 12
+	draw_passes = 9
 	tile_classes = (
 		("landuse", MapOsmLanduseTile),
 		("waterways", MapOsmWaterwaysTile),
@@ -673,14 +709,17 @@ class MapOsmTile(object):
 		("pois", MapOsmPoisTile),
 		)
 	def __init__(self, layer, filename, zoom, x, y, data=None):
-		parsed_json = json_loader(filename)
+		# The layers are loaded in the order in which they come in the tile.
+		tile_classes = dict(self.tile_classes)
+		tiles = {}
+		for layer_name, layer_data in tile_layers(filename, data):
+			tile_class = tile_classes.get(layer_name)
+			if tile_class is not None:
+				tiles[layer_name] = tile_class(layer, None, zoom, x, y, data=layer_data)
+		self.tiles = tiles
 		self.passes = []
 		for layer_name, tile_class in self.tile_classes:
-			layer_data = parsed_json.get(layer_name)
-			if layer_data is not None:
-				tile = tile_class(layer, None, zoom, x, y, data=layer_data)
-			else:
-				tile = None
+			tile = tiles.get(layer_name)
 			for i in range(tile_class.draw_passes):
 				self.passes.append((tile, i))
 		assert len(self.passes) == self.draw_passes
@@ -688,6 +727,16 @@ class MapOsmTile(object):
 		tile, i = self.passes[draw_pass]
 		if tile is not None:
 			tile.draw(ctx, scale, i)
+	def get_memory_size(self):
+		return sum([tile.get_memory_size() for tile in self.tiles.values()])
+	def drop_recordings(self):
+		for tile in self.tiles.values():
+			tile.drop_recordings()
+	def get_labels(self):
+		labels = []
+		for tile in self.tiles.values():
+			labels.extend(tile.get_labels())
+		return labels
 
 tilesets.append(MapTilesetVector("osm-vector",
 	tile_class=MapOsmTile,
@@ -696,3 +745,19 @@ tilesets.append(MapTilesetVector("osm-vector",
 	zoom_max=16,
 	))
 
+# The same in Mapbox Vector Tile format, which is smaller and faster to load
+tilesets.append(MapTilesetVector("osm-vector-mvt",
+	tile_class=MapOsmTile,
+	url_template="tiles/osm-vector/{z}/{x}/{y}.mvt",
+	zoom_min=4,
+	zoom_max=16,
+	))
+
+# The same as GeoJSON already in tile pixels (to a quarter pixel)
+tilesets.append(MapTilesetVector("osm-vector-pixels",
+	tile_class=MapOsmTile,
+	url_template="tiles/osm-vector/{z}/{x}/{y}.geojson?grid=4",
+	zoom_min=4,
+	zoom_max=16,
+	))
+
@@ -2,7 +2,7 @@
 # pykarta/maps/layers/tilesets_parcel.py
 # Vector tile sets and renderers for them
 # Copyright 2013--2018, Trinity College
-# Last modified: 13 May 2018
+# Last modified: 17 October 2026
 
 import math
 import json
@@ -15,9 +15,9 @@ from ...draw import centered_label
 class MapParcelsTile(MapGeoJSONTile):
 	clip = 0
 	draw_passes = 2
-	def __init__(self, layer, filename, zoom, x, y):
-		MapGeoJSONTile.__init__(self, layer, filename, zoom, x, y)
-		self.labels = []
+	def __init__(self, layer, filename, zoom, x, y, data=None):
+		MapGeoJSONTile.__init__(self, layer, filename, zoom, x, y, data=data)
+		self.parcel_labels = []
 		if zoom >= 16:		# labels appear
 			for id, polygon, properties, style in self.polygons:
 				geojson = json.loads(properties['centroid'])
@@ -28,13 +28,16 @@ class MapParcelsTile(MapGeoJSONTile):
 					house_number = properties.get("house_number")
 					street = properties.get("street")
 					if house_number and street:				# not None and not blank
-						self.labels.append((center, house_number, street))
+						self.parcel_labels.append((center, house_number, street))
+	styles = {
+		"parcel": { "line-color": (0.0, 0.0, 0.0), "line-width": 0.25 },
+		}
 	def choose_polygon_style(self, properties):
-		return { "line-color": (0.0, 0.0, 0.0), "line-width": 0.25 }
+		return self.style_id("parcel", self.styles.get)
 	def draw2(self, ctx, scale):
 		zoom = self.zoom + math.log(scale, 2.0)
 		show_street = zoom >= 17.9
-		for center, house_number, street in self.labels:
+		for center, house_number, street in self.parcel_labels:
 			center = self.scale_point(center, scale)
 			if show_street:
 				text = "%s %s" % (house_number, street)
@@ -1,7 +1,7 @@
 # pykarta/maps/layers/vector.py
 # An editable vector layer
 # Copyright 2013--2021, Trinity College
-# Last modified: 2 January 2022
+# Last modified: 18 October 2026
 
 from gi.repository import Gtk, Gdk
 import cairo
@@ -10,6 +10,9 @@ import weakref
 
 from pykarta.maps.layers import MapLayer
 from pykarta.geometry import Point, BoundingBox, LineString, Polygon
+from pykarta.geometry.distance import plane_lineseg_distance
+from pykarta.geometry.rtree import RTree
+from pykarta.geometry.simplify import line_simplify_levels, line_simplify_filter
 import pykarta.draw
 
 #============================================================================
@@ -20,6 +23,7 @@ class MapLayerVector(MapLayer):
 		MapLayer.__init__(self)
 		self.layer_objs = []
 		self.visible_objs = []
+		self.index = None
 		self.dragger = None
 		self.drawing_tool = None
 		self.tool_done_cb = tool_done_cb
@@ -28,22 +32,28 @@ class MapLayerVector(MapLayer):
 	# Add a vector object to the vector layer
 	def add_obj(self, obj):
 		self.layer_objs.append(obj)
-		self.set_stale()
+		self.reindex()
 
 	# Remove a vector object from the vector layer
 	def remove_obj(self, obj):
 		self.layer_objs.remove(obj)
-		self.set_stale()
+		self.reindex()
 
 	# Raise a vector object to the top of the Z order
 	def raise_obj(self, obj):
 		self.layer_objs.remove(obj)
 		self.layer_objs.append(obj)
-		self.set_stale()
+		self.reindex()
 
 	# Remove all of the vector objects from the vector layer
 	def clear(self):
 		self.layer_objs = []
+		self.reindex()
+
+	# Discard the spatial index so that it will be rebuilt. Call this
+	# if you change the geometry of objects already in the layer.
+	def reindex(self):
+		self.index = None
 		self.set_stale()
 
 	# Set the current drawing tool. Use None to deactivate.
@@ -89,11 +99,11 @@ class MapLayerVector(MapLayer):
 	# Figure out which objects are now visible.
 	def do_viewport(self):
 		map_bbox = self.containing_map.get_bbox()
-		self.visible_objs = []
-		for obj in self.layer_objs:
-			if obj.geometry.get_bbox().overlaps(map_bbox):
-				obj.project(self.containing_map)
-				self.visible_objs.append(obj)
+		if self.index is None:
+			self.index = RTree(self.layer_objs, bbox=lambda obj: obj.geometry.get_bbox())
+		self.visible_objs = self.index.query(map_bbox)
+		for obj in self.visible_objs:
+			obj.project(self.containing_map)
 		if self.drawing_tool is not None:
 			self.drawing_tool.project(self.containing_map)
 
@@ -157,7 +167,9 @@ class MapLayerVector(MapLayer):
 					self.dragger.obj.delete(self.dragger.i, self.containing_map)
 				if self.obj_modified_cb:
 					self.obj_modified_cb(self.dragger.obj)
+				self.dragger.obj.simplify_levels = None
 				self.dragger = None
+				self.index = None
 				self.containing_map.set_cursor(None)
 				self.redraw()
 		return False
@@ -206,6 +218,7 @@ class MapVectorObj(object):
 	snap = True		# snap this object's points to other objects
 	min_points = 0	# when to stop allowing point deletion
 	unclosed = 1	# 1 for open figures, 0 for closed figures
+	simplify = None	# tolerance in pixels for dropping points when not editable, None to disable
 
 	def __init__(self, properties):
 		self._editable = False
@@ -214,16 +227,32 @@ class MapVectorObj(object):
 		if properties is not None:
 			self.properties.update(properties)
 		self.projected_points = []
+		self.simplify_levels = None
 
 	def set_editable(self, editable):
 		self._editable = editable
+		self.simplify_levels = None
 		self.update_phantoms()
 
 	# Project this vector object's points to pixel space
 	def project(self, containing_map):
-		self.projected_points = containing_map.project_points(self.geometry.points)
+		self.projected_points = containing_map.project_points(self.simplified_points(containing_map))
 		self.update_phantoms()
 
+	# If simplification is enabled and the object is not being edited,
+	# return its points less those which would not visibly change it at
+	# the map's current zoom level. Note that points which are dropped
+	# are not available for snapping.
+	def simplified_points(self, containing_map):
+		points = self.geometry.points
+		if self.simplify is None or self._editable or len(points) < 8:
+			return points
+		if self.simplify_levels is None or len(self.simplify_levels) != len(points):
+			self.simplify_levels = line_simplify_levels(points)
+		lat, lon, zoom = containing_map.get_center_and_zoom()
+		degrees_per_pixel = 360.0 / 256.0 / (2.0 ** zoom) * math.cos(math.radians(lat))
+		return line_simplify_filter(points, self.simplify_levels, self.simplify * degrees_per_pixel)
+
 	# Override this to draw the object from self.projected_points.
 	def draw(self, ctx):
 		pass
@@ -353,7 +382,7 @@ class MapVectorLineString(MapVectorObj):
 		i = 0
 		limit = len(points) - 1
 		while i < limit:
-			if pykarta.geometry.plane_lineseg_distance(testpt, points[i], points[i+1]) < 10:
+			if plane_lineseg_distance(testpt, points[i], points[i+1]) < 10:
 				return True
 			i += 1
 		return False
@@ -1,6 +1,6 @@
 # pykarta/maps/tilegen.py
 # Copyright 2013--2017, Trinity College
-# Last modified: 3 February 2015
+# Last modified: 17 October 2026
 
 import cairo
 import os
@@ -11,7 +11,7 @@ from pykarta.maps import MapBase
 from pykarta.geometry import BoundingBox
 from pykarta.misc import tile_count
 import pyapp.i18n
-from pykarta.geometry.projection import project_to_tilespace, unproject_from_tilespace
+from pykarta.geometry.projection import project_points_tilespace, unproject_from_tilespace
 
 # This is a Pykarta map object which produces map tiles as its output.
 # But rather than stitch them together on a Cairo surface, it saves
@@ -54,14 +54,13 @@ class MapTilegen(MapBase):
 		for layer in self.layers_ordered:
 			bbox.add_bbox(layer.get_bbox())
 
-		x_start, y_start = list(map(int, project_to_tilespace(bbox.max_lat, bbox.min_lon, zoom_start)))
-		x_stop, y_stop = list(map(int, project_to_tilespace(bbox.min_lat, bbox.max_lon, zoom_start)))
+		corners = ((bbox.max_lat, bbox.min_lon), (bbox.min_lat, bbox.max_lon))
+		(x_start, y_start), (x_stop, y_stop) = project_points_tilespace(corners, zoom_start).astype(int).tolist()
 		total = tile_count(x_stop-x_start+1, y_stop-y_start+1, zoom_stop-zoom_start+1)
 
 		count = 0
 		for zoom in range(zoom_start, zoom_stop+1):
-			x_start, y_start = list(map(int, project_to_tilespace(bbox.max_lat, bbox.min_lon, zoom)))
-			x_stop, y_stop = list(map(int, project_to_tilespace(bbox.min_lat, bbox.max_lon, zoom)))
+			(x_start, y_start), (x_stop, y_stop) = project_points_tilespace(corners, zoom).astype(int).tolist()
 			for x in range(x_start-1, x_stop+2):
 				for y in range(y_start-1, y_stop+2):
 					#print "render_tile(%d, %d, %d)" % (x, y, zoom)
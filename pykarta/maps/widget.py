@@ -1,7 +1,7 @@
 #=============================================================================
 # pykarta/maps/widget.py
 # Copyright 2013--2022, Trinity College
-# Last modified: 2 January 2022
+# Last modified: 17 October 2026
 #=============================================================================
 
 
@@ -336,6 +336,7 @@ class MapPrint(MapCairo):
 			self,
 			tile_source=None,
 			tile_cache_basedir=map_widget.tile_cache_basedir,
+			tile_cache=map_widget.tile_cache,
 			feedback=MapPrintProgress(main_window)
 			)
 
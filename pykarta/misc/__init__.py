@@ -1,6 +1,6 @@
 # pykarta/misc/__init__.py
 # Copyright 2013--2018, Trinity College
-# Last modified: 15 May 2018
+# Last modified: 17 October 2026
 
 import os
 import time
@@ -56,7 +56,10 @@ if sys.version_info >= (3,0):
 		def __init__(self, bound_method):
 			self.m = WeakMethod(bound_method)
 		def __call__(self, *args, **kwargs):
-			return self.m()(*args, **kwargs)
+			method = self.m()
+			if method is None:
+				raise ReferenceError
+			return method(*args, **kwargs)
 else:
 	import weakref
 	import new
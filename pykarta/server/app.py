@@ -2,7 +2,7 @@
 # pykarta/server/app.py
 # Server for use by PyKarta applications.
 # Provides geocoding and vector map tiles.
-# Last modified: 17 October 2019
+# Last modified: 17 October 2026
 
 import re, os
 
@@ -13,6 +13,8 @@ except ImportError:
 	import sys
 	sys.path.insert(1, "../..")
 
+from pykarta.server.dbopen import dbrelease
+
 # Import data data provider modules
 from pykarta.server.modules.not_found import app as app_not_found
 from pykarta.server.modules.geocoder_parcel import app as app_geocoder_parcel
@@ -58,7 +60,32 @@ def app(environ, start_response):
 				environ["PATH_INFO"] = ("/%s%s" % (m.group(2), m.group(3)))
 			else:
 				app = routes[None]
-	return app(environ, start_response)
+
+	# Most apps return lists, so the database connections can go back
+	# to the pool as soon as they return. Those which stream their
+	# responses keep them until the server closes the iterable.
+	streaming = False
+	try:
+		result = app(environ, start_response)
+		streaming = not isinstance(result, list)
+	finally:
+		if not streaming:
+			dbrelease()
+	return ReleaseOnClose(result) if streaming else result
+
+# Wraps the iterable returned by an app which streams its response so
+# that the database connections go back to the pool once it is closed
+class ReleaseOnClose(object):
+	def __init__(self, iterable):
+		self.iterable = iterable
+	def __iter__(self):
+		return iter(self.iterable)
+	def close(self):
+		try:
+			if hasattr(self.iterable, "close"):
+				self.iterable.close()
+		finally:
+			dbrelease()
 
 # Standalone server for testing
 # Start it up and run:
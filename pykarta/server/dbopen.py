@@ -1,35 +1,103 @@
 # pykarta/servers/dbopen.py
-# Last modified: 19 October 2019
+# Last modified: 17 October 2026
+
+# The databases are opened read-only (though TEMP tables can still be
+# created) and their connections are kept in a pool which is shared by
+# all threads. When a thread first calls dbopen() for a database, it takes
+# a connection from the pool (or opens a new one) and keeps it until it
+# calls dbrelease(). The WSGI app in app.py does this at the end of each
+# request, so a server which starts a new thread for each request does
+# not open a new connection (and load Spatialite) each time.
+#
+# Queries should bind their parameters rather than format them into the
+# SQL text. The sqlite3 module keeps the prepared form of the last
+# statements_cached statements run on each connection, so a query whose
+# text does not change is prepared only once.
 
 from email.utils import formatdate, parsedate_tz, mktime_tz
 import os, time
 import sqlite3
 import threading
 
+mmap_size = 256 * 1024 * 1024		# bytes of the file to map into memory
+cache_size = 16 * 1024				# KiB of page cache per connection
+statements_cached = 256
+
+class DatabasePool(object):
+	def __init__(self, db_filename):
+		self.db_filename = db_filename
+		self.lock = threading.Lock()
+		self.idle = []
+		self.mtime = None
+
+	# Take a connection from the pool. If the database file has been
+	# replaced, the connections to the old one are closed.
+	def get(self, stderr):
+		mtime = int(os.path.getmtime(self.db_filename))
+		with self.lock:
+			if mtime != self.mtime:
+				if self.mtime is not None:
+					stderr.write("Database %s has changed\n" % self.db_filename)
+				for conn, conn_mtime in self.idle:
+					conn.close()
+				self.idle = []
+				self.mtime = mtime
+			if len(self.idle) > 0:
+				return self.idle.pop()
+		return (self.connect(stderr), mtime)
+
+	# Return a connection to the pool, unless it is to an old revision
+	# of the database.
+	def put(self, item):
+		with self.lock:
+			if item[1] == self.mtime:
+				self.idle.append(item)
+				return
+		item[0].close()
+
+	def connect(self, stderr):
+		stderr.write("Opening database %s...\n" % self.db_filename)
+		conn = sqlite3.connect("file:%s?mode=ro" % self.db_filename, uri=True, check_same_thread=False, cached_statements=statements_cached)
+		conn.execute("PRAGMA mmap_size=%d" % mmap_size)
+		conn.execute("PRAGMA cache_size=-%d" % cache_size)
+		conn.enable_load_extension(True)
+		conn.load_extension("mod_spatialite")
+		conn.enable_load_extension(False)
+		conn.row_factory = sqlite3.Row
+		return conn
+
+pools = {}
+pools_lock = threading.Lock()
+
+# Connections which this thread has taken from the pools
 class Databases(threading.local):
 	def __init__(self):
 		self.databases = {}
 
 databases = Databases()
 
-# Open the requested database, if it is not open already. But first,
+# Open the requested database, if it is not open already. If the database
+# file has been replaced since we opened it, open it again. But first,
 # if the HTTP request in environ has an If-Modified-Since header
 # earlier than the file revision date of the database, bail out
 # returning None.
 def dbopen(environ, db_basename):
 	stderr = environ['wsgi.errors']
 
-	if not db_basename in databases.databases:
-		db_filename = os.path.join(environ["DATADIR"], db_basename)
-		stderr.write("Opening database %s...\n" % db_filename)
-		stderr.write("db_filename: %s\n" % db_filename)
-		conn = sqlite3.connect(db_filename)
-		conn.enable_load_extension(True)
-		conn.load_extension("mod_spatialite")
-		conn.enable_load_extension(False)
-		conn.row_factory = sqlite3.Row
-		databases.databases[db_basename] = (conn.cursor(), int(os.path.getmtime(db_filename)))
-	(cursor, last_modified) = databases.databases[db_basename]
+	db_filename = os.path.join(environ["DATADIR"], db_basename)
+	with pools_lock:
+		pool = pools.get(db_filename)
+		if pool is None:
+			pool = pools[db_filename] = DatabasePool(db_filename)
+
+	item = databases.databases.get(db_basename)
+	if item is not None and item[2] != int(os.path.getmtime(db_filename)):
+		dbrelease(db_basename)
+		item = None
+	if item is None:
+		conn, mtime = pool.get(stderr)
+		item = databases.databases[db_basename] = (pool, conn, mtime, conn.cursor())
+	(pool, conn, last_modified, cursor) = item
 
 	time_now = time.time()
 	response_headers = [
@@ -49,3 +117,21 @@ def dbopen(environ, db_basename):
 
 	return (cursor, response_headers)
 
+# Return the file revision date of a database opened by dbopen()
+# in this thread.
+def dbmtime(db_basename):
+	return databases.databases[db_basename][2]
+
+# Give back to the pool the connection to the indicated database (or to
+# all databases) which this thread took in dbopen(). Cursors obtained
+# from dbopen() must not be used afterward.
+def dbrelease(db_basename=None):
+	if db_basename is None:
+		names = list(databases.databases.keys())
+	else:
+		names = [db_basename] if db_basename in databases.databases else []
+	for name in names:
+		pool, conn, mtime, cursor = databases.databases.pop(name)
+		cursor.close()
+		pool.put((conn, mtime))
+
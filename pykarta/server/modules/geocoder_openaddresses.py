@@ -1,6 +1,6 @@
 # pykarta/server/modules/geocoder_openaddresses.py
 # Geocoder gets addresses from the Openaddresses project.
-# Last modified: 16 May 2018
+# Last modified: 18 October 2026
 
 import os, json, time, re
 from pykarta.server.dbopen import dbopen
@@ -12,9 +12,15 @@ except ImportError:
 
 thread_data = threading.local()
 
+# Largest number of addresses accepted in one batch request
+batch_max = 10000
+
 def app(environ, start_response):
 	stderr = environ['wsgi.errors']
 
+	if environ.get('REQUEST_METHOD') == 'POST':
+		return app_batch(environ, start_response)
+
 	cursor, response_headers = dbopen(environ, "openaddresses.sqlite")
 	if cursor is None:
 		start_response("304 Not Modified", response_headers)
@@ -72,3 +78,82 @@ def app(environ, start_response):
 	#stderr.write("Result: %s\n" % str(feature))
 	return [json.dumps(feature).encode("utf-8")]
 
+# Geocode a batch of addresses POSTed as a JSON list of the lists which
+# app() accepts in the query string. The addresses are loaded into a
+# temporary table which is joined to addresses in the same three passes
+# as above (house and apartment number, house number, range of house
+# numbers), each pass taking only those addresses not yet found. The
+# answers are sent one per line in the order of the addresses, each
+# a GeoJSON Feature or null.
+def app_batch(environ, start_response):
+	stderr = environ['wsgi.errors']
+
+	# If-Modified-Since means nothing to a POST, so dbopen() should not
+	# answer 304 Not Modified.
+	environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+	cursor, response_headers = dbopen(environ, "openaddresses.sqlite")
+
+	try:
+		length = int(environ.get('CONTENT_LENGTH') or 0)
+		addresses = json.loads(environ['wsgi.input'].read(length).decode("utf-8"))
+		assert isinstance(addresses, list) and len(addresses) <= batch_max
+		assert all(isinstance(field, (str, int)) or field is None for address in addresses for field in address)
+		rows = []
+		for seq, (house_number, apartment_number, street, city, state, postal_code) in enumerate(addresses):
+			if isinstance(house_number, int):		# JSON number
+				house_number = str(house_number)
+			house_number_int = int(house_number) if re.match(r'^\d+$', house_number or "") else None
+			rows.append((seq, house_number, house_number_int, apartment_number or "", street, city, state, postal_code or ""))
+	except (ValueError, TypeError, AssertionError):
+		start_response("400 Bad Request", [('Content-Type', 'text/plain')])
+		return [b"Expected a JSON list of at most %d addresses, each a list of six fields\n" % batch_max]
+	stderr.write("Geocoding batch of %d addresses...\n" % len(addresses))
+
+	cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS geocode_batch (
+		seq integer PRIMARY KEY, house_number text, house_number_int integer, apartment_number text,
+		street text, city text, state text, postal_code text
+		)""")
+	cursor.execute("DELETE FROM temp.geocode_batch")
+	cursor.executemany("INSERT INTO temp.geocode_batch VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+	query = """SELECT b.seq, a.longitude, a.latitude FROM temp.geocode_batch AS b, addresses AS a
+		WHERE {house} AND a.street=b.street AND a.city=b.city AND a.region=b.state
+		AND (b.postal_code='' OR a.postal_code=b.postal_code OR a.postal_code IS NULL)"""
+	passes = (
+		"b.apartment_number != '' AND a.apartment_number=b.apartment_number AND a.house_number=b.house_number",
+		"a.house_number=b.house_number",
+		"b.house_number_int IS NOT NULL AND a.house_number_start <= b.house_number_int AND a.house_number_end >= b.house_number_int",
+		)
+	coordinates = {}
+	for house in passes:
+		cursor.execute(query.format(house=house))
+		found = {}
+		for seq, longitude, latitude in cursor.fetchall():
+			found.setdefault(seq, [longitude, latitude])
+		coordinates.update(found)
+		# Only the addresses not yet found go on to the next pass.
+		cursor.executemany("DELETE FROM temp.geocode_batch WHERE seq=?", [(seq,) for seq in found.keys()])
+	cursor.execute("DELETE FROM temp.geocode_batch")
+	cursor.connection.commit()
+	stderr.write("Found %d of %d\n" % (len(coordinates), len(addresses)))
+
+	lines = []
+	for seq in range(len(addresses)):
+		point = coordinates.get(seq)
+		if point is not None:
+			feature = {
+				'type':'Feature',
+				'geometry':{'type':'Point', 'coordinates':point},
+				'properties':{'precision':'ROOF'}
+				}
+		else:
+			feature = None
+		lines.append((json.dumps(feature) + "\n").encode("utf-8"))
+
+	# The answers depend on what was POSTed, so the caching headers
+	# which dbopen() supplies for GET requests do not apply.
+	start_response("200 OK", [
+		('Content-Type', 'application/x-ndjson')
+		])
+	return lines
+
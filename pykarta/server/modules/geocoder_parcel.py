@@ -1,6 +1,6 @@
 # pykarta/server/modules/geocoder_parcel.py
 # Geocoder gets addresses from the assessor's parcel map
-# Last modified: 19 October 2019
+# Last modified: 17 October 2026
 
 import os, json, time
 from pykarta.server.dbopen import dbopen
@@ -12,9 +12,15 @@ except ImportError:
 
 thread_data = threading.local()
 
+# Largest number of addresses accepted in one batch request
+batch_max = 10000
+
 def app(environ, start_response):
 	stderr = environ['wsgi.errors']
 
+	if environ.get('REQUEST_METHOD') == 'POST':
+		return app_batch(environ, start_response)
+
 	cursor, response_headers = dbopen(environ, "parcels.sqlite")
 	if cursor is None:
 		start_response("304 Not Modified", response_headers)
@@ -70,3 +76,77 @@ def app(environ, start_response):
 	#stderr.write("Result: %s\n" % str(feature))
 	return [json.dumps(feature).encode("utf-8")]
 
+# Geocode a batch of addresses POSTed as a JSON list of the lists which
+# app() accepts in the query string. The addresses are loaded into a
+# temporary table which is joined to parcel_addresses, first for exact
+# matches and then, for those not found, with the house number two lower.
+# The answers are sent one per line in the order of the addresses, each
+# a GeoJSON Feature or null.
+def app_batch(environ, start_response):
+	stderr = environ['wsgi.errors']
+
+	# If-Modified-Since means nothing to a POST, so dbopen() should not
+	# answer 304 Not Modified.
+	environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+	cursor, response_headers = dbopen(environ, "parcels.sqlite")
+
+	try:
+		length = int(environ.get('CONTENT_LENGTH') or 0)
+		addresses = json.loads(environ['wsgi.input'].read(length).decode("utf-8"))
+		assert isinstance(addresses, list) and len(addresses) <= batch_max
+		assert all(isinstance(field, (str, int)) or field is None for address in addresses for field in address)
+		rows = []
+		for seq, (house_number, apartment_number, street, town, state, postal_code) in enumerate(addresses):
+			try:
+				house_number_minus_two = str(int(house_number) - 2)
+			except (ValueError, TypeError):
+				house_number_minus_two = None
+			rows.append((seq, house_number, house_number_minus_two, street, town, state, postal_code or ""))
+	except (ValueError, TypeError, AssertionError):
+		start_response("400 Bad Request", [('Content-Type', 'text/plain')])
+		return [b"Expected a JSON list of at most %d addresses, each a list of six fields\n" % batch_max]
+	stderr.write("Geocoding batch of %d addresses...\n" % len(addresses))
+
+	cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS geocode_batch (
+		seq integer PRIMARY KEY, house_number text, house_number_minus_two text,
+		street text, city text, state text, zip text
+		)""")
+	cursor.execute("DELETE FROM temp.geocode_batch")
+	cursor.executemany("INSERT INTO temp.geocode_batch VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+	query = """SELECT b.seq, p.centroid FROM temp.geocode_batch AS b, parcel_addresses AS p
+		WHERE p.house_number=b.{house_number} AND p.street=b.street AND p.city=b.city AND p.state=b.state
+		AND (b.zip='' OR p.zip=b.zip OR p.zip='' OR p.zip IS NULL)"""
+	centroids = {}
+	for house_number in ("house_number", "house_number_minus_two"):
+		cursor.execute(query.format(house_number=house_number))
+		found = {}
+		for seq, centroid in cursor.fetchall():
+			found.setdefault(seq, centroid)
+		centroids.update(found)
+		# Only the addresses not yet found go on to the next pass.
+		cursor.executemany("DELETE FROM temp.geocode_batch WHERE seq=?", [(seq,) for seq in found.keys()])
+	cursor.execute("DELETE FROM temp.geocode_batch")
+	cursor.connection.commit()
+	stderr.write("Found %d of %d\n" % (len(centroids), len(addresses)))
+
+	lines = []
+	for seq in range(len(addresses)):
+		centroid = centroids.get(seq)
+		if centroid is not None:
+			feature = {
+				'type':'Feature',
+				'geometry':json.loads(centroid),
+				'properties':{'precision':'LOT'}
+				}
+		else:
+			feature = None
+		lines.append((json.dumps(feature) + "\n").encode("utf-8"))
+
+	# The answers depend on what was POSTed, so the caching headers
+	# which dbopen() supplies for GET requests do not apply.
+	start_response("200 OK", [
+		('Content-Type', 'application/x-ndjson')
+		])
+	return lines
+
@@ -1,6 +1,6 @@
 # pykarta/server/modules/tiles_osm_vec.py
 # Produce GeoJSON tiles from OSM data stored in a Spatialite database
-# Last modified: 17 October 2019
+# Last modified: 17 October 2026
 
 # References:
 # https://docs.python.org/2/library/sqlite3.html
@@ -11,9 +11,10 @@
 # http://northredoubt.com/n/2012/01/18/spatialite-and-spatial-indexes/
 
 
-import os, json, re, gzip, io
-from pykarta.geometry.projection import unproject_from_tilespace
-from pykarta.server.dbopen import dbopen
+import os, json, re
+import tempfile
+from pykarta.geometry.projection import tile_bbox
+from pykarta.server.tilecache import tile_response, tile_grid, encode_tile, encode_tile_stream, encode_tile_mvt, quantize_tile
 
 # Sets of map layers for use together
 map_layer_sets = {
@@ -146,164 +147,277 @@ layers = {
 		'where_expressions': [
 			"amenity IS NOT NULL"
 			],
-		},
 		'clip': False,		# unnecessary
 		'simplification': None,
 		'pad-bbox': False,
+		},
 	}
 
-def get_tile(stderr, cursor, layer_name, small_bbox, large_bbox, zoom):
-	layer = layers.get(layer_name)
-	assert layer is not None
-
-	bbox = large_bbox if layer.get("pad-bbox",True) else small_bbox
-
-	geometry = "__geometry__"
-	if layer.get("clip",True):
-		geometry = "Intersection(%s,%s)" % (geometry, bbox)
-	simplification = layer.get("simplification",1.0)		# one pixel
-	if simplification is not None and zoom < layer.get('simplify-until',16):
-		simplification = 360.0 / (2.0 ** zoom) / 256.0 * simplification
-		geometry = "SimplifyPreserveTopology(%s,%f)" % (geometry, simplification)
-
-	columns = layer["columns"]
-	if "other_tags" in layer:
-		columns = list(columns)
-		columns.append("other_tags")
-
-	# Build the part of the WHERE clause unique to this layer
-	where_expressions = layer["where_expressions"]
-	where_index = (zoom - layer.get("zoom_min",0))
-	if where_index < 0:
-		return None
-	where = where_expressions[where_index if where_index < len(where_expressions) else -1]
-	pixel_in_degrees = 360.0 / (2.0 ** zoom) / 256.0
-	a_speck = (pixel_in_degrees * pixel_in_degrees) * 10.0	
-	where = where.replace("{a_speck}", str(a_speck))
-	#stderr.write("where: %s\n" % where)
+# Group the indicated layers by the table from which they are drawn. Layers
+# which have nothing to show at this zoom level are left out. Returns
+# a dict of table name -> list of (layer name, layer, where expression).
+def group_layers(layer_names, zoom):
+	tables = {}
+	for layer_name in layer_names:
+		layer = layers.get(layer_name)
+		assert layer is not None
+
+		# Build the part of the WHERE clause unique to this layer
+		where_expressions = layer["where_expressions"]
+		where_index = (zoom - layer.get("zoom_min",0))
+		if where_index < 0:
+			continue
+		where = where_expressions[where_index if where_index < len(where_expressions) else -1]
+		where = where.replace("{a_speck}", ":a_speck")
+		tables.setdefault(layer["table"], []).append((layer_name, layer, where))
+	return tables
+
+# Find the features of several layers which are drawn from the same table.
+# The spatial index is scanned only once and each row is tested against the
+# WHERE expression of each layer. Yields (layer name, feature).
+#
+# The bounding boxes and sizes are bound as parameters so that the text of
+# the query depends only on the layers and the zoom level and SQLite
+# can reuse the prepared statement.
+def query_table(stderr, cursor, table, members, params, zoom):
+	small_bbox = "BuildMBR(:small_min_lon,:small_min_lat,:small_max_lon,:small_max_lat,4326)"
+	large_bbox = "BuildMBR(:large_min_lon,:large_min_lat,:large_max_lon,:large_max_lat,4326)"
+	params = dict(params)
+	columns = []
+	selections = []
+	search_bbox = small_bbox
+	for i, (layer_name, layer, where) in enumerate(members):
+		for column in layer["columns"] + (("other_tags",) if "other_tags" in layer else ()):
+			if not column in columns:
+				columns.append(column)
+
+		bbox = large_bbox if layer.get("pad-bbox",True) else small_bbox
+		if bbox is large_bbox:
+			search_bbox = large_bbox
+
+		geometry = "Geometry"
+		if layer.get("clip",True):
+			geometry = "Intersection(%s,%s)" % (geometry, bbox)
+		simplification = layer.get("simplification",1.0)		# one pixel
+		if simplification is not None and zoom < layer.get('simplify-until',16):
+			params["simplification_%d" % i] = 360.0 / (2.0 ** zoom) / 256.0 * simplification
+			geometry = "SimplifyPreserveTopology(%s,:simplification_%d)" % (geometry, i)
+
+		# The geometry as GeoJSON if the row belongs in this layer, otherwise
+		# NULL. If it belongs but can not be converted, an empty string.
+		selections.append("CASE WHEN ( {where} ) AND Intersects({bbox}, Geometry) THEN COALESCE(AsGeoJSON({geometry}), '') END AS __geometry_{i}__".format(
+			where=where,
+			bbox=bbox,
+			geometry=geometry,
+			i=i,
+			))
 
 	# In Spatialite we must join the spatial index table explicitly.
-	spatial_test = "ROWID IN ( SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{table}' AND search_frame = {bbox} )""".format(
-		table=layer['table'],
-		bbox=bbox
+	spatial_test = "ROWID IN ( SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{table}' AND search_frame = {bbox} )".format(
+		table=table,
+		bbox=search_bbox
 		)
 
-	# Query to find what we want and do preliminary filtering using the spatial index.
-	query = "SELECT ogc_fid as __id__, Geometry as __geometry__, {columns} FROM {table} WHERE ( {where} ) AND {spatial_test}".format(
+	query = "SELECT ogc_fid as __id__, {columns}, {selections} FROM {table} WHERE ( {where} ) AND {spatial_test}".format(
 		columns=(",".join(columns)),
-		table=layer['table'],
-		where=where,
+		selections=(", ".join(selections)),
+		table=table,
+		where=(" OR ".join(["( %s )" % where for layer_name, layer, where in members])),
 		spatial_test=spatial_test,
 		)
 	#stderr.write("query: %s\n" % query)
 
-	# Enclose above query in another query which does more precision spatial
-	# filtering and converts the geometry to GeoJSON.
-	query = """SELECT AsGeoJSON({geometry}) as __geometry__, *
-				FROM ( {query} ) AS q
-				WHERE Intersects({bbox}, q.__geometry__)
-			""".format(query=query,bbox=bbox, spatial_test=spatial_test, geometry=geometry)
-	#stderr.write("query: %s\n" % query)
-
-	cursor.execute(query)
+	cursor.execute(query, params)
 
-	features = []
 	for row in cursor:
-		if row['__geometry__'] is None:
-			stderr.write("Invalid geometry: %s\n" % str(list(row)))
-			continue
+		for i, (layer_name, layer, where) in enumerate(members):
+			geometry = row["__geometry_%d__" % i]
+			if geometry is None:
+				continue
+			if geometry == "":
+				stderr.write("Invalid geometry: %s\n" % str(list(row)))
+				continue
+
+			properties = {}
+			if 'other_tags' in layer:
+				other_tags = row['other_tags']
+				if other_tags is not None:
+					try:
+						#other_tags = dict(map(lambda item: re.match(r'^"?([^"]+)"=>"([^"]*)"?$', item).groups(), other_tags.split('","')))
+						other_tags = json.loads("{%s}" % other_tags.replace('"=>"','":"'))
+						for tag in layer['other_tags']:
+							value = other_tags.get(tag)	
+							if value is not None:
+								properties[tag] = value
+					except (AttributeError, ValueError):
+						stderr.write("Failed to parse other_tags: %s\n" % other_tags)
+
+			for name in layer["columns"]:
+				value = row[name]
+				if value is not None:
+					properties[name] = value
+
+			if 'highway' in properties:
+				m = re.match(r'^(.+)_link$', properties['highway'])
+				if m:
+					properties['highway'] = m.group(1)
+					properties['is_link'] = 'yes'
+
+			yield (layer_name, {
+				'type': 'Feature',
+				'id': row['__id__'],
+				'geometry': geometry,		# still JSON text
+				'properties': properties,
+				})
 
-		row = dict(row)
-		id = row.pop('__id__')
-		geometry = json.loads(row.pop("__geometry__"))
-		properties = {}
-
-		if 'other_tags' in layer:
-			other_tags = row.pop('other_tags')
-			if other_tags is None:
-				other_tags = dict()
-			else:
-				try:
-					#other_tags = dict(map(lambda item: re.match(r'^"?([^"]+)"=>"([^"]*)"?$', item).groups(), other_tags.split('","')))
-					other_tags = json.loads("{%s}" % other_tags.replace('"=>"','":"'))
-					for tag in layer['other_tags']:
-						value = other_tags.get(tag)	
-						if value is not None:
-							properties[tag] = value
-				except AttributeError:
-					stderr.write("Failed to parse other_tags: %s\n" % other_tags)
-
-		for name, value in list(row.items()):
-			if value is not None:
-				properties[name] = value
-
-		if 'highway' in properties:
-			m = re.match(r'^(.+)_link$', properties['highway'])
-			if m:
-				properties['highway'] = m.group(1)
-				properties['is_link'] = 'yes'
-
-		feature = {
-			'type': 'Feature',
-			'id': id,
-			'geometry': geometry,
-			'properties': properties,
-			}
-		features.append(feature)
-	stderr.write("Found %d feature(s)\n" % len(features))
-
-	geojson = {
-		'type': 'FeatureCollection',
-		'features': features,
-		}
-
-	return geojson
+# Find the features of the indicated layers in a tile, running one query
+# for each table. Yields (layer name, feature) with the geometry of the
+# feature still in JSON text. Layers which are not shown at this zoom
+# level produce nothing. The features of one table are yielded as the
+# rows are read, so the caller should not use the cursor until it has
+# taken all of them.
+def query_layers(stderr, cursor, layer_names, zoom, x, y):
+	for table, members in group_layers(layer_names, zoom).items():
+		for item in query_table_features(stderr, cursor, table, members, zoom, x, y):
+			yield item
+
+# Run query_table() for the tile
+def query_table_features(stderr, cursor, table, members, zoom, x, y):
+	pixel_in_degrees = 360.0 / (2.0 ** zoom) / 256.0
+	params = {"a_speck": (pixel_in_degrees * pixel_in_degrees) * 10.0}
+	for prefix, pad in (("small", 0.0), ("large", 0.05)):
+		for name, value in zip(("min_lon", "min_lat", "max_lon", "max_lat"), tile_bbox(zoom, x, y, pad)):
+			params["%s_%s" % (prefix, name)] = value
+	return query_table(stderr, cursor, table, members, params, zoom)
+
+# Render several layers of a tile. Returns a dict of layer name ->
+# FeatureCollection, or None for layers not shown at this zoom level.
+def render_layers(stderr, cursor, layer_names, zoom, x, y):
+	shown = set([layer_name for members in group_layers(layer_names, zoom).values() for layer_name, layer, where in members])
+	result = dict([(layer_name, {'type':'FeatureCollection', 'features':[]} if layer_name in shown else None) for layer_name in layer_names])
+	for layer_name, feature in query_layers(stderr, cursor, layer_names, zoom, x, y):
+		feature['geometry'] = json.loads(feature['geometry'])
+		result[layer_name]['features'].append(feature)
+	for layer_name in shown:
+		stderr.write("%s: found %d feature(s)\n" % (layer_name, len(result[layer_name]['features'])))
+	return result
 
 def app(environ, start_response):
 	stderr = environ['wsgi.errors']
 
-	m = re.match(r'^/([^/]+)/(\d+)/(\d+)/(\d+)\.geojson$', environ['PATH_INFO'])
+	m = re.match(r'^/([^/]+)/(\d+)/(\d+)/(\d+)\.(geojson|mvt)$', environ['PATH_INFO'])
 	assert m, environ['PATH_INFO']
 	layer_name = m.group(1)
 	zoom = int(m.group(2))
 	x = int(m.group(3))
 	y = int(m.group(4))
+	format = m.group(5)
 	stderr.write("%s tile (%d, %d) at zoom %d...\n" % (layer_name, x, y, zoom))
 	assert zoom <= 16
 
-	cursor, response_headers = dbopen(environ, "osm_map.sqlite")
-	if cursor is None:
-		start_response("304 Not Modified", response_headers)
-		return []
+	def render(cursor):
+		return render_tile(stderr, cursor, layer_name, zoom, x, y)
+
+	if format == "mvt":
+		# A layer set is already a dict of layers. A single layer is
+		# put in a vector tile layer named as in a layer set.
+		def encode(geojson):
+			if layer_name not in map_layer_sets:
+				geojson = {layer_name.replace("osm-vector-",""): geojson} if geojson is not None else {}
+			return encode_tile_mvt(geojson, zoom, x, y)
+		return tile_response(environ, start_response, "osm_map.sqlite", layer_name + ".mvt", zoom, x, y, render,
+			encode=encode, content_type="application/vnd.mapbox-vector-tile")
 
-	p1 = unproject_from_tilespace(x, y, zoom)
-	p2 = unproject_from_tilespace(x + 1.0, y + 1.0, zoom)
-	small_bbox = 'BuildMBR(%f,%f,%f,%f,4326)' % (p1[1], p1[0], p2[1], p2[0])
+	# GeoJSON already projected to tile pixels and rounded
+	grid = tile_grid(environ)
+	if grid is not None:
+		return tile_response(environ, start_response, "osm_map.sqlite", "%s.grid%d" % (layer_name, grid), zoom, x, y, render,
+			encode=lambda geojson: encode_tile(quantize_tile(geojson, zoom, x, y, grid)))
 
-	p1 = unproject_from_tilespace(x - 0.05, y - 0.05, zoom)
-	p2 = unproject_from_tilespace(x + 1.05, y + 1.05, zoom)
-	large_bbox = 'BuildMBR(%f,%f,%f,%f,4326)' % (p1[1], p1[0], p2[1], p2[0])
+	# Plain GeoJSON is written out as it is found
+	def render_stream(cursor):
+		return stream_tile(stderr, cursor, layer_name, zoom, x, y)
+	return tile_response(environ, start_response, "osm_map.sqlite", layer_name, zoom, x, y, render_stream,
+		encode=encode_tile_stream, stream=True)
 
+# Return the indicated tile of a layer or a layer set as Python objects.
+# This is used both by app() and by the tile seeder.
+def render_tile(stderr, cursor, layer_name, zoom, x, y):
 	if layer_name in map_layer_sets:
-		layer_names = map_layer_sets[layer_name]
 		geojson = {}
-		for layer_name in layer_names:
-			tile_geojson = get_tile(stderr, cursor, layer_name, small_bbox, large_bbox, zoom)
-			if tile_geojson is not None:
-				geojson[layer_name.replace("osm-vector-","")] = tile_geojson
+		rendered = render_layers(stderr, cursor, map_layer_sets[layer_name], zoom, x, y)
+		for name in map_layer_sets[layer_name]:
+			if rendered[name] is not None:
+				geojson[name.replace("osm-vector-","")] = rendered[name]
+		return geojson
+	else:
+		return render_layers(stderr, cursor, [layer_name], zoom, x, y)[layer_name]
+
+# Return the indicated tile of a layer or a layer set as a series of
+# pieces of JSON text. The geometry, which Spatialite gives us as JSON,
+# is not parsed and the features are not collected into a dict.
+#
+# The rows of a table are read once for all of the layers drawn from it,
+# but the FeatureCollections must follow one another. So the features of
+# the first layer of each table are sent as they are found, while those
+# of the others wait in temporary files (in RAM until they grow large).
+# The layers of a set come in the order of their tables.
+spool_max = 256 * 1024
+def stream_tile(stderr, cursor, layer_name, zoom, x, y):
+	if layer_name in map_layer_sets:
+		layer_names = map_layer_sets[layer_name]
 	else:
-		geojson = get_tile(stderr, cursor, layer_name, small_bbox, large_bbox, zoom)
-
-	# Convert Python objects to JSON and compress
-	out = io.BytesIO()
-	with gzip.open(out, mode='wt') as fo:
-		json.dump(geojson, fo)
-
-	start_response("200 OK", response_headers + [
-		("Content-Type", "application/json"),
-		("Content-Encoding", "gzip"),
-		])
-	return [out.getvalue()]
+		layer_names = [layer_name]
+
+	tables = group_layers(layer_names, zoom)
+	if not layer_name in map_layer_sets and len(tables) == 0:
+		yield "null"
+		return
+
+	if layer_name in map_layer_sets:
+		yield "{"
+	first_layer = True
+	for table, members in tables.items():
+		names = [name for name, layer, where in members]
+		spools = dict([(name, tempfile.SpooledTemporaryFile(max_size=spool_max, mode="w+")) for name in names[1:]])
+		try:
+			counts = dict([(name, 0) for name in names])
+			def start_layer(name):
+				text = '{"type": "FeatureCollection", "features": ['
+				if layer_name in map_layer_sets:
+					text = '%s%s: %s' % ("" if first_layer else ", ", json.dumps(name.replace("osm-vector-","")), text)
+				return text
+
+			# The first layer as the rows come
+			yield start_layer(names[0])
+			first_layer = False
+			for name, feature in query_table_features(stderr, cursor, table, members, zoom, x, y):
+				geometry = feature.pop('geometry')
+				text = json.dumps(feature)
+				text = '%s%s, "geometry": %s}' % ("" if counts[name] == 0 else ", ", text[:-1], geometry)
+				counts[name] += 1
+				if name == names[0]:
+					yield text
+				else:
+					spools[name].write(text)
+			yield ']}'
+
+			# Then the others from their files
+			for name in names[1:]:
+				yield start_layer(name)
+				spool = spools[name]
+				spool.seek(0)
+				while True:
+					text = spool.read(65536)
+					if text == "":
+						break
+					yield text
+				yield ']}'
+		finally:
+			for spool in spools.values():
+				spool.close()
+	if layer_name in map_layer_sets:
+		yield "}"
 
 # A test which fetches a single tile
 if __name__ == "__main__":
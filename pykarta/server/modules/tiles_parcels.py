@@ -1,38 +1,51 @@
 # pykarta/server/modules/tiles_parcels.py
 # Produce GeoJSON tiles from parcel boundaries stored in a Spatialite database
-# Last modified: 19 October 2019
+# Last modified: 17 October 2026
 
 
-import os, json, re, gzip, io
-from pykarta.geometry.projection import unproject_from_tilespace
-from pykarta.server.dbopen import dbopen
+import os, json, re
+from pykarta.geometry.projection import tile_bbox
+from pykarta.server.tilecache import tile_response, tile_grid, encode_tile, encode_tile_mvt, quantize_tile
 
 def app(environ, start_response):
 	stderr = environ['wsgi.errors']
 
-	m = re.match(r'^/(\d+)/(\d+)/(\d+)\.geojson$', environ['PATH_INFO'])
+	m = re.match(r'^/(\d+)/(\d+)/(\d+)\.(geojson|mvt)$', environ['PATH_INFO'])
 	assert m, environ['PATH_INFO']
 	zoom = int(m.group(1))
 	x = int(m.group(2))
 	y = int(m.group(3))
+	format = m.group(4)
 	stderr.write("Parcel tile (%d, %d) at zoom %d...\n" % (x, y, zoom))
 	assert zoom <= 16
 
-	cursor, response_headers = dbopen(environ, "parcels.sqlite")
-	if cursor is None:
-		start_response("304 Not Modified", response_headers)
-		return []
+	def render(cursor):
+		return render_tile(stderr, cursor, zoom, x, y)
 
-	p1 = unproject_from_tilespace(x - 0.05, y - 0.05, zoom)
-	p2 = unproject_from_tilespace(x + 1.05, y + 1.05, zoom)
-	bbox = 'BuildMBR(%f,%f,%f,%f,4326)' % (p1[1], p1[0], p2[1], p2[0])
+	if format == "mvt":
+		return tile_response(environ, start_response, "parcels.sqlite", "parcels.mvt", zoom, x, y, render,
+			encode=lambda geojson: encode_tile_mvt({"parcels": geojson}, zoom, x, y),
+			content_type="application/vnd.mapbox-vector-tile")
+
+	grid = tile_grid(environ)
+	if grid is not None:
+		return tile_response(environ, start_response, "parcels.sqlite", "parcels.grid%d" % grid, zoom, x, y, render,
+			encode=lambda geojson: encode_tile(quantize_tile(geojson, zoom, x, y, grid)))
+
+	return tile_response(environ, start_response, "parcels.sqlite", "parcels", zoom, x, y, render)
+
+# Return the indicated tile as Python objects. This is used both
+# by app() and by the tile seeder.
+def render_tile(stderr, cursor, zoom, x, y):
+	# The bounding box and tolerance are bound as parameters so that
+	# SQLite can reuse the prepared statement.
+	params = dict(zip(("min_lon", "min_lat", "max_lon", "max_lat"), tile_bbox(zoom, x, y, 0.05)))
+	bbox = 'BuildMBR(:min_lon,:min_lat,:max_lon,:max_lat,4326)'
 
 	geometry = "Intersection(Geometry,{bbox})".format(bbox=bbox)
 	if zoom < 16:
-		geometry = "SimplifyPreserveTopology({geometry},{simplification})".format(
-			geometry=geometry,
-			simplification = 360.0 / (2.0 ** zoom) / 256.0		# one pixel
-			)
+		geometry = "SimplifyPreserveTopology({geometry},:simplification)".format(geometry=geometry)
+		params["simplification"] = 360.0 / (2.0 ** zoom) / 256.0		# one pixel
 	else:
 		#stderr.write("Not simplified\n")
 		pass
@@ -43,7 +56,7 @@ def app(environ, start_response):
 		AND ROWID IN ( SELECT ROWID FROM SpatialIndex WHERE f_table_name = 'parcels' AND search_frame = {bbox} )
 		""".format(geometry=geometry, bbox=bbox)
 
-	cursor.execute(query)
+	cursor.execute(query, params)
 
 	features = []
 	for row in cursor:
@@ -63,17 +76,7 @@ def app(environ, start_response):
 		'type': 'FeatureCollection',
 		'features': features,
 		}
-
-	# Convert to JSON and compress
-	out = io.BytesIO()
-	with gzip.open(out, mode='wt') as fo:
-		json.dump(geojson, fo)
-
-	start_response("200 OK", response_headers + [
-		('Content-Type', 'application/json'),
-		('Content-Encoding', 'gzip'),
-		])
-	return [out.getvalue()]
+	return geojson
 
 if __name__ == "__main__":
 	def dummy_start_response(code, headers):
@@ -0,0 +1,269 @@
+#! /usr/bin/python3
+# pykarta/server/seed.py
+# Render the server's GeoJSON tiles in advance
+# Last modified: 17 October 2026
+
+# After importing new data, run this to render the tiles of an area
+# so that no user has to wait for the first request for a tile:
+#
+# python3 -m pykarta.server.seed --datadir ~/geo_data/processed \
+#		--bbox -73.1,42.0,-72.3,42.4 --zoom 10-16
+#
+# By default the tiles are put in the server's tile cache (see tilecache.py)
+# so that it can send them as soon as it receives a request. They can be
+# saved instead as a directory of tiles or as MBTiles files (one per layer).
+#
+# The tiles are rendered by a pool of processes, each of which has its own
+# connexion to each database. The main process stores the tiles.
+
+import os, sys, math, json, time, argparse
+import multiprocessing
+import numpy
+
+from pykarta.geometry import BoundingBox, GeometryFromGeoJSON
+from pykarta.geometry.projection import project_points_tilespace, unproject_points_tilespace
+from pykarta.server.dbopen import dbopen, dbmtime
+from pykarta.server.tilecache import TileResponseCache, encode_tile
+from pykarta.server.modules import tiles_osm_vec, tiles_parcels
+from pykarta.formats.mbtiles import MapMbtilesWriter
+
+# Database from which each layer is rendered
+def layer_database(layer_name):
+	if layer_name == "parcels":
+		return "parcels.sqlite"
+	return "osm_map.sqlite"
+
+def all_layers():
+	return sorted(tiles_osm_vec.layers.keys()) + sorted(tiles_osm_vec.map_layer_sets.keys()) + ["parcels"]
+
+#=============================================================================
+# Which tiles cover the area?
+#=============================================================================
+
+# Yield (zoom, x, y) of the tiles which cover a bounding box and,
+# if a polygon is supplied, touch the polygon.
+def covering_tiles(bbox, zoom_start, zoom_stop, polygon=None):
+	prepared = polygon.prepare() if polygon is not None else None
+	for zoom in range(zoom_start, zoom_stop+1):
+		n = 1 << zoom
+		corners = ((bbox.max_lat, bbox.min_lon), (bbox.min_lat, bbox.max_lon))
+		(x_start, y_start), (x_stop, y_stop) = numpy.clip(project_points_tilespace(corners, zoom).astype(int), 0, n-1).tolist()
+		if prepared is None:
+			for x in range(x_start, x_stop+1):
+				for y in range(y_start, y_stop+1):
+					yield (zoom, x, y)
+		else:
+			for x, y in polygon_tiles(polygon, prepared, zoom, x_start, x_stop, y_start, y_stop):
+				yield (zoom, x, y)
+
+# A tile touches the polygon if one of its corners is inside the polygon
+# or the polygon's outline passes through it. To find the tiles through
+# which the outline passes, we take points along each edge at intervals
+# of less than half a tile.
+def polygon_tiles(polygon, prepared, zoom, x_start, x_stop, y_start, y_stop):
+	width = x_stop - x_start + 1
+	height = y_stop - y_start + 1
+	touched = numpy.zeros((width, height), dtype=bool)
+
+	corner_x, corner_y = numpy.meshgrid(numpy.arange(x_start, x_stop+2), numpy.arange(y_start, y_stop+2), indexing="ij")
+	corners = unproject_points_tilespace(numpy.column_stack((corner_x.ravel(), corner_y.ravel())), zoom)
+	inside = prepared.contains_points(corners).reshape(corner_x.shape)
+	touched |= inside[:-1,:-1] | inside[1:,:-1] | inside[:-1,1:] | inside[1:,1:]
+
+	if hasattr(polygon, "polygons"):
+		rings = [ring for p in polygon.polygons for ring in [p.points] + p.holes]
+	else:
+		rings = [polygon.points] + polygon.holes
+	for ring in rings:
+		vertices = project_points_tilespace(ring, zoom)
+		vertices = numpy.vstack((vertices, vertices[:1]))
+		for (x1, y1), (x2, y2) in zip(vertices[:-1].tolist(), vertices[1:].tolist()):
+			steps = int(math.ceil(max(abs(x2 - x1), abs(y2 - y1)) * 2.0)) + 1
+			t = numpy.linspace(0.0, 1.0, steps + 1)
+			xs = numpy.floor(x1 + (x2 - x1) * t).astype(int) - x_start
+			ys = numpy.floor(y1 + (y2 - y1) * t).astype(int) - y_start
+			keep = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+			touched[xs[keep], ys[keep]] = True
+
+	for x, y in zip(*numpy.nonzero(touched)):
+		yield (int(x) + x_start, int(y) + y_start)
+
+#=============================================================================
+# Rendering (in the worker processes)
+#=============================================================================
+
+worker_environ = None
+
+def worker_init(datadir, verbose):
+	global worker_environ
+	worker_environ = {
+		"DATADIR": datadir,
+		"wsgi.errors": sys.stderr if verbose else open(os.devnull, "w"),
+		}
+
+# Render all of the requested layers of one tile. The OSM layers, including
+# the members of layer sets, are rendered together so that each table is
+# scanned only once. Returns a list of (layer_name, database revision date,
+# gzipped GeoJSON).
+def worker_render(args):
+	zoom, x, y, layer_names = args
+	stderr = worker_environ["wsgi.errors"]
+
+	osm_names = set()
+	for layer_name in layer_names:
+		if layer_name in tiles_osm_vec.map_layer_sets:
+			osm_names.update(tiles_osm_vec.map_layer_sets[layer_name])
+		elif layer_name in tiles_osm_vec.layers:
+			osm_names.add(layer_name)
+	rendered = {}
+	if len(osm_names) > 0:
+		cursor, response_headers = dbopen(worker_environ, "osm_map.sqlite")
+		rendered = tiles_osm_vec.render_layers(stderr, cursor, sorted(osm_names), zoom, x, y)
+
+	results = []
+	for layer_name in layer_names:
+		db_basename = layer_database(layer_name)
+		if layer_name == "parcels":
+			cursor, response_headers = dbopen(worker_environ, db_basename)
+			geojson = tiles_parcels.render_tile(stderr, cursor, zoom, x, y)
+		elif layer_name in tiles_osm_vec.map_layer_sets:
+			geojson = {}
+			for name in tiles_osm_vec.map_layer_sets[layer_name]:
+				if rendered[name] is not None:
+					geojson[name.replace("osm-vector-","")] = rendered[name]
+		else:
+			geojson = rendered[layer_name]
+		if geojson is not None:
+			results.append((layer_name, dbmtime(db_basename), encode_tile(geojson)))
+	return (zoom, x, y, results)
+
+#=============================================================================
+# Tile stores (in the main process)
+#=============================================================================
+
+class SeedStoreCache(object):
+	def __init__(self, filename):
+		self.cache = TileResponseCache(filename, sys.stderr)
+		self.cache.ram_max_bytes = 0
+	def add_tile(self, layer_name, zoom, x, y, mtime, data):
+		self.cache.put(layer_name, zoom, x, y, mtime, data)
+	def close(self):
+		pass
+
+class SeedStoreDirectory(object):
+	def __init__(self, output_dir):
+		self.output_dir = output_dir
+	def add_tile(self, layer_name, zoom, x, y, mtime, data):
+		dirname = os.path.join(self.output_dir, layer_name, str(zoom), str(x))
+		if not os.path.exists(dirname):
+			os.makedirs(dirname)
+		with open(os.path.join(dirname, "%d.geojson" % y), "wb") as f:
+			f.write(data)
+	def close(self):
+		pass
+
+class SeedStoreMbtiles(object):
+	def __init__(self, output_dir):
+		self.output_dir = output_dir
+		self.writers = {}
+	def add_tile(self, layer_name, zoom, x, y, mtime, data):
+		writer = self.writers.get(layer_name)
+		if writer is None:
+			if not os.path.exists(self.output_dir):
+				os.makedirs(self.output_dir)
+			writer = self.writers[layer_name] = MapMbtilesWriter(
+				os.path.join(self.output_dir, "%s.mbtiles" % layer_name),
+				{"name": layer_name, "format": "geojson"}
+				)
+		writer.add_tile(zoom, x, y, data)
+	def close(self):
+		for writer in self.writers.values():
+			writer.close()
+
+#=============================================================================
+# Command line
+#=============================================================================
+
+def parse_zoom_range(text):
+	if "-" in text:
+		start, stop = text.split("-", 1)
+	else:
+		start = stop = text
+	return (int(start), int(stop))
+
+def load_polygon(filename):
+	with open(filename) as f:
+		geojson = json.load(f)
+	if geojson["type"] == "FeatureCollection":
+		geojson = geojson["features"][0]
+	if geojson["type"] == "Feature":
+		geojson = geojson["geometry"]
+	return GeometryFromGeoJSON(geojson)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Render the server's GeoJSON tiles in advance")
+	area = parser.add_mutually_exclusive_group(required=True)
+	area.add_argument("--bbox", help="min_lon,min_lat,max_lon,max_lat")
+	area.add_argument("--polygon", help="GeoJSON file containing a Polygon or MultiPolygon")
+	parser.add_argument("--zoom", type=parse_zoom_range, required=True, help="zoom level or range such as 10-16")
+	parser.add_argument("--layers", help="comma-separated list of layers and layer sets (default: all)")
+	parser.add_argument("--datadir", default=os.environ.get("DATADIR"), help="directory containing the databases")
+	parser.add_argument("--format", choices=("cache", "directory", "mbtiles"), default="cache")
+	parser.add_argument("--output", help="tile cache file (default $DATADIR/tile_cache.sqlite) or output directory")
+	parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+	parser.add_argument("--verbose", action="store_true")
+	args = parser.parse_args(argv)
+
+	if args.datadir is None:
+		parser.error("--datadir or $DATADIR is required")
+	zoom_start, zoom_stop = args.zoom
+	if zoom_start > zoom_stop or zoom_stop > 16:
+		parser.error("invalid zoom range")
+
+	layer_names = args.layers.split(",") if args.layers else all_layers()
+	for layer_name in layer_names:
+		if not layer_name in all_layers():
+			parser.error("no such layer: %s" % layer_name)
+
+	polygon = None
+	if args.bbox is not None:
+		min_lon, min_lat, max_lon, max_lat = map(float, args.bbox.split(","))
+		bbox = BoundingBox((min_lon, min_lat, max_lon, max_lat))
+	else:
+		polygon = load_polygon(args.polygon)
+		bbox = polygon.get_bbox()
+
+	if args.format == "cache":
+		store = SeedStoreCache(args.output or os.path.join(args.datadir, "tile_cache.sqlite"))
+	elif args.output is None:
+		parser.error("--output is required for --format=%s" % args.format)
+	elif args.format == "directory":
+		store = SeedStoreDirectory(args.output)
+	else:
+		store = SeedStoreMbtiles(args.output)
+
+	tiles = [(zoom, x, y, layer_names) for zoom, x, y in covering_tiles(bbox, zoom_start, zoom_stop, polygon)]
+	print("Rendering %d tiles of %d layer(s) using %d processes..." % (len(tiles), len(layer_names), args.processes))
+
+	start_time = time.time()
+	pool = multiprocessing.Pool(args.processes, initializer=worker_init, initargs=(args.datadir, args.verbose))
+	try:
+		count = 0
+		for zoom, x, y, results in pool.imap_unordered(worker_render, tiles, chunksize=8):
+			for layer_name, mtime, data in results:
+				store.add_tile(layer_name, zoom, x, y, mtime, data)
+			count += 1
+			if count % 100 == 0 or count == len(tiles):
+				elapsed = time.time() - start_time
+				sys.stdout.write("\r%d of %d tiles, %.1f tiles/second " % (count, len(tiles), count / elapsed if elapsed > 0 else 0.0))
+				sys.stdout.flush()
+		print()
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+		store.close()
+
+if __name__ == "__main__":
+	main()
+
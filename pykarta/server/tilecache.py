@@ -0,0 +1,234 @@
+# pykarta/server/tilecache.py
+# Cache of gzipped tile responses
+# Last modified: 17 October 2026
+
+# Rendering a vector tile means running one or more spatial queries and
+# then converting the result to JSON and compressing it. Since the same
+# tiles are requested over and over, we keep the compressed responses in
+# an SQLite database with a small RAM cache in front of it.
+#
+# Each tile is stored along with the revision date of the database from
+# which it was rendered. When the database is replaced, the old tiles
+# no longer match and are deleted the first time they are found.
+#
+# The cache file is $TILECACHE if set in the WSGI environment, otherwise
+# tile_cache.sqlite in $DATADIR. If it can not be opened, only the RAM
+# cache is used.
+
+import os, io, json, gzip, zlib
+import sqlite3
+import threading
+from urllib.parse import parse_qs
+from collections import OrderedDict
+from pykarta.server.dbopen import dbopen, dbmtime
+from pykarta.geometry.projection import project_geojson_geometries_quantized
+from pykarta.formats.mvt import mvt_encode_geojson
+
+class TileResponseCache(object):
+	ram_max_bytes = 32 * 1024 * 1024
+
+	def __init__(self, filename, stderr):
+		self.filename = filename
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.ram = OrderedDict()		# (name, zoom, x, y) -> (mtime, data)
+		self.ram_bytes = 0
+		try:
+			conn = self._connect()
+			conn.execute("""CREATE TABLE IF NOT EXISTS tiles (
+				name text, zoom integer, x integer, y integer, mtime integer, data blob,
+				PRIMARY KEY (name, zoom, x, y)
+				)""")
+			conn.commit()
+		except sqlite3.Error as e:
+			stderr.write("Tile cache %s not available: %s\n" % (filename, str(e)))
+			self.filename = None
+
+	def _connect(self):
+		conn = getattr(self.local, "conn", None)
+		if conn is None:
+			conn = sqlite3.connect(self.filename, timeout=30)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+			self.local.conn = conn
+		return conn
+
+	# Return the gzipped tile rendered from the database revision
+	# of the indicated date, or None.
+	def get(self, name, zoom, x, y, mtime):
+		key = (name, zoom, x, y)
+		with self.lock:
+			item = self.ram.get(key)
+			if item is not None:
+				if item[0] == mtime:
+					self.ram.move_to_end(key)
+					return item[1]
+				self._ram_remove(key)
+
+		if self.filename is None:
+			return None
+		conn = self._connect()
+		row = conn.execute("SELECT mtime, data FROM tiles WHERE name=? AND zoom=? AND x=? AND y=?", key).fetchone()
+		if row is None:
+			return None
+		if row[0] != mtime:
+			with conn:
+				conn.execute("DELETE FROM tiles WHERE name=? AND zoom=? AND x=? AND y=? AND mtime=?", key + (row[0],))
+			return None
+		data = bytes(row[1])
+		self._ram_add(key, mtime, data)
+		return data
+
+	def put(self, name, zoom, x, y, mtime, data):
+		key = (name, zoom, x, y)
+		self._ram_add(key, mtime, data)
+		if self.filename is not None:
+			with self._connect() as conn:
+				conn.execute("INSERT OR REPLACE INTO tiles (name, zoom, x, y, mtime, data) VALUES (?, ?, ?, ?, ?, ?)", key + (mtime, sqlite3.Binary(data)))
+
+	def _ram_add(self, key, mtime, data):
+		with self.lock:
+			self._ram_remove(key)
+			self.ram[key] = (mtime, data)
+			self.ram_bytes += len(data)
+			while self.ram_bytes > self.ram_max_bytes:
+				old_key, (old_mtime, old_data) = self.ram.popitem(last=False)
+				self.ram_bytes -= len(old_data)
+
+	def _ram_remove(self, key):
+		item = self.ram.pop(key, None)
+		if item is not None:
+			self.ram_bytes -= len(item[1])
+
+tile_cache = None
+tile_cache_lock = threading.Lock()
+
+def get_tile_cache(environ):
+	global tile_cache
+	with tile_cache_lock:
+		if tile_cache is None:
+			filename = environ.get("TILECACHE")
+			if filename is None:
+				filename = os.path.join(environ["DATADIR"], "tile_cache.sqlite")
+			tile_cache = TileResponseCache(filename, environ['wsgi.errors'])
+		return tile_cache
+
+# Convert Python objects to JSON and compress
+def encode_tile(geojson):
+	out = io.BytesIO()
+	with gzip.open(out, mode='wt') as fo:
+		json.dump(geojson, fo)
+	return out.getvalue()
+
+# Compress JSON text which arrives in pieces, yielding the gzipped
+# data a piece at a time as the compressor lets it go
+def encode_tile_stream(chunks):
+	compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+	for chunk in chunks:
+		data = compressor.compress(chunk.encode("utf-8"))
+		if data:
+			yield data
+	yield compressor.flush()
+
+# Convert a dict of layer name -> GeoJSON FeatureCollection to a
+# Mapbox Vector Tile and compress
+def encode_tile_mvt(layers, zoom, x, y):
+	return gzip.compress(mvt_encode_geojson(layers, zoom, x, y))
+
+# Convert a GeoJSON FeatureCollection (or a dict of them, as is returned
+# for a layer set) from degrees to the pixel space of the tile with the
+# positions rounded to 1/grid of a pixel. Features which shrink to nothing
+# are dropped. The result is marked with "tile_pixels" so that the client
+# knows not to project it.
+def quantize_tile(geojson, zoom, x, y, grid=1):
+	if geojson is None:
+		return None
+	if geojson.get("type") != "FeatureCollection":
+		return dict([(name, quantize_tile(layer, zoom, x, y, grid)) for name, layer in geojson.items()])
+	features = geojson["features"]
+	geometries = project_geojson_geometries_quantized([feature["geometry"] for feature in features], zoom, x, y, 256 * grid)
+	if grid != 1:
+		scale = 1.0 / grid
+		geometries = [_scale_geometry(geometry, scale) for geometry in geometries]
+	new_features = []
+	for feature, geometry in zip(features, geometries):
+		if geometry is not None:
+			feature = dict(feature)
+			feature["geometry"] = geometry
+			new_features.append(feature)
+	return {
+		"type": "FeatureCollection",
+		"features": new_features,
+		"tile_pixels": True,
+		}
+
+def _scale_geometry(geometry, scale):
+	if geometry is None:
+		return None
+	if geometry["type"] == "GeometryCollection":
+		return {"type": "GeometryCollection", "geometries": [_scale_geometry(member, scale) for member in geometry["geometries"]]}
+	def scale_coordinates(coordinates):
+		if isinstance(coordinates[0], list):
+			return [scale_coordinates(item) for item in coordinates]
+		return [coordinates[0] * scale, coordinates[1] * scale]
+	return {"type": geometry["type"], "coordinates": scale_coordinates(geometry["coordinates"])}
+
+# The tile format requested in the query string. ?grid=N asks for GeoJSON
+# in tile pixels rounded to 1/N pixel (N from 1 to 16). Returns None if
+# degrees are wanted.
+def tile_grid(environ):
+	query = parse_qs(environ.get("QUERY_STRING", ""))
+	if not "grid" in query:
+		return None
+	try:
+		grid = int(query["grid"][0])
+	except ValueError:
+		return None
+	return min(max(grid, 1), 16)
+
+# Send a tile from the indicated database, using the cached copy if
+# there is a current one. Otherwise call render(cursor), which should
+# return the tile as Python objects, and pass the result to encode()
+# which should return it gzipped.
+#
+# If stream is True, encode() should instead return an iterable of
+# pieces of gzipped data, which are sent as they are produced. The
+# response is then an iterable which still needs the cursor, so the
+# caller must not release the database until it is closed (see app.py).
+# The tile goes into the cache once it has all been sent.
+def tile_response(environ, start_response, db_basename, name, zoom, x, y, render, encode=encode_tile, content_type="application/json", stream=False):
+	stderr = environ['wsgi.errors']
+
+	cursor, response_headers = dbopen(environ, db_basename)
+	if cursor is None:
+		start_response("304 Not Modified", response_headers)
+		return []
+
+	cache = get_tile_cache(environ)
+	mtime = dbmtime(db_basename)
+	data = cache.get(name, zoom, x, y, mtime)
+	if data is None:
+		if stream:
+			start_response("200 OK", response_headers + [
+				("Content-Type", content_type),
+				("Content-Encoding", "gzip"),
+				])
+			def pieces():
+				sent = []
+				for piece in encode(render(cursor)):
+					sent.append(piece)
+					yield piece
+				cache.put(name, zoom, x, y, mtime, b"".join(sent))
+			return pieces()
+		data = encode(render(cursor))
+		cache.put(name, zoom, x, y, mtime, data)
+	else:
+		stderr.write("Tile from cache\n")
+
+	start_response("200 OK", response_headers + [
+		("Content-Type", content_type),
+		("Content-Encoding", "gzip"),
+		("Content-Length", str(len(data))),
+		])
+	return [data]
+
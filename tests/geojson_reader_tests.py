@@ -0,0 +1,85 @@
+#! /usr/bin/python3
+
+import json, gzip
+from pykarta.formats.geojson_reader import GeojsonReader
+
+#============================================================================
+# The incremental reader should find the same features as json.loads()
+# however the input is broken up. Small chunk sizes split the tokens, the
+# geometries and the UTF-8 sequences between reads.
+#============================================================================
+
+def feature_collection(n):
+	return {
+		"type": "FeatureCollection",
+		"features": [
+			{"type": "Feature", "id": 1, "properties": {"name": "Café {n° %d}" % n, "tags": {"a": [1, 2]}},
+				"geometry": {"type": "Point", "coordinates": [-72.5, 41.75]}},
+			{"type": "Feature", "id": "two", "properties": {"highway": "residential"},
+				"geometry": {"type": "LineString", "coordinates": [[-72.5, 41.75], [-72.25, 41.5]]}},
+			{"type": "Feature", "properties": None,
+				"geometry": {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]], [[0.2, 0.1], [0.8, 0.1], [0.8, 0.7], [0.2, 0.1]]]}},
+			{"type": "Feature", "id": 4, "properties": {},
+				"geometry": {"coordinates": [[[[0, 0], [1, 0], [1, 1], [0, 0]]]], "type": "MultiPolygon"}},
+			{"type": "Feature", "id": 5, "properties": {"x": "東京"},
+				"geometry": {"type": "GeometryCollection", "geometries": [
+					{"type": "Point", "coordinates": [1, 2]},
+					{"type": "LineString", "coordinates": [[1, 2], [3, 4]]},
+					]}},
+			{"type": "Feature", "id": 6, "properties": {"empty": True}, "geometry": None},
+			],
+		"tile_pixels": n % 2 == 0,
+		}
+
+documents = [
+	("single collection", feature_collection(1)),
+	("empty collection", {"type": "FeatureCollection", "features": []}),
+	("layer set", {"roads": feature_collection(2), "places": feature_collection(3), "water": {"features": [], "type": "FeatureCollection"}}),
+	]
+
+# Read everything the way a renderer would
+def read_all(reader):
+	result = {}
+	for name, collection in reader.collections():
+		features = []
+		for feature in collection:
+			features.append((feature.id, feature.properties, feature.geometry_type, feature.geometry()))
+		result[name] = (features, collection.foreign_members)
+	return result
+
+# The same from the output of json.loads()
+def expected_from(document):
+	def collection_result(collection):
+		features = []
+		for feature in collection["features"]:
+			geometry = feature.get("geometry")
+			features.append((feature.get("id"), feature.get("properties") or {}, geometry["type"] if geometry is not None else None, geometry))
+		foreign_members = dict([(key, value) for key, value in collection.items() if not key in ("type", "features")])
+		return (features, foreign_members)
+	if document.get("type") == "FeatureCollection":
+		return {None: collection_result(document)}
+	return dict([(name, collection_result(collection)) for name, collection in document.items()])
+
+print("=== GeoJSON Reader ===")
+for description, document in documents:
+	for indent in (None, 2):
+		text = json.dumps(document, indent=indent, ensure_ascii=False).encode("utf-8")
+		expected = expected_from(json.loads(text.decode("utf-8")))
+		for gzipped in (False, True):
+			data = gzip.compress(text) if gzipped else text
+			for chunk_size in (1, 2, 3, 7, 64, 65536):
+				reader = GeojsonReader(data=data)
+				reader.chunk_size = chunk_size
+				assert reader.is_json()
+				result = read_all(reader)
+				assert result == expected, (description, indent, gzipped, chunk_size)
+	print(description, "OK")
+print()
+
+#============================================================================
+
+print("=== GeoJSON Reader, Not JSON ===")
+reader = GeojsonReader(data=b"\x1a\x05roads")
+print("is_json:", reader.is_json())
+assert not reader.is_json()
+print()
@@ -1,6 +1,7 @@
 #! /usr/bin/python
 
 from pykarta.geometry import *
+from pykarta.geometry.distance import plane_lineseg_distance
 
 #============================================================================
 
@@ -33,6 +34,16 @@ print
 
 #============================================================================
 
+print "=== Empty GeoJSON Coordinates ==="
+for geometry_type in ("LineString", "MultiPoint"):
+	geometry = GeometryFromGeoJSON({"type": geometry_type, "coordinates": []})
+	print geometry_type, ":", geometry.as_geojson()
+	assert len(geometry.points) == 0
+	assert geometry.as_geojson() == {"type": geometry_type, "coordinates": []}
+print
+
+#============================================================================
+
 print "=== Simplified line ==="
 line = ( (0,0), (1,0), (2,0), (3,0), (4,0), (5,0), (6,0), (6,1), (6,2), (6,3), (6,4), (6,5), (6,6), (5,6), (4,6), (3,6), (2,6), (1,6), (0,6), (0,5), (0,4), (0,3), (0,2), (0,1), (0,0) )
 simplified = line_simplify(line, 1.0)
@@ -0,0 +1,89 @@
+#! /usr/bin/python3
+
+from pykarta.formats.mvt import *
+from pykarta.geometry.projection import unproject_from_tilespace
+
+#============================================================================
+# The features are given in the grid of the tile (4096 units across) and
+# converted to degrees for the encoder. The decoder is asked for the same
+# grid, so what comes back should be exactly what went in. Exterior rings
+# have a positive area and holes a negative one, as in a vector tile.
+#============================================================================
+
+zoom, xtile, ytile = 14, 4823, 6127
+extent = 4096
+
+def to_degrees(coordinates):
+	if isinstance(coordinates[0], list):
+		return [to_degrees(item) for item in coordinates]
+	lat, lon = unproject_from_tilespace(xtile + coordinates[0] / float(extent), ytile + coordinates[1] / float(extent), zoom)
+	return [lon, lat]
+
+def geometry_to_degrees(geometry):
+	if geometry["type"] == "GeometryCollection":
+		return {"type": "GeometryCollection", "geometries": [geometry_to_degrees(member) for member in geometry["geometries"]]}
+	return {"type": geometry["type"], "coordinates": to_degrees(geometry["coordinates"])}
+
+# Decoded points are tuples
+def as_lists(coordinates):
+	if isinstance(coordinates[0], (list, tuple)):
+		return [as_lists(item) for item in coordinates]
+	return [coordinates[0], coordinates[1]]
+
+square = [[100,100], [900,100], [900,900], [100,900], [100,100]]
+hole = [[300,300], [300,700], [700,700], [700,300], [300,300]]
+square2 = [[2000,2000], [3000,2000], [3000,3000], [2000,3000], [2000,2000]]
+
+features = [
+	(1, {"type": "Point", "coordinates": [10,20]}, {"name": "a point", "rank": 3}),
+	(2, {"type": "MultiPoint", "coordinates": [[10,20], [4000,4000]]}, {"rank": -3}),
+	(3, {"type": "LineString", "coordinates": [[0,0], [100,50], [4095,4095]]}, {"highway": "residential", "oneway": True}),
+	(4, {"type": "MultiLineString", "coordinates": [[[0,0], [10,10]], [[20,20], [30,30], [40,20]]]}, {"width": 2.5}),
+	(5, {"type": "Polygon", "coordinates": [square]}, {"name": "no hole"}),
+	(6, {"type": "Polygon", "coordinates": [square, hole]}, {"name": "one hole"}),
+	(7, {"type": "MultiPolygon", "coordinates": [[square, hole], [square2]]}, {"name": "two parts"}),
+	(8, {"type": "GeometryCollection", "geometries": [
+		{"type": "Point", "coordinates": [500,500]},
+		{"type": "Polygon", "coordinates": [square2]},
+		]}, {"name": "collection"}),
+	]
+
+# A GeometryCollection comes back as one feature for each member
+expected = []
+for id, geometry, properties in features:
+	for member in (geometry["geometries"] if geometry["type"] == "GeometryCollection" else [geometry]):
+		expected.append({"type": "Feature", "id": id, "geometry": member, "properties": properties})
+
+print("=== MVT Round Trip ===")
+layers = {"things": {"type": "FeatureCollection", "features": [
+	{"type": "Feature", "id": id, "geometry": geometry_to_degrees(geometry), "properties": properties}
+	for id, geometry, properties in features
+	]}}
+data = mvt_encode_geojson(layers, zoom, xtile, ytile, extent=extent)
+print("Bytes:", len(data))
+decoded = mvt_decode(data, tilesize=extent)
+assert list(decoded.keys()) == ["things"]
+assert decoded["things"]["tile_pixels"] is True
+decoded_features = decoded["things"]["features"]
+assert len(decoded_features) == len(expected), len(decoded_features)
+for got, wanted in zip(decoded_features, expected):
+	print(wanted["id"], got["geometry"]["type"])
+	got["geometry"]["coordinates"] = as_lists(got["geometry"]["coordinates"])
+	assert got == wanted, (got, wanted)
+print()
+
+#============================================================================
+
+print("=== MVT Ring Orientation ===")
+# Rings wound the wrong way are reversed by the encoder so that the
+# decoder can still tell the holes from the outer rings.
+backwards = [square[::-1], hole[::-1]]
+data = mvt_encode_layer("backwards", [(9, "Polygon", backwards, {})], extent=extent)
+geometry = mvt_decode(data, tilesize=extent)["backwards"]["features"][0]["geometry"]
+print(geometry)
+assert geometry["type"] == "Polygon"
+assert len(geometry["coordinates"]) == 2
+outer, inner = geometry["coordinates"]
+assert sorted(as_lists(outer[:-1])) == sorted(square[:-1])
+assert sorted(as_lists(inner[:-1])) == sorted(hole[:-1])
+print()
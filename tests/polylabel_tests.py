@@ -0,0 +1,74 @@
+#! /usr/bin/python3
+
+import numpy
+from pykarta.geometry.polylabel import polylabel, PolylabelEdges
+
+#============================================================================
+# polylabel() should find a point inside the polygon which is as far from
+# the outline as the best point of a dense grid, give or take the
+# precision and the spacing of the grid.
+#============================================================================
+
+def grid_best(rings, step):
+	edges = PolylabelEdges(rings)
+	min_x, min_y, max_x, max_y = edges.bbox
+	xs, ys = numpy.meshgrid(numpy.arange(min_x, max_x + step, step), numpy.arange(min_y, max_y + step, step))
+	xs = xs.ravel()
+	ys = ys.ravel()
+	best = None
+	for start in range(0, len(xs), 1000):
+		distances = edges.signed_distances(xs[start:start+1000], ys[start:start+1000])
+		i = int(numpy.argmax(distances))
+		if best is None or distances[i] > best[1]:
+			best = ((float(xs[start+i]), float(ys[start+i])), float(distances[i]))
+	return best
+
+polygons = [
+	("square", [[(0,0), (100,0), (100,100), (0,100), (0,0)]]),
+	("square with hole", [[(0,0), (100,0), (100,100), (0,100), (0,0)], [(20,20), (60,20), (60,60), (20,60), (20,20)]]),
+	("L shape", [[(0,0), (100,0), (100,20), (20,20), (20,100), (0,100), (0,0)]]),
+	("thin diagonal", [[(0,0), (10,0), (200,190), (200,200), (190,200), (0,10), (0,0)]]),
+	("two parts", [[(0,0), (30,0), (30,30), (0,30), (0,0)], [(50,0), (150,0), (150,60), (50,60), (50,0)]]),
+	("unclosed", [[(0,0), (80,10), (90,70), (30,90), (-10,40)]]),
+	("polygon_labeling_test.py", [[
+		(230.69803743588272, -12.80152180197183),
+		(230.7776694044005, -6.943896176293492),
+		(233.1235669333255, -0.9983627885812894),
+		(242.30851015110966, 9.023812301456928),
+		(236.08579413336702, 10.969468633644283),
+		(231.45691363560036, 6.02480027556885),
+		(229.47044465783983, 1.7477599720004946),
+		(228.48070542223286, -9.256459996337071),
+		(226.34700524725486, -12.80152180197183),
+		(230.69803743588272, -12.80152180197183),
+		]]),
+	]
+
+print("=== Polylabel ===")
+for name, rings in polygons:
+	edges = PolylabelEdges(rings)
+	min_x, min_y, max_x, max_y = edges.bbox
+	size = max(max_x - min_x, max_y - min_y)
+	precision = size / 200.0
+	step = size / 400.0
+	(x, y), distance = polylabel(rings, precision=precision)
+	(grid_x, grid_y), grid_distance = grid_best(rings, step)
+	print(name, ":", (x, y), distance, "grid:", (grid_x, grid_y), grid_distance)
+
+	# The distance reported is that of the point returned, and it is inside.
+	assert abs(edges.signed_distances([x], [y])[0] - distance) < 1e-9
+	assert distance > 0.0
+
+	# Not worse than the grid by more than the precision
+	assert distance >= grid_distance - precision, (distance, grid_distance)
+
+	# And the grid finds nothing much better (within half a diagonal step)
+	assert grid_distance <= distance + precision + step * 0.71, (distance, grid_distance)
+print()
+
+#============================================================================
+
+print("=== Polylabel, Degenerate ===")
+print(polylabel([[(0,0), (10,0), (20,0)]]))
+assert polylabel([[(0,0), (10,0), (20,0)]]) == ((0, 0), 0.0)
+print()
@@ -0,0 +1,44 @@
+#! /usr/bin/python3
+
+import os, sqlite3, tempfile, shutil
+from pykarta.server.seed import SeedStoreMbtiles
+
+#============================================================================
+# The tiles are seeded again after each import, into the same directory.
+# The second run should replace the tiles it renders again and keep the
+# others.
+#============================================================================
+
+def read_tiles(filename):
+	conn = sqlite3.connect(filename)
+	tiles = dict([((zoom, x, y), bytes(data)) for zoom, x, y, data in conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles")])
+	metadata = dict(conn.execute("SELECT name, value FROM metadata").fetchall())
+	conn.close()
+	return tiles, metadata
+
+print("=== Seed MBTiles Twice ===")
+output_dir = tempfile.mkdtemp()
+try:
+	store = SeedStoreMbtiles(output_dir)
+	store.add_tile("osm-vector-roads", 14, 4823, 6127, 0, b"first 1")
+	store.add_tile("osm-vector-roads", 14, 4824, 6127, 0, b"first 2")
+	store.close()
+
+	store = SeedStoreMbtiles(output_dir)
+	store.add_tile("osm-vector-roads", 14, 4823, 6127, 0, b"second 1")
+	store.add_tile("osm-vector-roads", 14, 4823, 6128, 0, b"second 3")
+	store.close()
+
+	tiles, metadata = read_tiles(os.path.join(output_dir, "osm-vector-roads.mbtiles"))
+	print("Tiles:", tiles)
+	print("Metadata:", metadata)
+	flipped = (2**14-1)
+	assert tiles == {
+		(14, 4823, flipped - 6127): b"second 1",
+		(14, 4824, flipped - 6127): b"first 2",
+		(14, 4823, flipped - 6128): b"second 3",
+		}
+	assert metadata == {"name": "osm-vector-roads", "format": "geojson"}
+finally:
+	shutil.rmtree(output_dir)
+print()
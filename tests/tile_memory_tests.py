@@ -0,0 +1,51 @@
+#! /usr/bin/python3
+
+from collections import OrderedDict
+from pykarta.maps.layers.base import MapTileLayer, tile_memory_manager
+
+#============================================================================
+# A tile which is larger than the whole memory budget can not be kept.
+# It should be loaded again each time it is wanted, not left in the
+# layer's RAM cache where the memory manager does not know about it.
+#============================================================================
+
+class BigTile(object):
+	def get_memory_size(self):
+		return 1000
+
+class TestLayer(MapTileLayer):
+	def __init__(self):
+		self.ram_cache = OrderedDict()
+		self.ram_cache_max = 1000
+		self.loads = 0
+	def load_tile(self, zoom, x, y, may_download):
+		self.loads += 1
+		return BigTile()
+
+print("=== Tile Larger Than Budget ===")
+saved_budget = tile_memory_manager.budget
+layer = TestLayer()
+try:
+	tile_memory_manager.set_budget(500)
+	for i in range(3):
+		tile = layer.load_tile_cached(14, 4823, 6127, True)
+		assert isinstance(tile, BigTile)
+	stats = tile_memory_manager.get_stats()
+	print("Loads:", layer.loads, "Cached:", len(layer.ram_cache), "Stats:", stats)
+	assert layer.loads == 3
+	assert len(layer.ram_cache) == 0
+	assert stats["used"] == 0
+
+	# Once the budget is large enough, the tile stays.
+	tile_memory_manager.set_budget(5000)
+	hits = tile_memory_manager.get_stats()["hits"]
+	for i in range(3):
+		layer.load_tile_cached(14, 4823, 6127, True)
+	print("Loads:", layer.loads, "Cached:", len(layer.ram_cache))
+	assert layer.loads == 4
+	assert list(layer.ram_cache.keys()) == [(14, 4823, 6127)]
+	assert tile_memory_manager.get_stats()["hits"] == hits + 2
+finally:
+	layer.ram_cache_clear()
+	tile_memory_manager.set_budget(saved_budget)
+print()